@@ -1,7 +1,7 @@
 import json
 from typing import Dict, List, Any
 from helpers import check_args_and_env_vars
-from storage import list_files_in_dir, download_file
+from storage import list_files_in_dir, download_many
 
 
 def is_empty_response(response: str) -> bool:
@@ -27,47 +27,46 @@ def group_responses(
     not_consistent_count = 0
 
     # List all JSON files in the specified GCS bucket and prefix
-    file_names = list_files_in_dir(batch_outputs_bucket, batch_outputs_prefix)
-
-    for blob_name in file_names:
-        if blob_name.endswith(".json"):
-            response_content = download_file(batch_outputs_bucket, blob_name)
-            if response_content is None:
-                print(f"No content retrieved for {blob_name}")
+    json_file_names = list_files_in_dir(
+        batch_outputs_bucket, batch_outputs_prefix, suffix=".json"
+    )
+    response_contents = download_many(batch_outputs_bucket, json_file_names)
+
+    for blob_name, response_content in zip(json_file_names, response_contents):
+        if response_content is None:
+            print(f"No content retrieved for {blob_name}")
+            continue
+        try:
+            data = json.loads(response_content)
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON from blob {blob_name}: {e}")
+            continue
+
+        for item in data:
+            custom_id = item.get("custom_id", "")
+            if not custom_id:
                 continue
+
             try:
-                data = json.loads(response_content)
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON from blob {blob_name}: {e}")
+                main_filename, section = custom_id.rsplit("-", 1)
+                main_filename = main_filename.replace("-Section", "")
+            except ValueError:
+                print(f"Invalid custom_id format in blob {blob_name}: {custom_id}")
                 continue
 
-            for item in data:
-                custom_id = item.get("custom_id", "")
-                if not custom_id:
-                    continue
-
-                try:
-                    main_filename, section = custom_id.rsplit("-", 1)
-                    main_filename = main_filename.replace("-Section", "")
-                except ValueError:
-                    print(f"Invalid custom_id format in blob {blob_name}: {custom_id}")
-                    continue
-
-                if main_filename not in grouped_data:
-                    grouped_data[main_filename] = {}
-
-                if section not in grouped_data[main_filename]:
-                    grouped_data[main_filename][section] = {"responses": []}
-
-                response_body = item.get("response", {}).get("body", {})
-                message_content = (
-                    response_body.get("choices", [{}])[0]
-                    .get("message", {})
-                    .get("content", "")
-                )
-                grouped_data[main_filename][section]["responses"].append(
-                    message_content
-                )
+            if main_filename not in grouped_data:
+                grouped_data[main_filename] = {}
+
+            if section not in grouped_data[main_filename]:
+                grouped_data[main_filename][section] = {"responses": []}
+
+            response_body = item.get("response", {}).get("body", {})
+            message_content = (
+                response_body.get("choices", [{}])[0]
+                .get("message", {})
+                .get("content", "")
+            )
+            grouped_data[main_filename][section]["responses"].append(message_content)
 
     # Calculate consistency counts per section
     for main_filename, sections in grouped_data.items():
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from typing import BinaryIO, List, Tuple
+
+import dotenv
+
+dotenv.load_dotenv()
+
+CACHE_DIR: str = os.getenv("BLOB_CACHE_DIR", ".blob_cache")
+# Set BLOB_CACHE_MAX_BYTES=0 to disable the cache
+CACHE_MAX_BYTES: int = int(os.getenv("BLOB_CACHE_MAX_BYTES", str(2 * 1024**3)))
+
+# Prefix of the temporary files entries are written to, never a cache key
+_TEMP_PREFIX = ".tmp-"
+
+_cache_lock = threading.Lock()
+_cache_size: int | None = None
+
+
+def is_enabled() -> bool:
+    """Return True if the local blob cache is enabled."""
+    return CACHE_MAX_BYTES > 0
+
+
+def cache_key(bucket_name: str, blob_name: str, generation: int | str) -> str:
+    """
+    Build the cache key for a specific version of a blob.
+
+    Args:
+        bucket_name (str): The name of the GCS bucket.
+        blob_name (str): The name of the blob.
+        generation (int | str): The generation (or etag) of the blob.
+
+    Returns:
+        str: A hex digest identifying the blob version.
+    """
+    return hashlib.sha256(
+        f"{bucket_name}/{blob_name}#{generation}".encode("utf-8")
+    ).hexdigest()
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+
+def get(key: str) -> str | None:
+    """
+    Look up a cache entry and mark it as recently used.
+
+    Args:
+        key (str): The cache key from cache_key.
+
+    Returns:
+        str | None: The local path of the cached blob, or None on a miss.
+    """
+    path = _entry_path(key)
+    try:
+        # The modification time doubles as the last access time for eviction
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def put(key: str, data: bytes) -> str:
+    """
+    Store blob contents in the cache and evict old entries if the cache is full.
+
+    Args:
+        key (str): The cache key from cache_key.
+        data (bytes): The blob contents.
+
+    Returns:
+        str: The local path of the cached blob.
+    """
+    file, temp_path = open_temp(key)
+    with file:
+        file.write(data)
+    return commit(key, temp_path)
+
+
+def open_temp(key: str) -> Tuple[BinaryIO, str]:
+    """
+    Open a temporary file to write a cache entry to, e.g. while streaming the blob.
+
+    Readers never see the file until it is passed to commit. A file that is not
+    committed must be passed to discard.
+
+    Args:
+        key (str): The cache key from cache_key.
+
+    Returns:
+        Tuple[BinaryIO, str]: The file opened for writing, and its path.
+    """
+    directory = os.path.dirname(_entry_path(key))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=_TEMP_PREFIX)
+    return os.fdopen(fd, "wb"), temp_path
+
+
+def commit(key: str, temp_path: str) -> str:
+    """
+    Move a written and closed temporary file into the cache as the entry for key.
+
+    Args:
+        key (str): The cache key from cache_key.
+        temp_path (str): The path returned by open_temp.
+
+    Returns:
+        str: The local path of the cached blob.
+    """
+    global _cache_size
+    path = _entry_path(key)
+    size = os.path.getsize(temp_path)
+    with _cache_lock:
+        # A replaced entry no longer counts towards the cache size
+        try:
+            replaced_size = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced_size = 0
+        os.replace(temp_path, path)
+        if _cache_size is None:
+            _cache_size = sum(size for _, size, _ in _list_entries())
+        else:
+            _cache_size += size - replaced_size
+        if _cache_size > CACHE_MAX_BYTES:
+            _cache_size = _evict(CACHE_MAX_BYTES, keep=path)
+    return path
+
+
+def discard(temp_path: str) -> None:
+    """Remove a temporary file from open_temp that will not be committed."""
+    try:
+        os.remove(temp_path)
+    except FileNotFoundError:
+        pass
+
+
+def _list_entries() -> List[Tuple[str, int, float]]:
+    entries: List[Tuple[str, int, float]] = []
+    if not os.path.isdir(CACHE_DIR):
+        return entries
+    for shard in os.scandir(CACHE_DIR):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.is_file() and not entry.name.startswith(_TEMP_PREFIX):
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def _evict(max_bytes: int, keep: str | None = None) -> int:
+    """Remove least recently used entries until the cache fits in max_bytes."""
+    entries = _list_entries()
+    total = sum(size for _, size, _ in entries)
+    for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def clear() -> None:
+    """Remove all cached blobs."""
+    global _cache_size
+    with _cache_lock:
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        _cache_size = 0
@@ -1,98 +1,171 @@
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 import json
+import math
+import multiprocessing
 import os
 from pathlib import Path
-from typing import Any, Dict, List, Callable
+import tempfile
+from typing import Any, BinaryIO, Dict, Iterable, List, Tuple
 from datetime import datetime, timezone
 
-from helpers import check_args_and_env_vars, update_state
-from storage import upload_file_to_bucket, download_file
-from google.cloud import storage
+from helpers import (
+    CHARS_PER_TOKEN,
+    blob_fingerprint,
+    check_args_and_env_vars,
+    select_pending,
+    update_state,
+)
+from corpus import CorpusWriter
+import filters
+from filters import RuleSet
+from json_stream import JsonStreamReader
+from storage import upload_many, download_many, iter_blobs, open_blob
+from storage_backends import BlobInfo
+
+# Files in download or upload per sectioning process, keeps the processes busy
+IO_THREADS_PER_WORKER: int = 2
+
+
+# The filter rules sections are built with
+RULES: RuleSet = filters.DEFAULT_RULES
+
+# Size in tokens that sections are merged up to and split down to, 0 keeps the
+# sections as the headings divide them
+SECTION_TARGET_TOKENS: int = int(os.getenv("SECTION_TARGET_TOKENS", "0"))
+# Sections smaller than this are merged with the next one while the result fits
+SECTION_MIN_TOKENS: int = int(
+    os.getenv("SECTION_MIN_TOKENS", str(SECTION_TARGET_TOKENS // 4))
+)
+
+# Kinds of blocks in a FlatLayout
+PARAGRAPH: int = 0
+HEADING: int = 1
+OTHER: int = 2
+
+
+class FlatLayout:
+    """
+    The blocks of a document layout in reading order, stored column-wise.
 
+    Blocks dropped by a BLOCK rule are left out together with their nested blocks.
 
-def ignore_lataaja(text: str) -> bool:
+    Attributes:
+        kinds (array): The kind of each block: PARAGRAPH, HEADING or OTHER.
+        levels (array): The heading level of each heading block, 0 for other blocks.
+        ignored (array): 1 + the index of the PARAGRAPH rule that drops the text of the
+            block, 0 if no rule does.
+        texts (List[str]): The stripped text of each block.
+        page_count (int): The largest pageEnd of any block, ignored blocks included.
     """
-    Rule to ignore paragraphs starting with 'Lataaja:'.
 
-    Args:
-        text (str): The text of the paragraph.
+    __slots__ = ("kinds", "levels", "ignored", "texts", "page_count")
 
-    Returns:
-        bool: True if the paragraph should be ignored, False otherwise.
-    """
-    return text.startswith("Lataaja:")
+    def __init__(self) -> None:
+        self.kinds = array("b")
+        self.levels = array("i")
+        self.ignored = array("b")
+        self.texts: List[str] = []
+        self.page_count = 1
 
 
-def ignore_header_footer(text_type: str, text: str) -> bool:
+class Section:
     """
-    Rule to ignore blocks of type 'header' or 'footer'.
+    A title and the paragraphs under it.
 
-    Args:
-        text_type (str): The type of the text block.
-        text (str): The text of the block.
-
-    Returns:
-        bool: True if the block should be ignored, False otherwise.
+    Sections merged or split to the token target list the 1-based indexes of the
+    sections the headings divided the document into in sources.
     """
-    return text_type in {"header", "footer"}
 
+    __slots__ = ("title", "content", "sources")
 
-PARAGRAPH_RULES: List[Callable[[str], bool]] = [
-    ignore_lataaja,
-]
+    def __init__(
+        self, title: str, content: List[str], sources: List[int] | None = None
+    ) -> None:
+        self.title = title
+        self.content = content
+        self.sources = sources
 
-BLOCK_RULES: List[Callable[[str, str], bool]] = [
-    ignore_header_footer,
-]
+    def to_dict(self) -> Dict[str, Any]:
+        if self.sources is None:
+            return {"title": self.title, "content": self.content}
+        return {"title": self.title, "content": self.content, "sources": self.sources}
 
 
-def process_blocks(
-    blocks: List[Dict[str, Any]],
-    sections: List[Dict[str, Any]],
-    previous_type: List[str],
-    active_heading_levels: List[int],
-) -> None:
-    for block in blocks:
+def flatten_layout(
+    blocks: List[Dict[str, Any]], flat: FlatLayout | None = None
+) -> FlatLayout:
+    """
+    Flattens nested layout blocks into a FlatLayout in a single iterative walk.
+
+    Args:
+        blocks (List[Dict[str, Any]]): The top-level blocks of the document.
+        flat (FlatLayout | None): A FlatLayout to append the blocks to.
+
+    Returns:
+        FlatLayout: The blocks in reading order.
+    """
+    flat = flat if flat is not None else FlatLayout()
+    # Blocks are pushed in reverse so that they are visited in reading order
+    stack: List[Dict[str, Any]] = blocks[::-1]
+    while stack:
+        block = stack.pop()
+        page_end = block.get("pageSpan", {}).get("pageEnd", 1)
+        if isinstance(page_end, int) and page_end > flat.page_count:
+            flat.page_count = page_end
+
         text_block = block.get("textBlock", {})
+        nested_blocks = text_block.get("blocks", [])
         text_type = text_block.get("type", "").lower()
         text = text_block.get("text", "").strip()
 
-        # Apply block-type rules
-        should_ignore_block = any(rule(text_type, text) for rule in BLOCK_RULES)
-        if should_ignore_block:
+        if RULES.drops(filters.BLOCK, text, text_type):
+            # Nested blocks are skipped but still count towards the page count
+            flat.page_count = max(flat.page_count, get_max_page_end(nested_blocks))
             continue
 
         if text_type.startswith("heading"):
-            heading_level = extract_heading_level(text_type)
-            if heading_level in active_heading_levels:
-                if sections and sections[-1]["title"]:
-                    sections.append({"title": text, "content": []})
-                else:
-                    sections.append({"title": text, "content": []})
-                previous_type.append(text_type)
-            else:
-                handle_paragraph(text, sections, previous_type)
-        elif text_type == "paragraph":
-            # Apply rules to the paragraph
-            should_ignore = any(rule(text) for rule in PARAGRAPH_RULES)
-            if not should_ignore:
-                if not sections:
-                    sections.append({"title": "", "content": [text]})
-                else:
-                    sections[-1]["content"].append(text)
-            previous_type.append(text_type)
+            flat.kinds.append(HEADING)
+            flat.levels.append(extract_heading_level(text_type))
         else:
-            if not sections:
-                sections.append({"title": "", "content": [text]})
-            else:
-                sections[-1]["content"].append(text)
-            previous_type.append(text_type)
+            flat.kinds.append(PARAGRAPH if text_type == "paragraph" else OTHER)
+            flat.levels.append(0)
+        flat.ignored.append(RULES.match(filters.PARAGRAPH, text) + 1)
+        flat.texts.append(text)
 
-        # Recursively process nested blocks
-        nested_blocks = text_block.get("blocks", [])
         if nested_blocks:
-            process_blocks(
-                nested_blocks, sections, previous_type, active_heading_levels
-            )
+            stack.extend(reversed(nested_blocks))
+    return flat
+
+
+def build_sections(flat: FlatLayout, max_active_level: int) -> List[Section]:
+    """
+    Splits the blocks into sections at headings of levels 1 to max_active_level.
+
+    Headings of other levels are handled as paragraphs. Content before the first
+    section heading goes into a section without a title.
+
+    Args:
+        flat (FlatLayout): The blocks of the document.
+        max_active_level (int): The deepest heading level that starts a section.
+
+    Returns:
+        List[Section]: The sections in reading order.
+    """
+    sections: List[Section] = []
+    for kind, level, ignored, text in zip(
+        flat.kinds, flat.levels, flat.ignored, flat.texts
+    ):
+        if kind == HEADING and 1 <= level <= max_active_level:
+            sections.append(Section(text, []))
+        elif kind == OTHER or not ignored:
+            if not sections:
+                sections.append(Section("", [text]))
+            else:
+                sections[-1].content.append(text)
+        else:
+            RULES.count(ignored - 1)
+    return sections
 
 
 def extract_heading_level(text_type: str) -> int:
@@ -111,53 +184,69 @@ def extract_heading_level(text_type: str) -> int:
         return 1  # Default to level 1 if extraction fails
 
 
-def handle_paragraph(
-    text: str, sections: List[Dict[str, Any]], previous_type: List[str]
-) -> None:
+def count_sections_per_level(flat: FlatLayout, max_heading_level: int) -> List[int]:
     """
-    Handles adding a paragraph to the sections.
+    Counts how many sections build_sections would produce for each heading level.
+
+    Splitting on heading levels 1 to level gives one section per heading of those
+    levels, plus one leading untitled section if any content comes before the first
+    of those headings. Both are collected in a single pass over the blocks.
 
     Args:
-        text (str): The paragraph text.
-        sections (List[Dict[str, Any]]): The list of sections.
-        previous_type (List[str]): The list of previous block types.
-    """
-    should_ignore = any(rule(text) for rule in PARAGRAPH_RULES)
-    if not should_ignore:
-        if not sections:
-            sections.append({"title": "", "content": [text]})
-        else:
-            sections[-1]["content"].append(text)
-    previous_type.append("paragraph")
+        flat (FlatLayout): The blocks of the document.
+        max_heading_level (int): The deepest heading level to count.
+
+    Returns:
+        List[int]: The section count of each level, index 0 being heading level 1.
+    """
+    headings_per_level = [0] * max_heading_level
+    # The lowest heading level seen so far, headings at or above it start sections
+    min_heading_level = math.inf
+    # Levels below this have content before their first section heading
+    leading_content_below = -math.inf
+
+    for kind, level, ignored in zip(flat.kinds, flat.levels, flat.ignored):
+        if kind == HEADING and 1 <= level <= max_heading_level:
+            # Below its own level a heading is handled as a paragraph
+            if not ignored:
+                leading_content_below = max(
+                    leading_content_below, min(level, min_heading_level)
+                )
+            min_heading_level = min(min_heading_level, level)
+            headings_per_level[level - 1] += 1
+        elif kind == OTHER or not ignored:
+            leading_content_below = max(leading_content_below, min_heading_level)
+
+    counts: List[int] = []
+    headings = 0
+    for level in range(1, max_heading_level + 1):
+        headings += headings_per_level[level - 1]
+        counts.append(headings + (1 if level < leading_content_below else 0))
+    return counts
 
 
-def determine_active_heading_levels(
-    blocks: List[Dict[str, Any]], page_count: int
-) -> List[int]:
+def determine_active_heading_levels(flat: FlatLayout, page_count: int) -> List[int]:
     """
     Determines which heading levels to use for splitting sections based on the number of pages.
 
     Args:
-        blocks (List[Dict[str, Any]]): The list of blocks in the document.
+        flat (FlatLayout): The blocks of the document.
         page_count (int): The number of pages in the document.
 
     Returns:
         List[int]: The active heading levels to use for splitting.
     """
     max_heading_level = 6  # Assuming heading levels 1 through 6
-    for level in range(1, max_heading_level + 1):
-        active_levels = list(range(1, level + 1))
-        sections = []
-        previous_type = []
-        process_blocks(blocks, sections, previous_type, active_levels)
-        if len(sections) >= page_count:
-            return active_levels
+    section_counts = count_sections_per_level(flat, max_heading_level)
+    for level, section_count in enumerate(section_counts, start=1):
+        if section_count >= page_count:
+            return list(range(1, level + 1))
     return list(range(1, max_heading_level + 1))
 
 
 def get_max_page_end(blocks: List[Dict[str, Any]]) -> int:
     """
-    Recursively finds the maximum pageEnd value in all blocks.
+    Finds the maximum pageEnd value in all blocks without recursion.
 
     Args:
         blocks (List[Dict[str, Any]]): The list of blocks.
@@ -166,114 +255,542 @@ def get_max_page_end(blocks: List[Dict[str, Any]]) -> int:
         int: The maximum pageEnd value.
     """
     max_page = 1
-    for block in blocks:
-        page_span = block.get("pageSpan", {})
-        page_end = page_span.get("pageEnd", 1)
+    stack = list(blocks)
+    while stack:
+        block = stack.pop()
+        page_end = block.get("pageSpan", {}).get("pageEnd", 1)
         if isinstance(page_end, int) and page_end > max_page:
             max_page = page_end
-
-        # Check nested blocks
-        text_block = block.get("textBlock", {})
-        nested_blocks = text_block.get("blocks", [])
-        if nested_blocks:
-            nested_max = get_max_page_end(nested_blocks)
-            if nested_max > max_page:
-                max_page = nested_max
+        stack.extend(block.get("textBlock", {}).get("blocks", []))
     return max_page
 
 
-def convert_json_to_json_array(
-    input_file_gcs: str,
-    output_file_json_gcs: str,
-    output_file_txt_gcs: str,
-    bucket_name: str,
-) -> None:
-    """Converts a JSON file in GCS to a JSON array and a TXT file, then uploads them to specified directories."""
-    data = download_file(bucket_name, input_file_gcs)
-    if data is None:
-        raise ValueError(
-            f"Failed to download {input_file_gcs} from bucket {bucket_name}"
-        )
+def flatten_layout_stream(
+    stream: BinaryIO, flat: FlatLayout | None = None
+) -> FlatLayout:
+    """
+    Flattens the blocks of a Document AI layout JSON while reading it from a stream.
 
-    data = json.loads(data)
+    Blocks that fit in the read window are decoded whole and flattened with
+    flatten_layout. Larger blocks are walked field by field, decoding only the fields
+    flatten_layout uses and skipping the rest as it streams past, so memory stays flat
+    regardless of the size of the document.
 
-    document_layout = data.get("documentLayout", {})
-    blocks = document_layout.get("blocks", [])
-    # Calculate page_count as the maximum pageEnd value across all blocks
-    page_count = get_max_page_end(blocks)
+    Args:
+        stream (BinaryIO): The layout JSON.
+        flat (FlatLayout | None): A FlatLayout to append to, e.g. from an earlier shard of
+            the same document.
+
+    Returns:
+        FlatLayout: The blocks in reading order.
+    """
+    flat = flat if flat is not None else FlatLayout()
+    reader = JsonStreamReader(stream)
+
+    reader.expect("{")
+    while reader.next_item("}"):
+        if reader.read_key() != "documentLayout":
+            reader.skip_value()
+            continue
+        reader.expect("{")
+        while reader.next_item("}"):
+            if reader.read_key() != "blocks":
+                reader.skip_value()
+                continue
+            reader.expect("[")
+            _flatten_block_array(reader, flat)
+    return flat
+
+
+def _flatten_block_array(reader: JsonStreamReader, flat: FlatLayout) -> None:
+    """Flattens a streamed array of blocks whose opening bracket has been consumed."""
+    # Each open block keeps its entry index and its type and text until it closes,
+    # as nested blocks may in principle come before them
+    blocks: List[List[Any]] = []
+    # The containers being read: "blocks" arrays, "block" and "textBlock" objects
+    containers: List[str] = ["blocks"]
+    while containers:
+        container = containers[-1]
+        if container == "blocks":
+            if not reader.next_item("]"):
+                containers.pop()
+                continue
+            decoded, block = reader.try_read_value()
+            if decoded:
+                flatten_layout([block], flat)
+                continue
+            reader.expect("{")
+            # Reserve the entry of the block so it precedes its nested blocks
+            blocks.append([len(flat.kinds), "", ""])
+            flat.kinds.append(OTHER)
+            flat.levels.append(0)
+            flat.ignored.append(0)
+            flat.texts.append("")
+            containers.append("block")
+        elif container == "block":
+            if not reader.next_item("}"):
+                containers.pop()
+                _close_block(flat, *blocks.pop())
+                continue
+            key = reader.read_key()
+            if key == "textBlock" and reader.peek() == "{":
+                reader.expect("{")
+                containers.append("textBlock")
+            elif key == "pageSpan":
+                page_span = reader.read_value()
+                page_end = (
+                    page_span.get("pageEnd", 1) if isinstance(page_span, dict) else 1
+                )
+                if isinstance(page_end, int) and page_end > flat.page_count:
+                    flat.page_count = page_end
+            else:
+                reader.skip_value()
+        else:
+            if not reader.next_item("}"):
+                containers.pop()
+                continue
+            key = reader.read_key()
+            if key == "type":
+                blocks[-1][1] = reader.read_value()
+            elif key == "text":
+                blocks[-1][2] = reader.read_value()
+            elif key == "blocks" and reader.peek() == "[":
+                reader.expect("[")
+                containers.append("blocks")
+            else:
+                reader.skip_value()
+
+
+def _close_block(flat: FlatLayout, index: int, text_type: str, text: str) -> None:
+    """Fills in the reserved entry of a streamed block, or drops it if it is ignored."""
+    text_type = text_type.lower()
+    text = text.strip()
+    if RULES.drops(filters.BLOCK, text, text_type):
+        # Drop the block together with its nested blocks
+        del flat.kinds[index:]
+        del flat.levels[index:]
+        del flat.ignored[index:]
+        del flat.texts[index:]
+        return
+    if text_type.startswith("heading"):
+        flat.kinds[index] = HEADING
+        flat.levels[index] = extract_heading_level(text_type)
+    else:
+        flat.kinds[index] = PARAGRAPH if text_type == "paragraph" else OTHER
+    flat.ignored[index] = RULES.match(filters.PARAGRAPH, text) + 1
+    flat.texts[index] = text
 
-    active_heading_levels = determine_active_heading_levels(blocks, page_count)
 
-    sections: List[Dict[str, Any]] = []
-    previous_type: List[str] = []
-    process_blocks(blocks, sections, previous_type, active_heading_levels)
+def sections_from_flat(flat: FlatLayout) -> Tuple[List[Section], int]:
+    """
+    Split flattened layout blocks into sections of a title and its paragraphs.
 
-    # Remove all sections that have no contents
-    cleaned_sections = [
-        section for section in sections if section["title"] or section["content"]
-    ]
+    Args:
+        flat (FlatLayout): The blocks of the document.
 
-    # Remove all sections where title + all contents combined length is below 30 characters
+    Returns:
+        Tuple[List[Section], int]: The sections and the page count of the document.
+    """
+    # The page count is the maximum pageEnd value across all blocks
+    page_count = flat.page_count
+
+    active_heading_levels = determine_active_heading_levels(flat, page_count)
+    sections = build_sections(flat, max(active_heading_levels))
+
+    # Remove all sections that have no contents, and all sections a SECTION rule drops,
+    # e.g. where title + all contents combined length is below 30 characters
     filtered_sections = [
         section
-        for section in cleaned_sections
-        if len(section["title"] + "".join(section["content"])) >= 30
+        for section in sections
+        if (section.title or section.content)
+        and not RULES.drops(filters.SECTION, section.title + "".join(section.content))
     ]
+    if SECTION_TARGET_TOKENS > 0:
+        filtered_sections = fit_sections_to_budget(
+            filtered_sections, SECTION_TARGET_TOKENS, SECTION_MIN_TOKENS
+        )
+    return filtered_sections, page_count
+
+
+def estimate_tokens(section: Section) -> int:
+    """Estimate the tokens of a section as its title and content appear in a prompt."""
+    chars = len(section.title) + sum(
+        len(paragraph) + 1 for paragraph in section.content
+    )
+    return math.ceil(chars / CHARS_PER_TOKEN)
+
+
+def split_text(text: str, max_chars: int) -> List[str]:
+    """
+    Split text into pieces of at most max_chars, at sentence ends where possible.
+
+    Args:
+        text (str): The text to split.
+        max_chars (int): The maximum length of a piece.
+
+    Returns:
+        List[str]: The pieces in order.
+    """
+    pieces: List[str] = []
+    while len(text) > max_chars:
+        cut = text.rfind(". ", 0, max_chars) + 1
+        if cut <= 0:
+            cut = text.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        pieces.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def split_section(section: Section, target_tokens: int) -> List[Section]:
+    """
+    Split a section into parts of about target_tokens at paragraph boundaries.
+
+    Each part keeps the title. Paragraphs longer than a part are split at sentence ends.
+
+    Args:
+        section (Section): The section to split.
+        target_tokens (int): The size a part may grow to.
+
+    Returns:
+        List[Section]: The parts, each with the sources of the section.
+    """
+    # Leave room for the title repeated in every part, but always some for content
+    max_chars = max(
+        target_tokens * CHARS_PER_TOKEN - len(section.title), CHARS_PER_TOKEN * 16
+    )
+    parts: List[List[str]] = [[]]
+    part_chars = 0
+    for paragraph in section.content:
+        for piece in split_text(paragraph, max_chars):
+            if parts[-1] and part_chars + len(piece) + 1 > max_chars:
+                parts.append([])
+                part_chars = 0
+            parts[-1].append(piece)
+            part_chars += len(piece) + 1
+    return [Section(section.title, part, list(section.sources or [])) for part in parts]
+
+
+def fit_sections_to_budget(
+    sections: List[Section], target_tokens: int, min_tokens: int
+) -> List[Section]:
+    """
+    Merge adjacent tiny sections and split oversized ones to about target_tokens.
+
+    Every section costs a prompt of its own, so fragments are merged into the
+    following sections, while sections too long for a complete answer are split.
+    The titles of merged sections are kept as paragraphs of the merged section.
+
+    Args:
+        sections (List[Section]): The sections the headings divide the document into.
+        target_tokens (int): The size sections are merged up to and split down to.
+        min_tokens (int): Sections smaller than this are merged with the next one.
 
+    Returns:
+        List[Section]: The new sections, with the 1-based indexes of the sections
+            each was made of in sources.
+    """
+    fitted: List[Section] = []
+    for index, section in enumerate(sections, start=1):
+        tokens = estimate_tokens(section)
+        if tokens > target_tokens:
+            section.sources = [index]
+            fitted.extend(split_section(section, target_tokens))
+            continue
+        previous = fitted[-1] if fitted else None
+        if (
+            previous is not None
+            and estimate_tokens(previous) < min_tokens
+            and estimate_tokens(previous) + tokens <= target_tokens
+        ):
+            if section.title:
+                previous.content.append(section.title)
+            previous.content.extend(section.content)
+            previous.sources.append(index)
+            continue
+        fitted.append(Section(section.title, list(section.content), [index]))
+
+    # A tiny last section goes into the one before it
+    if len(fitted) > 1:
+        last, previous = fitted[-1], fitted[-2]
+        last_tokens = estimate_tokens(last)
+        if (
+            last_tokens < min_tokens
+            and estimate_tokens(previous) + last_tokens <= target_tokens
+            and previous.sources[-1] != last.sources[0]
+        ):
+            if last.title:
+                previous.content.append(last.title)
+            previous.content.extend(last.content)
+            previous.sources.extend(last.sources)
+            fitted.pop()
+    return fitted
+
+
+def sections_from_layout(data: Dict[str, Any]) -> Tuple[List[Section], int]:
+    """
+    Split a Document AI layout into sections of a title and its paragraphs.
+
+    Args:
+        data (Dict[str, Any]): The Document AI document with a documentLayout.
+
+    Returns:
+        Tuple[List[Section], int]: The sections and the page count of the document.
+    """
+    document_layout = data.get("documentLayout", {})
+    return sections_from_flat(flatten_layout(document_layout.get("blocks", [])))
+
+
+def render_sections(sections: List[Section]) -> Tuple[str, str]:
+    """Render sections as a JSON array and as plain text."""
     # Serialize JSON content
-    json_content = json.dumps(filtered_sections, indent=4)
-    upload_file_to_bucket(bucket_name, output_file_json_gcs, file_contents=json_content)
-    print(f"Uploaded JSON sections to gs://{bucket_name}/{output_file_json_gcs}")
+    json_content = json.dumps([section.to_dict() for section in sections], indent=4)
 
     # Prepare text content
     lines: List[str] = []
-    for section in filtered_sections:
-        if section["title"]:
-            lines.append(f"{section['title']}\n")
-        for paragraph in section["content"]:
+    for section in sections:
+        if section.title:
+            lines.append(f"{section.title}\n")
+        for paragraph in section.content:
             lines.append(f"{paragraph}\n")
         lines.append("\n\n")  # Separator between sections
 
     final_text = "".join(lines).strip()
+    return json_content, final_text
+
+
+def section_layout_streams(streams: Iterable[BinaryIO]) -> Tuple[str, str, int]:
+    """
+    Split the streamed layout JSON shards of a document into sections and render them.
+
+    Args:
+        streams (Iterable[BinaryIO]): The layout JSON shards of the document in shard
+            order, each is closed after it has been read.
+
+    Returns:
+        Tuple[str, str, int]: The JSON and TXT sections and the page count of the document.
+    """
+    flat = FlatLayout()
+    for stream in streams:
+        with stream:
+            flatten_layout_stream(stream, flat)
+    sections, page_count = sections_from_flat(flat)
+    json_content, final_text = render_sections(sections)
+    return json_content, final_text, page_count
+
+
+def section_layout_files(
+    file_paths: List[str],
+) -> Tuple[str, str, int, Dict[str, int]]:
+    """
+    Split the layout JSON shards of a document in local files into sections.
+
+    This is the CPU-bound part of the stage and runs in a worker process with --workers.
+
+    Args:
+        file_paths (List[str]): The local layout JSON shards of the document in shard order.
+
+    Returns:
+        Tuple[str, str, int, Dict[str, int]]: The JSON and TXT sections, the page count of
+            the document and the filter rule hits while sectioning it.
+    """
+    hits_before = RULES.hits.copy()
+    json_content, final_text, page_count = section_layout_streams(
+        open(path, "rb") for path in file_paths
+    )
+    return json_content, final_text, page_count, dict(RULES.hits - hits_before)
+
 
-    # Upload TXT content
-    upload_file_to_bucket(bucket_name, output_file_txt_gcs, file_contents=final_text)
+def upload_sections(
+    json_content: str,
+    final_text: str,
+    output_file_json_gcs: str,
+    output_file_txt_gcs: str,
+    bucket_name: str,
+) -> None:
+    """Upload the rendered JSON and TXT sections."""
+    upload_many(
+        bucket_name,
+        [
+            {
+                "destination_blob_name": output_file_json_gcs,
+                "file_contents": json_content,
+            },
+            {"destination_blob_name": output_file_txt_gcs, "file_contents": final_text},
+        ],
+    )
+    print(f"Uploaded JSON sections to gs://{bucket_name}/{output_file_json_gcs}")
     print(f"Uploaded TXT sections to gs://{bucket_name}/{output_file_txt_gcs}")
 
+
+def convert_layout_to_sections(
+    layout_files_gcs: List[str],
+    output_file_json_gcs: str,
+    output_file_txt_gcs: str,
+    bucket_name: str,
+    section_pool: Executor | None = None,
+    corpus: CorpusWriter | None = None,
+) -> int:
+    """
+    Download the layout shards of a document, split it into sections and upload them.
+
+    Args:
+        layout_files_gcs (List[str]): The layout JSON blobs of the document in shard order.
+        output_file_json_gcs (str): The blob to write the JSON sections to.
+        output_file_txt_gcs (str): The blob to write the TXT sections to.
+        bucket_name (str): The name of the GCS bucket.
+        section_pool (Executor | None): Process pool to section in, or None to section
+            in the calling thread.
+        corpus (CorpusWriter | None): A corpus to also add the sections to.
+
+    Returns:
+        int: The page count of the document.
+    """
+    if section_pool is None:
+        # Stream the shards straight from storage
+        json_content, final_text, page_count = section_layout_streams(
+            open_blob(bucket_name, name) for name in layout_files_gcs
+        )
+    else:
+        # Spool the shards to local files for the worker process to stream from
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_paths = [
+                os.path.join(temp_dir, f"{index}.json")
+                for index in range(len(layout_files_gcs))
+            ]
+            download_many(bucket_name, layout_files_gcs, file_paths)
+            json_content, final_text, page_count, hits = section_pool.submit(
+                section_layout_files, file_paths
+            ).result()
+            RULES.add_hits(hits)
+    upload_sections(
+        json_content, final_text, output_file_json_gcs, output_file_txt_gcs, bucket_name
+    )
+    if corpus is not None:
+        corpus.add_card(
+            Path(output_file_json_gcs).stem, output_file_json_gcs, json_content
+        )
+    return page_count
+
+
+def convert_json_to_json_array(
+    input_file_gcs: str,
+    output_file_json_gcs: str,
+    output_file_txt_gcs: str,
+    bucket_name: str,
+    input_fingerprint: str | None = None,
+    section_pool: Executor | None = None,
+    corpus: CorpusWriter | None = None,
+) -> None:
+    """Converts a JSON file in GCS to a JSON array and a TXT file, then uploads them to specified directories."""
+    page_count = convert_layout_to_sections(
+        [input_file_gcs],
+        output_file_json_gcs,
+        output_file_txt_gcs,
+        bucket_name,
+        section_pool=section_pool,
+        corpus=corpus,
+    )
+
     # Update state with sectionsCreatedAt timestamp
     current_time = datetime.now(timezone.utc).isoformat()
     file_name = Path(input_file_gcs).stem
-    update_state(file_name, {"sectionsCreatedAt": current_time})
+    state: Dict[str, Any] = {"sectionsCreatedAt": current_time, "pageCount": page_count}
+    if input_fingerprint:
+        state["chunksFingerprint"] = input_fingerprint
+    update_state(file_name, state)
 
 
-def list_json_files(bucket_name: str, prefix: str) -> List[str]:
+def list_json_files(bucket_name: str, prefix: str) -> List[BlobInfo]:
     """List all JSON files in the specified GCS bucket and prefix."""
-    storage_client = storage.Client()
-    blobs = storage_client.list_blobs(bucket_name, prefix=prefix)
-    json_files = [blob.name for blob in blobs if blob.name.lower().endswith(".json")]
-    return json_files
+    return list(iter_blobs(bucket_name, prefix, suffix=".json", ignore_case=True))
 
 
 def process_all_files(
-    bucket_name: str, input_dir: str, output_dir_json: str, output_dir_txt: str
+    bucket_name: str,
+    input_dir: str,
+    output_dir_json: str,
+    output_dir_txt: str,
+    force: bool = False,
+    workers: int = 1,
+    corpus: CorpusWriter | None = None,
 ) -> None:
+    """
+    Convert the pending layout JSON files to sections.
+
+    Args:
+        bucket_name (str): The name of the GCS bucket.
+        input_dir (str): The directory of the layout JSON files.
+        output_dir_json (str): The directory to write the JSON sections to.
+        output_dir_txt (str): The directory to write the TXT sections to.
+        force (bool): Convert all files, not only new, changed or failed ones.
+        workers (int): Number of processes to section in, 1 sections serially.
+        corpus (CorpusWriter | None): A corpus to also add the sections to.
+    """
     json_files = list_json_files(bucket_name, input_dir)
     if not json_files:
         print(f"No JSON files found in gs://{bucket_name}/{input_dir}")
         return
 
-    for input_file_gcs in json_files:
+    pending_files = select_pending(
+        json_files,
+        done_key="sectionsCreatedAt",
+        fingerprint_key="chunksFingerprint",
+        failed_key="sectionsFailedAt",
+        force=force,
+    )
+
+    def process_file(blob: BlobInfo, section_pool: Executor | None = None) -> None:
+        input_file_gcs = blob.name
         file_stem = Path(input_file_gcs).stem
         output_file_json_gcs = f"{output_dir_json}/{file_stem}.json"
         output_file_txt_gcs = f"{output_dir_txt}/{file_stem}.txt"
 
-        convert_json_to_json_array(
-            input_file_gcs, output_file_json_gcs, output_file_txt_gcs, bucket_name
-        )
+        try:
+            convert_json_to_json_array(
+                input_file_gcs,
+                output_file_json_gcs,
+                output_file_txt_gcs,
+                bucket_name,
+                input_fingerprint=blob_fingerprint(blob),
+                section_pool=section_pool,
+                corpus=corpus,
+            )
+        except Exception as e:
+            print(f"Failed to convert gs://{bucket_name}/{input_file_gcs}: {e}")
+            fail_time = datetime.now(timezone.utc).isoformat()
+            update_state(file_stem, {"sectionsFailedAt": fail_time})
+            return
         print(
             f"Converted gs://{bucket_name}/{input_file_gcs} to gs://{bucket_name}/{output_file_json_gcs} and gs://{bucket_name}/{output_file_txt_gcs}"
         )
 
+    if workers <= 1:
+        for blob in pending_files:
+            process_file(blob)
+    else:
+        # Each I/O thread carries one file through download, sectioning in the process
+        # pool and upload, so the threads bound the files held in memory at once.
+        # Workers are spawned rather than forked, since they start on the first
+        # submit while I/O threads may hold the locks of the storage client and the
+        # state store.
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as section_pool:
+            with ThreadPoolExecutor(
+                max_workers=workers * IO_THREADS_PER_WORKER
+            ) as io_pool:
+                list(
+                    io_pool.map(
+                        lambda blob: process_file(blob, section_pool), pending_files
+                    )
+                )
+
+    print(f"Filter rule hits: {RULES.report()}")
+
 
 def main() -> None:
     """Main function to process JSON files from GCS bucket and convert them to sections."""
@@ -284,15 +801,30 @@ def main() -> None:
             "CHUNKS_DIR",
             "SECTIONS_JSON_DIR",
             "SECTIONS_TXT_DIR",
-        ]
+        ],
+        optional_args=["--workers"],
+        flag_args=["--force", "--corpus"],
     )
 
     BUCKET_NAME = config["BUCKET_NAME"]
     INPUT_DIR = config["CHUNKS_DIR"]
     OUTPUT_DIR_JSON = config["SECTIONS_JSON_DIR"]
     OUTPUT_DIR_TXT = config["SECTIONS_TXT_DIR"]
-
-    process_all_files(BUCKET_NAME, INPUT_DIR, OUTPUT_DIR_JSON, OUTPUT_DIR_TXT)
+    WORKERS = int(config.get("WORKERS", 1))
+    # With --corpus the sections of this run are also written to one corpus file
+    corpus = CorpusWriter() if config["CORPUS"] else None
+
+    process_all_files(
+        BUCKET_NAME,
+        INPUT_DIR,
+        OUTPUT_DIR_JSON,
+        OUTPUT_DIR_TXT,
+        force=config["FORCE"],
+        workers=WORKERS,
+        corpus=corpus,
+    )
+    if corpus is not None:
+        corpus.close(BUCKET_NAME)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,191 @@
+import json
+import mmap
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+
+import dotenv
+
+from storage import download_many, upload_many
+from storage_backends import BlobInfo, crc32c_base64
+
+dotenv.load_dotenv()
+
+# Directory of the corpus files, in the bucket and locally
+CORPUS_DIR: str = os.getenv("CORPUS_DIR", "corpus")
+
+
+def corpus_paths(name: str) -> Tuple[str, str]:
+    """Return the paths of the sections file and the index file of a corpus."""
+    return f"{CORPUS_DIR}/{name}.jsonl", f"{CORPUS_DIR}/{name}.index.json"
+
+
+def parse_custom_id(custom_id: str) -> Tuple[str, int]:
+    """
+    Split a batch request custom_id into its card id and section index.
+
+    Args:
+        custom_id (str): E.g. "card.json-Section-3".
+
+    Returns:
+        Tuple[str, int]: The card id, e.g. "card", and the 1-based section index.
+    """
+    filename, section_index = custom_id.rsplit("-Section-", 1)
+    return os.path.splitext(filename)[0], int(section_index)
+
+
+class CorpusWriter:
+    """
+    Writes the sections of many cards into one JSONL file with an offset index.
+
+    Each line holds one section with its card id and 1-based section index. The index
+    maps each card id to the sections blob it was written to, that blob's CRC32C, and
+    the byte offset and length of each of its sections in the JSONL file.
+    """
+
+    def __init__(self, name: str | None = None) -> None:
+        self.name = (
+            name or f"sections_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}"
+        )
+        self.path, self.index_path = corpus_paths(self.name)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "wb")
+        self._cards: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add_card(
+        self, card_id: str, sections_blob_name: str, json_content: str
+    ) -> None:
+        """
+        Append the sections of a card.
+
+        Args:
+            card_id (str): The id of the card, the stem of its sections blob.
+            sections_blob_name (str): The name of the card's sections JSON blob.
+            json_content (str): The sections JSON uploaded to that blob.
+        """
+        lines = [
+            (
+                json.dumps(
+                    {"card": card_id, "section": index, **section},
+                    ensure_ascii=False,
+                )
+                + "\n"
+            ).encode("utf-8")
+            for index, section in enumerate(json.loads(json_content), start=1)
+        ]
+        data = json_content.encode("utf-8")
+        with self._lock:
+            offsets: List[List[int]] = []
+            for line in lines:
+                offsets.append([self._file.tell(), len(line)])
+                self._file.write(line)
+            self._cards[card_id] = {
+                "blob": sections_blob_name,
+                # The size and checksum the uploaded sections blob has in the bucket
+                "size": len(data),
+                "crc32c": crc32c_base64(data),
+                "sections": offsets,
+            }
+
+    def close(self, bucket_name: str) -> None:
+        """Write the index and upload both files of the corpus."""
+        self._file.close()
+        with open(self.index_path, "w", encoding="utf-8") as f:
+            json.dump({"cards": self._cards}, f)
+        upload_many(
+            bucket_name,
+            [
+                {"destination_blob_name": self.path, "source_file_path": self.path},
+                {
+                    "destination_blob_name": self.index_path,
+                    "source_file_path": self.index_path,
+                },
+            ],
+        )
+        print(
+            f"Wrote {len(self._cards)} cards to corpus {self.name} in gs://{bucket_name}/{CORPUS_DIR}"
+        )
+
+
+class Corpus:
+    """
+    Random access to the sections in a corpus written by CorpusWriter.
+
+    The JSONL file is memory-mapped, so only the sections that are read are loaded.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        path, index_path = corpus_paths(name)
+        with open(index_path, "r", encoding="utf-8") as f:
+            self.cards: Dict[str, Dict[str, Any]] = json.load(f)["cards"]
+        self._file = open(path, "rb")
+        # An empty file cannot be mapped
+        self._map = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.path.getsize(path)
+            else b""
+        )
+
+    @classmethod
+    def download(cls, bucket_name: str, name: str) -> "Corpus":
+        """Download a corpus from the bucket and open it."""
+        paths = list(corpus_paths(name))
+        os.makedirs(CORPUS_DIR, exist_ok=True)
+        download_many(bucket_name, paths, paths)
+        return cls(name)
+
+    def card_ids(self) -> List[str]:
+        """Return the ids of the cards in the corpus."""
+        return list(self.cards)
+
+    def blob_infos(self) -> List[BlobInfo]:
+        """Return the sections blobs the cards were written to, with their fingerprints."""
+        return [
+            BlobInfo(
+                name=card["blob"],
+                size=card["size"],
+                crc32c=card["crc32c"],
+            )
+            for card in self.cards.values()
+        ]
+
+    def section(self, card_id: str, section_index: int) -> Dict[str, Any]:
+        """
+        Read one section of a card.
+
+        Args:
+            card_id (str): The id of the card.
+            section_index (int): The 1-based index of the section.
+
+        Returns:
+            Dict[str, Any]: The section with its title, content and sources if any.
+        """
+        if section_index < 1:
+            raise IndexError(f"Section indexes start at 1, got {section_index}")
+        offset, length = self.cards[card_id]["sections"][section_index - 1]
+        record = json.loads(self._map[offset : offset + length])
+        del record["card"], record["section"]
+        return record
+
+    def sections(self, card_id: str) -> List[Dict[str, Any]]:
+        """Read all sections of a card in order."""
+        return [
+            self.section(card_id, index)
+            for index in range(1, len(self.cards[card_id]["sections"]) + 1)
+        ]
+
+    def __getitem__(self, custom_id: str) -> Dict[str, Any]:
+        """Read the section a batch request custom_id refers to."""
+        card_id, section_index = parse_custom_id(custom_id)
+        try:
+            return self.section(card_id, section_index)
+        except (KeyError, IndexError):
+            raise KeyError(custom_id)
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
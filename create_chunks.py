@@ -1,17 +1,56 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import lru_cache
+import heapq
+import math
+import os
 import re
-from typing import List, Optional
+import time
+from typing import Any, Callable, Dict, List, Optional
 
 from google.api_core.client_options import ClientOptions
-from google.api_core.exceptions import InternalServerError, RetryError
-from google.cloud import storage, documentai_v1beta3 as documentai
-from helpers import check_args_and_env_vars, update_state
-from google.cloud.documentai_toolbox import gcs_utilities
-from dataclasses import dataclass
+from google.api_core.exceptions import GoogleAPICallError, RetryError
+from google.api_core.operation import Operation
+from google.cloud import documentai_v1beta3 as documentai
+from helpers import (
+    blob_fingerprint,
+    check_args_and_env_vars,
+    content_hash,
+    load_state,
+    select_pending,
+    state_key,
+    update_states,
+)
+from dataclasses import dataclass, field
 
-from storage import copy_batch_to_dir
+from chunks_to_sections import RULES as SECTION_RULES, convert_layout_to_sections
+from corpus import CorpusWriter
+from state_store import get_cached_layouts, put_cached_layouts
+from storage import (
+    MAX_WORKERS,
+    blob_exists,
+    copy_batch_to_dir,
+    copy_file,
+    iter_blobs,
+    parse_gcs_uri,
+)
+from storage_backends import BlobInfo
 
-BATCH_SIZE: int = 20
+# Batch limits, batches are packed to roughly the same number of pages within these
+MAX_BATCH_DOCUMENTS: int = 50
+MAX_BATCH_BYTES: int = 500 * 1024 * 1024
+TARGET_BATCH_PAGES: int = int(os.getenv("DOCUMENT_AI_TARGET_BATCH_PAGES", "1000"))
+# Used to estimate the page count of PDFs that have not been processed before
+ESTIMATED_BYTES_PER_PAGE: int = 100 * 1024
+# Document AI allows 5 concurrent batch requests per processor by default
+MAX_CONCURRENT_OPERATIONS: int = int(os.getenv("DOCUMENT_AI_MAX_OPERATIONS", "5"))
+POLL_INTERVAL: int = 15
+OPERATION_TIMEOUT: int = 3600
+# Failed documents are resubmitted until they have been tried this many times
+MAX_ATTEMPTS: int = 3
+RETRY_BASE_DELAY: int = 60
+# Document AI names output shards <input stem>-<shard index>.json
+SHARD_PATTERN: re.Pattern[str] = re.compile(r"^(?P<stem>.+)-(?P<shard>\d+)\.json$")
 
 
 @dataclass
@@ -23,26 +62,224 @@ class Config:
     PDF_DIR: str
 
 
-def get_pdf_files_from_bucket(bucket_name: str, source_dir: str) -> List[str]:
-    """Retrieve all PDF file names from the specified GCS bucket and source directory."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=source_dir)
-    pdf_files = [blob.name for blob in blobs if blob.name.lower().endswith(".pdf")]
-    return pdf_files
+@dataclass
+class BatchJob:
+    document_uris: List[str]
+    output_uri: str
+    operation: Operation | None = None
+    submitted_at: float = field(default=0.0)
+    attempt: int = 1
+    # Monotonic time before which the job must not be submitted, used for retry backoff
+    not_before: float = 0.0
+
+
+@dataclass
+class DocumentResult:
+    uri: str
+    succeeded: bool
+    error: str = ""
+    output_uri: str = ""
+
+
+def get_pdf_files_from_bucket(bucket_name: str, source_dir: str) -> List[BlobInfo]:
+    """Retrieve all PDF files from the specified GCS bucket and source directory."""
+    return list(iter_blobs(bucket_name, source_dir, suffix=".pdf", ignore_case=True))
+
+
+def estimate_page_count(blob: BlobInfo, file_state: Dict[str, Any]) -> int:
+    """Return the page count recorded for a PDF by an earlier run, or estimate it from its size."""
+    page_count = file_state.get("pageCount")
+    if isinstance(page_count, int) and page_count > 0:
+        return page_count
+    return max(1, math.ceil(blob.size / ESTIMATED_BYTES_PER_PAGE))
+
+
+def plan_batches(
+    blobs: List[BlobInfo],
+    page_counts: Dict[str, int],
+    min_batches: int = 1,
+    target_pages: int = TARGET_BATCH_PAGES,
+    max_documents: int = MAX_BATCH_DOCUMENTS,
+    max_bytes: int = MAX_BATCH_BYTES,
+) -> List[List[BlobInfo]]:
+    """
+    Pack PDFs into batches of roughly equal page count within the batch limits.
+
+    The number of batches is derived from the page, document and byte budgets, and
+    documents are assigned largest first to the batch with the fewest pages so far, so
+    that the batches take about as long to process.
+
+    Args:
+        blobs (List[BlobInfo]): The PDFs to process.
+        page_counts (Dict[str, int]): Known or estimated page count of each PDF by blob name.
+        min_batches (int): The minimum number of batches, e.g. the number of concurrent operations.
+        target_pages (int): The page budget of a batch.
+        max_documents (int): The maximum number of documents in a batch.
+        max_bytes (int): The maximum total size of a batch.
+
+    Returns:
+        List[List[BlobInfo]]: The batches, largest first.
+    """
+    if not blobs:
+        return []
+
+    total_pages = sum(page_counts[blob.name] for blob in blobs)
+    total_bytes = sum(blob.size for blob in blobs)
+    batch_count = min(
+        len(blobs),
+        max(
+            min_batches,
+            math.ceil(total_pages / target_pages),
+            math.ceil(len(blobs) / max_documents),
+            math.ceil(total_bytes / max_bytes),
+        ),
+    )
+
+    # Heap of (pages, bytes, index) so the lightest batch is always on top
+    loads = [(0, 0, index) for index in range(batch_count)]
+    batches: List[List[BlobInfo]] = [[] for _ in range(batch_count)]
+    for blob in sorted(blobs, key=lambda blob: page_counts[blob.name], reverse=True):
+        skipped = []
+        while loads:
+            pages, size, index = heapq.heappop(loads)
+            batch = batches[index]
+            if batch and (len(batch) >= max_documents or size + blob.size > max_bytes):
+                skipped.append((pages, size, index))
+                continue
+            batch.append(blob)
+            heapq.heappush(
+                loads, (pages + page_counts[blob.name], size + blob.size, index)
+            )
+            break
+        else:
+            # Every batch is full, open a new one
+            batches.append([blob])
+            skipped.append((page_counts[blob.name], blob.size, len(batches) - 1))
+        for load in skipped:
+            heapq.heappush(loads, load)
+
+    batches = [batch for batch in batches if batch]
+    batches.sort(
+        key=lambda batch: sum(page_counts[blob.name] for blob in batch), reverse=True
+    )
+    return batches
+
+
+@lru_cache(maxsize=None)
+def get_documentai_client(location: str) -> documentai.DocumentProcessorServiceClient:
+    """Return a shared Document AI client for the given location."""
+    opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+    return documentai.DocumentProcessorServiceClient(client_options=opts)
 
 
-def batch_process_documents(
+@lru_cache(maxsize=None)
+def get_processor_version(location: str, processor_full_name: str) -> str:
+    """
+    Return the full name of the processor version that processes documents.
+
+    Args:
+        location (str): The location of the processor.
+        processor_full_name (str): The processor or processor version name.
+
+    Returns:
+        str: The processor version name, or the processor name if it cannot be resolved.
+    """
+    if "/processorVersions/" in processor_full_name:
+        return processor_full_name
+    try:
+        processor = get_documentai_client(location).get_processor(
+            name=processor_full_name
+        )
+    except GoogleAPICallError as e:
+        print(f"Could not resolve the processor version of {processor_full_name}: {e}")
+        return processor_full_name
+    return processor.default_processor_version or processor_full_name
+
+
+def layout_blob_name(output_dir: str, blob: BlobInfo) -> str:
+    """Return the name of the layout JSON that copy_batch_to_dir writes for a PDF."""
+    return f"{output_dir.rstrip('/')}/{os.path.splitext(os.path.basename(blob.name))[0]}.json"
+
+
+def find_layout_shards(bucket_name: str, output_uri: str, blob: BlobInfo) -> List[str]:
+    """
+    Find the layout JSON shards Document AI wrote for a PDF.
+
+    Args:
+        bucket_name (str): The name of the GCS bucket.
+        output_uri (str): The GCS URI of the document's or the batch's output directory.
+        blob (BlobInfo): The PDF.
+
+    Returns:
+        List[str]: The names of the shards in shard order.
+    """
+    _, prefix = parse_gcs_uri(output_uri)
+    stem = os.path.splitext(os.path.basename(blob.name))[0]
+    shards: List[tuple[int, str]] = []
+    for shard in iter_blobs(bucket_name, f"{prefix.rstrip('/')}/", suffix=".json"):
+        match = SHARD_PATTERN.match(os.path.basename(shard.name))
+        if match and match["stem"] == stem:
+            shards.append((int(match["shard"]), shard.name))
+    return [name for _, name in sorted(shards)]
+
+
+def place_layouts(
+    bucket_name: str,
+    placements: List[tuple[BlobInfo, List[str]]],
+    place: Callable[[BlobInfo, List[str]], Dict[str, Any]],
+    max_workers: int = MAX_WORKERS,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Put existing layout output to use for PDFs, e.g. from the layout cache.
+
+    Args:
+        bucket_name (str): The name of the GCS bucket.
+        placements (List[tuple[BlobInfo, List[str]]]): Each PDF with its layout JSON shards.
+        place (Callable[[BlobInfo, List[str]], Dict[str, Any]]): Copies or sections the
+            layout of a PDF and returns the state to record for it.
+        max_workers (int): Maximum number of PDFs placed in parallel.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The state of each placed PDF keyed by blob name. PDFs
+            whose layout no longer exists or failed are left out.
+    """
+
+    def place_one(placement: tuple[BlobInfo, List[str]]) -> Dict[str, Any] | None:
+        blob, layout_blobs = placement
+        try:
+            if not all(blob_exists(bucket_name, name) for name in layout_blobs):
+                raise FileNotFoundError(layout_blobs[0])
+            return place(blob, layout_blobs)
+        except FileNotFoundError:
+            print(f"Layout {layout_blobs[0]} no longer exists, processing again.")
+        except Exception as e:
+            print(f"Failed to use the layout {layout_blobs[0]} for {blob.name}: {e}")
+        return None
+
+    if not placements:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        states = list(executor.map(place_one, placements))
+    return {
+        blob.name: state
+        for (blob, _), state in zip(placements, states)
+        if state is not None
+    }
+
+
+def submit_batch(
     processor_full_name: str,
     location: str,
     gcs_output_uri: str,
     gcs_input_uris: Optional[List[str]] = None,
-    timeout: int = 3600,
     input_mime_type: str = "application/pdf",
-) -> None:
-    """Process specific documents using Document AI and save the results to GCS."""
-    opts = ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
-    client = documentai.DocumentProcessorServiceClient(client_options=opts)
+) -> Operation:
+    """Start processing specific documents using Document AI without waiting for the result.
+
+    Returns:
+        Operation: The long-running operation of the batch.
+    """
+    client = get_documentai_client(location)
 
     if gcs_input_uris:
         # Specify specific GCS URIs to process individual documents
@@ -68,24 +305,193 @@ def batch_process_documents(
         document_output_config=output_config,
     )
 
-    try:
-        operation = client.batch_process_documents(request=request)
-        print(f"Waiting for operation {operation.operation.name} to complete...")
-        operation.result(timeout=timeout)
-    except (RetryError, InternalServerError) as e:
-        print(e.message)
-        return
+    return client.batch_process_documents(request=request)
+
+
+def get_document_results(
+    operation: Operation, document_uris: List[str]
+) -> List[DocumentResult]:
+    """Read the outcome of each document from a finished batch operation.
+
+    Document AI reports a status per input document in BatchProcessMetadata. Documents
+    without a status share the outcome of the operation as a whole.
+
+    Args:
+        operation (Operation): The finished batch operation.
+        document_uris (List[str]): The GCS URIs of the documents in the batch.
+
+    Returns:
+        List[DocumentResult]: The result of each document in document_uris.
+    """
+    error = operation.exception()
+    operation_error = str(error) if error is not None else ""
+
+    statuses: Dict[str, DocumentResult] = {}
+    state_message = ""
+    succeeded = error is None
+    if operation.metadata is not None:
+        metadata = documentai.BatchProcessMetadata(operation.metadata)
+        state_message = metadata.state_message
+        succeeded = (
+            succeeded
+            and metadata.state == documentai.BatchProcessMetadata.State.SUCCEEDED
+        )
+        for status in metadata.individual_process_statuses:
+            # A status code of 0 is google.rpc.Code.OK
+            statuses[status.input_gcs_source] = DocumentResult(
+                uri=status.input_gcs_source,
+                succeeded=status.status.code == 0,
+                error=status.status.message,
+                output_uri=status.output_gcs_destination,
+            )
+
+    if succeeded:
+        print(f"Batch Process Succeeded: {state_message}")
+    else:
+        print(f"Batch Process Failed: {operation_error or state_message}")
+
+    return [
+        statuses.get(
+            uri,
+            DocumentResult(
+                uri=uri,
+                succeeded=succeeded,
+                error="" if succeeded else operation_error or state_message,
+            ),
+        )
+        for uri in document_uris
+    ]
+
+
+def run_batches(
+    jobs: List[BatchJob],
+    processor_full_name: str,
+    location: str,
+    on_finished: Callable[[BatchJob, List[DocumentResult]], None],
+    max_in_flight: int = MAX_CONCURRENT_OPERATIONS,
+    poll_interval: int = POLL_INTERVAL,
+    timeout: int = OPERATION_TIMEOUT,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> None:
+    """Run Document AI batches keeping up to max_in_flight operations running at once.
+
+    Operations are polled without blocking on any single one. As soon as a batch
+    finishes, on_finished is called for it on a worker thread while the remaining
+    operations keep running. Documents that failed are resubmitted as a new batch with
+    exponential backoff until they have been tried max_attempts times.
+
+    Args:
+        jobs (List[BatchJob]): The batches to process.
+        processor_full_name (str): The full resource name of the processor.
+        location (str): The location of the processor.
+        on_finished (Callable[[BatchJob, List[DocumentResult]], None]): Called with each job and
+            the final results of its documents. Documents that will be retried are left out.
+        max_in_flight (int): The maximum number of concurrent operations.
+        poll_interval (int): Seconds between polls of the running operations.
+        timeout (int): Seconds after which a running operation is cancelled and given up on.
+        max_attempts (int): How many times a document is submitted before giving up.
+    """
+    queued = list(jobs)
+    in_flight: List[BatchJob] = []
+    finishing: List[Future] = []
+
+    def finish(job: BatchJob, results: List[DocumentResult]) -> None:
+        failed = [result for result in results if not result.succeeded]
+        final_results = results
+        if failed and job.attempt < max_attempts:
+            delay = RETRY_BASE_DELAY * 2 ** (job.attempt - 1)
+            print(
+                f"Retrying {len(failed)} of {len(results)} documents from {job.output_uri} in {delay} s"
+            )
+            for result in failed:
+                print(f"{result.uri} failed: {result.error}")
+            queued.append(
+                BatchJob(
+                    document_uris=[result.uri for result in failed],
+                    output_uri=f"{job.output_uri}_retry{job.attempt}",
+                    attempt=job.attempt + 1,
+                    not_before=time.monotonic() + delay,
+                )
+            )
+            final_results = [result for result in results if result.succeeded]
+        if final_results:
+            finishing.append(executor.submit(on_finished, job, final_results))
 
-    metadata = documentai.BatchProcessMetadata(operation.metadata)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while queued or in_flight:
+            # Fill the free operation slots with jobs whose backoff has passed
+            now = time.monotonic()
+            for job in [job for job in queued if job.not_before <= now]:
+                if len(in_flight) >= max_in_flight:
+                    break
+                queued.remove(job)
+                try:
+                    job.operation = submit_batch(
+                        processor_full_name,
+                        location,
+                        job.output_uri,
+                        job.document_uris,
+                    )
+                except (RetryError, GoogleAPICallError) as e:
+                    print(f"Failed to submit batch {job.output_uri}: {e.message}")
+                    finish(
+                        job,
+                        [
+                            DocumentResult(uri=uri, succeeded=False, error=e.message)
+                            for uri in job.document_uris
+                        ],
+                    )
+                    continue
+                job.submitted_at = time.monotonic()
+                in_flight.append(job)
+                print(
+                    f"Started operation {job.operation.operation.name} for {len(job.document_uris)} files "
+                    f"({len(in_flight)} in flight, {len(queued)} queued)"
+                )
 
-    if metadata.state != documentai.BatchProcessMetadata.State.SUCCEEDED:
-        raise ValueError(f"Batch Process Failed: {metadata.state_message}")
+            time.sleep(poll_interval)
 
-    print(f"Batch Process Succeeded: {metadata.state_message}")
+            for job in list(in_flight):
+                try:
+                    done = job.operation.done()
+                except (RetryError, GoogleAPICallError) as e:
+                    # Counts towards the timeout, so an operation that cannot be
+                    # polled is given up on as well
+                    print(f"Error polling {job.operation.operation.name}: {e.message}")
+                    done = False
+
+                if done:
+                    results = get_document_results(job.operation, job.document_uris)
+                elif time.monotonic() - job.submitted_at > timeout:
+                    print(f"Operation {job.operation.operation.name} timed out.")
+                    # Free the processor quota the operation holds
+                    try:
+                        job.operation.cancel()
+                    except (RetryError, GoogleAPICallError) as e:
+                        print(
+                            f"Failed to cancel {job.operation.operation.name}: {e.message}"
+                        )
+                    results = [
+                        DocumentResult(uri=uri, succeeded=False, error="Timed out")
+                        for uri in job.document_uris
+                    ]
+                else:
+                    continue
+
+                in_flight.remove(job)
+                finish(job, results)
+
+    for future in finishing:
+        # Surface errors raised while finishing a batch
+        future.result()
 
 
 def main() -> None:
-    """Main function to process PDF files from GCS bucket using Document AI in batches."""
+    """Main function to process PDF files from GCS bucket using Document AI in batches.
+
+    With --fused, each finished document is split into sections straight from the
+    batch output instead of being copied to CHUNKS_DIR for chunks_to_sections.py.
+    """
     config: Config = check_args_and_env_vars(
         required_env_vars=[
             "BUCKET_NAME",
@@ -94,7 +500,8 @@ def main() -> None:
             "BATCHES_DIR",
             "CHUNKS_DIR",
             "PDF_DIR",
-        ]
+        ],
+        flag_args=["--force", "--fused", "--corpus"],
     )
 
     bucket_name = config["BUCKET_NAME"]
@@ -103,6 +510,12 @@ def main() -> None:
     output_dir = config["CHUNKS_DIR"]
     source_dir = config["PDF_DIR"]
     batches_dir = config["BATCHES_DIR"]
+    fused = config["FUSED"]
+    if fused:
+        for env_var in ["SECTIONS_JSON_DIR", "SECTIONS_TXT_DIR"]:
+            if env_var not in config:
+                raise ValueError(f"Missing required environment variable: {env_var}")
+
     pdf_files = get_pdf_files_from_bucket(bucket_name, source_dir)
 
     print(f"Total PDF files: {len(pdf_files)}")
@@ -111,40 +524,165 @@ def main() -> None:
         print("No PDF files found in the bucket to process.")
         return
 
-    batches = gcs_utilities.create_batches(
-        gcs_bucket_name=bucket_name, gcs_prefix=source_dir, batch_size=BATCH_SIZE
+    pending_files = select_pending(
+        pdf_files,
+        done_key="chunksCreatedAt",
+        fingerprint_key="pdfFingerprint",
+        failed_key="chunksFailedAt",
+        force=config["FORCE"],
     )
 
-    print(f"Total batches: {len(batches)}")
+    # With --fused --corpus the sections of this run are also written to one corpus file
+    corpus = CorpusWriter() if fused and config["CORPUS"] else None
+
+    def place(blob: BlobInfo, layout_blobs: List[str]) -> Dict[str, Any]:
+        current_time = datetime.now(timezone.utc).isoformat()
+        state: Dict[str, Any] = {
+            "chunksCreatedAt": current_time,
+            "pdfFingerprint": blob_fingerprint(blob),
+        }
+        if fused:
+            stem = os.path.splitext(os.path.basename(blob.name))[0]
+            page_count = convert_layout_to_sections(
+                layout_blobs,
+                f"{config['SECTIONS_JSON_DIR']}/{stem}.json",
+                f"{config['SECTIONS_TXT_DIR']}/{stem}.txt",
+                bucket_name,
+                corpus=corpus,
+            )
+            state.update({"sectionsCreatedAt": current_time, "pageCount": page_count})
+        else:
+            copy_file(bucket_name, layout_blobs[0], layout_blob_name(output_dir, blob))
+        return state
+
+    # PDFs whose bytes were already processed by this processor version reuse the
+    # stored layout, and only one of several identical PDFs goes to Document AI.
+    # Layouts are cached where Document AI wrote them, in a batch output directory
+    # that no later run writes to. Entries elsewhere, such as copies in CHUNKS_DIR
+    # that a PDF of the same name overwrites, are not trusted.
+    processor_version = get_processor_version(location, processor_full_name)
+    content_hashes = {blob.name: content_hash(blob) for blob in pending_files}
+    cached_layouts = {
+        pdf_hash: layout_blob
+        for pdf_hash, layout_blob in (
+            {}
+            if config["FORCE"]
+            else get_cached_layouts(
+                list(set(content_hashes.values())), processor_version
+            )
+        ).items()
+        if layout_blob.startswith(f"{batches_dir.rstrip('/')}/")
+    }
+    placed = place_layouts(
+        bucket_name,
+        [
+            (blob, [cached_layouts[content_hashes[blob.name]]])
+            for blob in pending_files
+            if content_hashes[blob.name] in cached_layouts
+        ],
+        place,
+    )
+    update_states(placed)
+    print(f"Reused cached layouts for {len(placed)} files")
 
-    for batch in batches:
-        print(f"{len(batch.gcs_documents.documents)} files in batch.")
-        document_uris = [doc.gcs_uri for doc in batch.gcs_documents.documents]
-        print(document_uris)
+    duplicates: Dict[str, List[BlobInfo]] = {}
+    uncached_files: List[BlobInfo] = []
+    for blob in pending_files:
+        if blob.name in placed:
+            continue
+        if content_hashes[blob.name] in duplicates:
+            duplicates[content_hashes[blob.name]].append(blob)
+        else:
+            duplicates[content_hashes[blob.name]] = []
+            uncached_files.append(blob)
+    pending_files = uncached_files
+    blobs_by_name = {blob.name: blob for blob in pending_files}
+    blobs_by_uri = {f"gs://{bucket_name}/{blob.name}": blob for blob in pending_files}
 
-        # Define the output URI for this batch
-        batch_output_uri = f"gs://{bucket_name}/{batches_dir.rstrip('/')}/batch_{datetime.now(timezone.utc).isoformat()}"
+    if not pending_files:
+        print("No PDF files left to process.")
+        if corpus is not None:
+            corpus.close(bucket_name)
+        return
 
-        print(f"Batch Output URI: {batch_output_uri}")
+    state = load_state()
+    page_counts = {
+        blob.name: estimate_page_count(blob, state.get(state_key(blob.name), {}))
+        for blob in pending_files
+    }
+    batches = [
+        [f"gs://{bucket_name}/{blob.name}" for blob in batch]
+        for batch in plan_batches(
+            pending_files, page_counts, min_batches=MAX_CONCURRENT_OPERATIONS
+        )
+    ]
+
+    print(f"Total batches: {len(batches)}")
 
-        # Process the batch with specific document URIs
-        batch_process_documents(
-            processor_full_name=processor_full_name,
-            location=location,
-            gcs_output_uri=batch_output_uri,
-            gcs_input_uris=document_uris,
-            timeout=3600,
-            input_mime_type="application/pdf",
+    batch_time = datetime.now(timezone.utc).isoformat()
+    jobs = [
+        BatchJob(
+            document_uris=document_uris,
+            # Define the output URI for this batch
+            output_uri=f"gs://{bucket_name}/{batches_dir.rstrip('/')}/batch_{batch_time}_{index:04d}",
         )
+        for index, document_uris in enumerate(batches, start=1)
+    ]
+    chunks_uri = f"gs://{bucket_name}/{output_dir.rstrip('/')}"
 
-        chunks_uri = f"gs://{bucket_name}/{output_dir.rstrip('/')}"
-        copy_batch_to_dir(batch_output_uri, chunks_uri)
+    def finish_batch(job: BatchJob, results: List[DocumentResult]) -> None:
+        succeeded = [result for result in results if result.succeeded]
+        if succeeded and not fused:
+            copy_batch_to_dir(job.output_uri, chunks_uri)
 
-        # Update state for each file in the batch
+        # Each document's layout serves it and the identical PDFs held back for it
+        layouts: Dict[str, List[str]] = {
+            blobs_by_uri[result.uri].name: find_layout_shards(
+                bucket_name,
+                result.output_uri or job.output_uri,
+                blobs_by_uri[result.uri],
+            )
+            for result in succeeded
+        }
+        placed = place_layouts(
+            bucket_name,
+            [
+                (target, layout_blobs)
+                for name, layout_blobs in layouts.items()
+                if layout_blobs
+                for target in [blobs_by_name[name]] + duplicates[content_hashes[name]]
+            ],
+            place,
+        )
+        put_cached_layouts(
+            {
+                content_hashes[name]: layout_blobs[0]
+                for name, layout_blobs in layouts.items()
+                # A layout split into several shards cannot be reused as one blob
+                if name in placed and len(layout_blobs) == 1
+            },
+            processor_version,
+        )
+
+        # Update state for each file in the batch with its own outcome
         current_time = datetime.now(timezone.utc).isoformat()
-        for uri in document_uris:
-            file_name = uri.split("/")[-1]
-            update_state(file_name, {"chunksCreatedAt": current_time})
+        failed: Dict[str, Dict[str, Any]] = {}
+        for result in results:
+            blob = blobs_by_uri[result.uri]
+            if blob.name in placed:
+                continue
+            error = result.error
+            if result.succeeded:
+                error = f"Could not use the layout output in {result.output_uri or job.output_uri}"
+            failed[blob.name] = {"chunksFailedAt": current_time, "chunksError": error}
+        update_states({**placed, **failed})
+
+    run_batches(jobs, processor_full_name, location, on_finished=finish_batch)
+
+    if fused:
+        print(f"Filter rule hits: {SECTION_RULES.report()}")
+    if corpus is not None:
+        corpus.close(bucket_name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+import itertools
+import os
+import re
+from typing import Dict, Iterator, List, Tuple
+
+import dotenv
+import numpy as np
+
+dotenv.load_dotenv()
+
+# Estimated Jaccard similarity of word shingles above which sections are answered by
+# one representative, 0 disables near-duplicate detection
+NEAR_DUPLICATE_THRESHOLD: float = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0"))
+
+# Hash functions in a MinHash signature, more estimate the similarity more precisely
+NUM_PERMUTATIONS: int = 128
+# Words per shingle
+SHINGLE_WORDS: int = 3
+# Shingles hashed at once when computing signatures, bounds the memory used
+SHINGLES_PER_CHUNK: int = 65536
+
+_WORD = re.compile(r"\w+")
+_MASK_32 = np.uint64(0xFFFFFFFF)
+
+# Fixed seed, so the same texts are grouped the same way in every run
+_random = np.random.default_rng(20240901)
+# Odd multipliers, so a * x + b modulo 2 ** 32 permutes the 32 bit shingle hashes
+_PERMUTATION_A = _random.integers(0, 2**32, NUM_PERMUTATIONS, dtype=np.uint32) | 1
+_PERMUTATION_B = _random.integers(0, 2**32, NUM_PERMUTATIONS, dtype=np.uint32)
+# Multipliers combining the hashes of the words of a shingle, and the rows of a band
+_SHINGLE_MULTIPLIERS = _random.integers(1, 2**63, SHINGLE_WORDS, dtype=np.uint64) | 1
+_BAND_MULTIPLIERS = _random.integers(1, 2**63, NUM_PERMUTATIONS, dtype=np.uint64) | 1
+
+
+def shingle_hashes(
+    text: str, word_ids: Dict[str, int], new_ids: Iterator[int]
+) -> np.ndarray:
+    """
+    Hash the word shingles of a text to 32 bits.
+
+    Args:
+        text (str): The text.
+        word_ids (Dict[str, int]): Ids of the words seen so far, extended with the
+            words of text. Hashes are only comparable between texts sharing word_ids.
+        new_ids (Iterator[int]): Unused ids to give new words.
+
+    Returns:
+        np.ndarray: The uint32 hashes of the shingles, one shingle of all words for
+            texts shorter than a shingle, empty for texts without words.
+    """
+    words = _WORD.findall(text.lower())
+    hashes = np.fromiter(
+        map(word_ids.setdefault, words, new_ids), dtype=np.uint64, count=len(words)
+    )
+    width = min(SHINGLE_WORDS, len(hashes))
+    if width == 0:
+        return hashes.astype(np.uint32)
+    count = len(hashes) - width + 1
+    combined = np.zeros(count, dtype=np.uint64)
+    for offset in range(width):
+        combined += (
+            hashes[offset : offset + count] + np.uint64(1)
+        ) * _SHINGLE_MULTIPLIERS[offset]
+    return ((combined >> np.uint64(32)) ^ (combined & _MASK_32)).astype(np.uint32)
+
+
+def minhash_signatures(texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the MinHash signature of each text.
+
+    The shingles of many texts are hashed together and reduced per text, so the work
+    happens in a few large numpy operations.
+
+    Args:
+        texts (List[str]): The texts.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The uint32 signatures, one row per text, and
+            whether each text has any words. Texts without words get no signature.
+    """
+    word_ids: Dict[str, int] = {}
+    new_ids = itertools.count()
+    shingles = [shingle_hashes(text, word_ids, new_ids) for text in texts]
+    has_words = np.array([len(hashes) > 0 for hashes in shingles], dtype=bool)
+    signatures = np.full(
+        (len(texts), NUM_PERMUTATIONS), np.iinfo(np.uint32).max, dtype=np.uint32
+    )
+
+    start = 0
+    while start < len(texts):
+        # Take texts until the chunk is full, at least one
+        end, size = start, 0
+        while end < len(texts) and (end == start or size < SHINGLES_PER_CHUNK):
+            size += len(shingles[end])
+            end += 1
+        chunk = [hashes for hashes in shingles[start:end] if len(hashes)]
+        rows = np.flatnonzero(has_words[start:end]) + start
+        if chunk:
+            values = np.concatenate(chunk)
+            # One permutation per row, wrapping around at 32 bits
+            permuted = np.outer(_PERMUTATION_A, values)
+            permuted += _PERMUTATION_B[:, None]
+            offsets = np.cumsum([0] + [len(hashes) for hashes in chunk[:-1]])
+            signatures[rows] = np.minimum.reduceat(permuted, offsets, axis=1).T
+        start = end
+    return signatures, has_words
+
+
+def lsh_bands(threshold: float, num_permutations: int = NUM_PERMUTATIONS) -> int:
+    """
+    Choose the number of LSH bands for a similarity threshold.
+
+    Texts sharing all rows of a band become candidates. The similarity at which that
+    becomes likely, (1 / bands) ** (1 / rows), is set as close to the threshold as the
+    divisors of num_permutations allow.
+
+    Args:
+        threshold (float): The Jaccard similarity threshold.
+        num_permutations (int): The length of the signatures.
+
+    Returns:
+        int: The number of bands, a divisor of num_permutations.
+    """
+    return min(
+        (
+            bands
+            for bands in range(1, num_permutations + 1)
+            if num_permutations % bands == 0
+        ),
+        key=lambda bands: abs((1 / bands) ** (bands / num_permutations) - threshold),
+    )
+
+
+def find_near_duplicates(texts: Dict[str, str], threshold: float) -> Dict[str, str]:
+    """
+    Group texts whose estimated Jaccard similarity reaches threshold.
+
+    Texts are visited in order. A text that no earlier group took becomes the
+    representative of a new group, joined by the later texts similar to it.
+
+    Args:
+        texts (Dict[str, str]): The texts by id, in order.
+        threshold (float): The estimated Jaccard similarity of word shingles a text
+            needs to a representative to join its group.
+
+    Returns:
+        Dict[str, str]: The id of the representative of every text in a group
+            that is not a representative itself.
+    """
+    ids = list(texts)
+    signatures, has_words = minhash_signatures(list(texts.values()))
+    bands = lsh_bands(threshold)
+    rows = NUM_PERMUTATIONS // bands
+
+    # Bucket the texts of each band by a hash of their rows in the band
+    groups_of_text: List[List[np.ndarray]] = [[] for _ in ids]
+    candidates = np.flatnonzero(has_words)
+    for band in range(bands):
+        columns = slice(band * rows, (band + 1) * rows)
+        band_hashes = (
+            signatures[candidates, columns].astype(np.uint64) @ _BAND_MULTIPLIERS[:rows]
+        )
+        order = np.argsort(band_hashes, kind="stable")
+        sorted_hashes = band_hashes[order]
+        boundaries = np.flatnonzero(np.diff(sorted_hashes)) + 1
+        for group in np.split(candidates[order], boundaries):
+            if len(group) > 1:
+                for text in group:
+                    groups_of_text[text].append(group)
+
+    representatives: Dict[str, str] = {}
+    assigned = np.zeros(len(ids), dtype=bool)
+    for text in range(len(ids)):
+        if assigned[text] or not groups_of_text[text]:
+            continue
+        assigned[text] = True
+        members = np.unique(np.concatenate(groups_of_text[text]))
+        members = members[(members > text) & ~assigned[members]]
+        if not len(members):
+            continue
+        similarity = (signatures[members] == signatures[text]).mean(axis=1)
+        for member in members[similarity >= threshold]:
+            assigned[member] = True
+            representatives[ids[member]] = ids[text]
+    return representatives
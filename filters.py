@@ -1,29 +1,156 @@
-from typing import List, Dict, Callable
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, List, Tuple
 
-# Define type for filter functions
-FilterFunction = Callable[[Dict], bool]
+# What a rule is applied to. A dropped layout block takes its nested blocks with it,
+# paragraph rules also apply to headings handled as paragraphs, and section rules see
+# the title and content of a finished section combined.
+BLOCK: str = "block"
+PARAGRAPH: str = "paragraph"
+SECTION: str = "section"
+CHUNK: str = "chunk"
 
 
-def text_length_filter(chunk: Dict, min_length: int = 2) -> bool:
-    return len(chunk.get("text", "")) >= min_length
+@dataclass(frozen=True)
+class Rule:
+    """
+    A declarative filter rule. Text matching any of the rule's conditions is dropped.
 
+    Attributes:
+        name (str): The name hits are counted under.
+        target (str): BLOCK, PARAGRAPH, SECTION or CHUNK.
+        pattern (str | None): A regex matched at the start of the text.
+        types (FrozenSet[str]): Block types to drop, for BLOCK rules.
+        min_length (int | None): Drop text shorter than this many characters.
+        predicate (Callable[[str], bool] | None): Any other condition on the text.
+    """
 
-def space_count_filter(chunk: Dict) -> bool:
-    text = chunk.get("text", "")
-    first_part = text[:10]
-    last_part = text[-10:]
-    return first_part.count(" ") < 5 and last_part.count(" ") < 5
+    name: str
+    target: str
+    pattern: str | None = None
+    types: FrozenSet[str] = field(default_factory=frozenset)
+    min_length: int | None = None
+    predicate: Callable[[str], bool] | None = None
 
 
-def filter_chunks(chunks: List[Dict], filters: List[FilterFunction]) -> List[Dict]:
-    filtered_chunks = []
-    for chunk in chunks:
-        keep = True
-        for filter_func in filters:
-            if not filter_func(chunk):
-                print(f"Filtered out chunk: {chunk}")
-                keep = False
-                break
-        if keep:
-            filtered_chunks.append(chunk)
-    return filtered_chunks
+def has_spaced_out_ends(text: str) -> bool:
+    """Return True if the first or last 10 characters contain 5 or more spaces."""
+    return text[:10].count(" ") >= 5 or text[-10:].count(" ") >= 5
+
+
+RULES: List[Rule] = [
+    Rule("lataaja", PARAGRAPH, pattern=r"Lataaja:"),
+    Rule("header_footer", BLOCK, types=frozenset({"header", "footer"})),
+    Rule("short_section", SECTION, min_length=30),
+    Rule("short_chunk", CHUNK, min_length=2),
+    Rule("spaced_out_chunk", CHUNK, predicate=has_spaced_out_ends),
+]
+
+
+class RuleSet:
+    """
+    Rules compiled for fast evaluation, counting how often each rule drops something.
+
+    The patterns of each target are combined into one regex, so a text is checked
+    against all of them in a single match.
+    """
+
+    def __init__(self, rules: List[Rule]) -> None:
+        self.names: List[str] = [rule.name for rule in rules]
+        self.hits: Counter[str] = Counter()
+        self._hits_lock = threading.Lock()
+        self._patterns: Dict[str, re.Pattern[str] | None] = {}
+        self._types: Dict[str, Dict[str, int]] = {}
+        self._checks: Dict[str, List[Tuple[int, Rule]]] = {}
+        for target in (BLOCK, PARAGRAPH, SECTION, CHUNK):
+            target_rules = [
+                (index, rule)
+                for index, rule in enumerate(rules)
+                if rule.target == target
+            ]
+            alternatives = [
+                f"(?P<r{index}>{rule.pattern})"
+                for index, rule in target_rules
+                if rule.pattern is not None
+            ]
+            self._patterns[target] = (
+                re.compile("|".join(alternatives)) if alternatives else None
+            )
+            self._types[target] = {
+                text_type: index
+                for index, rule in target_rules
+                for text_type in rule.types
+            }
+            self._checks[target] = [
+                (index, rule)
+                for index, rule in target_rules
+                if rule.min_length is not None or rule.predicate is not None
+            ]
+
+    def match(self, target: str, text: str, text_type: str = "") -> int:
+        """
+        Find the first rule of target that drops text, without counting a hit.
+
+        Args:
+            target (str): BLOCK, PARAGRAPH, SECTION or CHUNK.
+            text (str): The text to check.
+            text_type (str): The block type, for BLOCK rules.
+
+        Returns:
+            int: The index of the matching rule, or -1 if the text is kept.
+        """
+        index = self._types[target].get(text_type)
+        if index is not None:
+            return index
+        pattern = self._patterns[target]
+        if pattern is not None:
+            match = pattern.match(text)
+            if match:
+                return int(match.lastgroup[1:])
+        for index, rule in self._checks[target]:
+            if rule.min_length is not None and len(text) < rule.min_length:
+                return index
+            if rule.predicate is not None and rule.predicate(text):
+                return index
+        return -1
+
+    def count(self, index: int) -> None:
+        """Count a hit of the rule at index."""
+        with self._hits_lock:
+            self.hits[self.names[index]] += 1
+
+    def add_hits(self, hits: Dict[str, int]) -> None:
+        """Add hits counted elsewhere, e.g. in a worker process."""
+        with self._hits_lock:
+            self.hits.update(hits)
+
+    def drops(self, target: str, text: str, text_type: str = "") -> bool:
+        """Return True if a rule of target drops text, counting the hit."""
+        index = self.match(target, text, text_type)
+        if index < 0:
+            return False
+        self.count(index)
+        return True
+
+    def report(self) -> str:
+        """Return the hits of each rule as one line."""
+        return ", ".join(f"{name}: {self.hits[name]}" for name in self.names)
+
+
+DEFAULT_RULES: RuleSet = RuleSet(RULES)
+
+
+def filter_chunks(chunks: List[Dict], rules: RuleSet = DEFAULT_RULES) -> List[Dict]:
+    """
+    Drop chunks that a CHUNK rule matches.
+
+    Args:
+        chunks (List[Dict]): Chunks with a "text" field.
+        rules (RuleSet): The rules to apply, hits are counted in rules.hits.
+
+    Returns:
+        List[Dict]: The chunks that were kept.
+    """
+    return [chunk for chunk in chunks if not rules.drops(CHUNK, chunk.get("text", ""))]
@@ -1,21 +1,28 @@
 import argparse
-from typing import Dict, List
+from typing import Iterable, List
 from dotenv import dotenv_values
 import os
-import json
 from typing import Dict, Any
 
-STATE_FILE: str = "state.json"
+import state_store
+from storage_backends import BlobInfo
+
+# Rough size of a token for estimating prompt sizes without a tokenizer
+CHARS_PER_TOKEN: int = 4
 
 
 def parse_args(
-    required_args: List[str], optional_args: List[str] = []
+    required_args: List[str],
+    optional_args: List[str] = [],
+    flag_args: List[str] = [],
 ) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     for arg in required_args:
         parser.add_argument(arg, required=True, help=f"CLI argument {arg} is required")
     for arg in optional_args:
         parser.add_argument(arg, required=False, help=f"CLI argument {arg} is optional")
+    for arg in flag_args:
+        parser.add_argument(arg, action="store_true", help=f"CLI flag {arg}")
     return parser.parse_args()
 
 
@@ -23,15 +30,19 @@ def check_args_and_env_vars(
     required_args: List[str] = [],
     required_env_vars: List[str] = [],
     optional_args: List[str] = [],
-) -> Dict[str, str | None]:
-    config: Dict[str, str | None] = dotenv_values(".env")
-    args = parse_args(required_args, optional_args)
+    flag_args: List[str] = [],
+) -> Dict[str, Any]:
+    config: Dict[str, Any] = dotenv_values(".env")
+    args = parse_args(required_args, optional_args, flag_args)
     for arg in required_args:
         # Given arg --from_dir will set config.FROM_DIR to args.from_dir
         config.setdefault(arg[2:].upper(), args.__getattribute__(arg[2:]))
     for arg in optional_args:
         if args.__getattribute__(arg[2:]):
             config.setdefault(arg[2:].upper(), args.__getattribute__(arg[2:]))
+    for arg in flag_args:
+        # Given flag --force will set config.FORCE to True or False
+        config[arg[2:].upper()] = args.__getattribute__(arg[2:])
     for env_var in required_env_vars:
         if env_var not in config:
             raise ValueError(f"Missing required environment variable: {env_var}")
@@ -39,33 +50,95 @@ def check_args_and_env_vars(
     return config
 
 
+def state_key(file: str) -> str:
+    """Return the state key of a file: its name without path and extension."""
+    filename = os.path.basename(file)
+    return filename.rsplit(".", 1)[0] if "." in filename else filename
+
+
 def load_state() -> Dict[str, Any]:
-    """Load the upload state from a JSON file."""
-    if not os.path.exists(STATE_FILE):
-        return {}
-    try:
-        with open(STATE_FILE, "r") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        print(
-            f"Warning: {STATE_FILE} is not a valid JSON. Starting with an empty state."
-        )
-        return {}
+    """Load the state of all files from the state store."""
+    return state_store.load_all()
 
 
 def update_state(file: str, data: Dict[str, Any]) -> None:
     """Update the state with the provided data for a given key."""
+    update_states({file: data})
+
+
+def update_states(updates: Dict[str, Dict[str, Any]]) -> None:
+    """Update the state of several files in one transaction.
+
+    Args:
+        updates (Dict[str, Dict[str, Any]]): The data to set, keyed by file name or path.
+    """
     try:
-        filename = os.path.basename(file)
-        filename = filename.rsplit(".", 1)[0] if "." in filename else filename
-
-        state: Dict[str, Any] = load_state()
-        state.setdefault(filename, {})
-        state[filename].update(data)
-        with open(STATE_FILE, "w") as f:
-            json.dump(state, f, indent=4)
+        merged: Dict[str, Dict[str, Any]] = {}
+        for file, data in updates.items():
+            merged.setdefault(state_key(file), {}).update(data)
+        state_store.update_states(merged)
     except Exception as e:
-        print(f"Error updating state for {filename}: {e}")
+        print(f"Error updating state for {', '.join(updates)}: {e}")
+
+
+def blob_fingerprint(blob: BlobInfo) -> str:
+    """Return a string identifying the content of a blob for change detection."""
+    if blob.crc32c:
+        return f"crc32c:{blob.crc32c}"
+    if blob.md5_hash:
+        return f"md5:{blob.md5_hash}"
+    return f"generation:{blob.generation}"
+
+
+def content_hash(blob: BlobInfo) -> str:
+    """Return a hash of a blob's bytes, preferring MD5 over the collision-prone CRC32C."""
+    if blob.md5_hash:
+        return f"md5:{blob.md5_hash}"
+    return blob_fingerprint(blob)
+
+
+def select_pending(
+    blobs: Iterable[BlobInfo],
+    done_key: str,
+    fingerprint_key: str,
+    failed_key: str | None = None,
+    force: bool = False,
+) -> List[BlobInfo]:
+    """
+    Select the input blobs a stage still has to process based on the recorded state.
+
+    A blob is pending if the stage has never completed for it, if its content changed
+    since the stage last ran, or if the stage failed for it after the last success.
+
+    Args:
+        blobs (Iterable[BlobInfo]): The stage's input blobs.
+        done_key (str): The state key holding the stage's completion time, e.g. "chunksCreatedAt".
+        fingerprint_key (str): The state key holding the fingerprint of the input the stage last processed.
+        failed_key (str | None): The state key holding the stage's failure time, if any.
+        force (bool): Select all blobs regardless of the state.
+
+    Returns:
+        List[BlobInfo]: The pending blobs in their original order.
+    """
+    blobs = list(blobs)
+    if force:
+        return blobs
+
+    state = load_state()
+    pending: List[BlobInfo] = []
+    for blob in blobs:
+        file_state = state.get(state_key(blob.name), {})
+        done_at = file_state.get(done_key)
+        failed_at = file_state.get(failed_key) if failed_key else None
+        if (
+            not done_at
+            or file_state.get(fingerprint_key) != blob_fingerprint(blob)
+            or (failed_at and failed_at > done_at)
+        ):
+            pending.append(blob)
+
+    print(f"{len(pending)} of {len(blobs)} files need processing")
+    return pending
 
 
 def get_section_id(file_path: str, section_index: int) -> str:
@@ -0,0 +1,177 @@
+import io
+import json
+import re
+from typing import Any, BinaryIO, Tuple
+
+# Characters read from the stream at a time
+READ_SIZE: int = 256 * 1024
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# The next character that changes nesting or starts a string
+_STRUCTURE = re.compile(r'["{}\[\]]')
+# Characters of a string up to its closing quote or a backslash at the end of the buffer
+_STRING_BODY = re.compile(r'(?:[^"\\]|\\.)*', re.DOTALL)
+# A key without escapes followed by its colon
+_SIMPLE_KEY = re.compile(r'"([^"\\]*)"[ \t\n\r]*:')
+# Characters that may continue a number, such as "." and "e" after 12 in 12.5e3
+_NUMBER_TAIL = re.compile(r"[0-9.eE+\-]*")
+
+
+class JsonStreamReader:
+    """
+    Reads JSON tokens from a byte stream holding only a small window in memory.
+
+    The caller walks the document structure with expect, peek and read_key, decodes
+    the values it needs with read_value and skips the rest with skip_value, so large
+    documents can be processed without loading them as a whole. try_read_value decodes
+    values that fit in the window at the speed of json.loads.
+    """
+
+    def __init__(self, stream: BinaryIO, read_size: int = READ_SIZE) -> None:
+        self._text = io.TextIOWrapper(stream, encoding="utf-8")
+        self._read_size = read_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """Append the next piece of the stream to the buffer, returns False at the end."""
+        if self._eof:
+            return False
+        data = self._text.read(self._read_size)
+        if not data:
+            self._eof = True
+            return False
+        # Drop what has been consumed so the buffer stays small
+        self._buffer = self._buffer[self._pos :] + data
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Return the next character that is not whitespace, or "" at the end."""
+        if self._pos < len(self._buffer):
+            char = self._buffer[self._pos]
+            if char not in " \t\n\r":
+                return char
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        """Consume the next character, which must be char."""
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found!r} in JSON stream")
+        self._pos += 1
+
+    def _complete(self, end: int) -> bool:
+        """Return whether a value decoded up to end cannot continue past the buffer."""
+        return self._eof or not _NUMBER_TAIL.fullmatch(self._buffer, end)
+
+    def read_value(self) -> Any:
+        """Decode the next value, which must fit in memory."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the stream
+            if self._complete(end) or not self._fill():
+                self._pos = end
+                return value
+
+    def try_read_value(self) -> Tuple[bool, Any]:
+        """
+        Decode the next value if it lies entirely in the data read so far.
+
+        Returns:
+            Tuple[bool, Any]: Whether the value was decoded, and the value.
+        """
+        self.peek()
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            return False, None
+        if not self._complete(end):
+            # A number at the end of the buffer may continue in the stream
+            return False, None
+        self._pos = end
+        return True, value
+
+    def read_key(self) -> str:
+        """Decode an object key and consume the colon after it."""
+        self.peek()
+        match = _SIMPLE_KEY.match(self._buffer, self._pos)
+        if match:
+            self._pos = match.end()
+            return match.group(1)
+        key = self.read_value()
+        if not isinstance(key, str):
+            raise ValueError(f"Expected an object key but found {key!r} in JSON stream")
+        self.expect(":")
+        return key
+
+    def _skip_string(self) -> None:
+        """Skip a string whose opening quote has been consumed."""
+        while True:
+            self._pos = _STRING_BODY.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) and self._buffer[self._pos] == '"':
+                self._pos += 1
+                return
+            if not self._fill():
+                raise ValueError("Unterminated string in JSON stream")
+
+    def skip_value(self) -> None:
+        """Skip the next value without decoding it."""
+        if self.peek() not in "{[":
+            if self.peek() == '"':
+                self._pos += 1
+                self._skip_string()
+            else:
+                self.read_value()
+            return
+
+        depth = 0
+        while True:
+            match = _STRUCTURE.search(self._buffer, self._pos)
+            if match is None:
+                self._pos = len(self._buffer)
+                if not self._fill():
+                    raise ValueError("Unexpected end of JSON stream")
+                continue
+            self._pos = match.end()
+            char = match.group()
+            if char == '"':
+                self._skip_string()
+            elif char in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def next_item(self, close: str) -> bool:
+        """
+        Advance to the next item of an object or array.
+
+        Args:
+            close (str): The closing character of the container, "}" or "]".
+
+        Returns:
+            bool: True if another item follows, False if the container was closed.
+        """
+        char = self.peek()
+        if char == ",":
+            self._pos += 1
+            char = self.peek()
+        if char == close:
+            self._pos += 1
+            return False
+        return True
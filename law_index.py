@@ -0,0 +1,262 @@
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Tuple
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# How many § passages of the law go into a prompt, 0 puts the whole law in every prompt
+LAW_TOP_K: int = int(os.getenv("LAW_TOP_K", "0"))
+# Where the parsed law index is cached between runs
+LAW_INDEX_FILE: str = os.getenv("LAW_INDEX_FILE", ".law_index.json")
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1: float = 1.5
+BM25_B: float = 0.75
+
+# Words are indexed as character n-grams of this length, so that the inflected forms
+# of a word and the parts of compound words such as "rakennusjäte" and "jätehuolto"
+# share terms without a Finnish stemmer
+NGRAM_LENGTH: int = 5
+# Bump when tokenize changes, so that cached indexes are rebuilt
+INDEX_VERSION: int = 2
+
+_CHAPTER = re.compile(r"^(\d+(?: [a-z])?) luku$")
+_PARAGRAPH = re.compile(r"^(\d+(?: [a-z])?) §$")
+_WORD = re.compile(r"\w+")
+
+_STOPWORDS = frozenset("""
+    ja tai on ei se joka jotka sekä myös kuin jos niin ovat olla ole tämän tässä
+    tätä sen sitä siitä mukaan sekä että tulee voidaan voi kun mitä mikä jonka
+    joiden eikä vain nojalla
+    """.split())
+
+
+@dataclass(frozen=True)
+class LawPassage:
+    """
+    One § of the law.
+
+    Attributes:
+        chapter (str): The chapter number, e.g. "3".
+        chapter_title (str): The title of the chapter.
+        number (str): The § number, e.g. "40".
+        text (str): The § as it appears in the law, from its "40 §" line on.
+    """
+
+    chapter: str
+    chapter_title: str
+    number: str
+    text: str
+
+
+def ngrams(word: str) -> List[str]:
+    """Split a word into character n-grams, marking its start and end with spaces."""
+    padded = f" {word} "
+    return [
+        padded[start : start + NGRAM_LENGTH]
+        for start in range(max(1, len(padded) - NGRAM_LENGTH + 1))
+    ]
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into the character n-grams of its words, leaving out stopwords."""
+    return [
+        term
+        for word in _WORD.findall(text.lower())
+        if word not in _STOPWORDS and not word.isdigit()
+        for term in ngrams(word)
+    ]
+
+
+def parse_law(law_text: str) -> List[LawPassage]:
+    """
+    Split the law text into its § passages.
+
+    Chapters start at "N luku" lines followed by the chapter title, and each §
+    at an "N §" line followed by its title. Text before the first § is left out.
+
+    Args:
+        law_text (str): The full text of the law.
+
+    Returns:
+        List[LawPassage]: The passages in the order of the law.
+    """
+    passages: List[LawPassage] = []
+    chapter, chapter_title = "", ""
+    number: str | None = None
+    lines: List[str] = []
+
+    def close_passage() -> None:
+        if number is not None:
+            passages.append(
+                LawPassage(chapter, chapter_title, number, "\n".join(lines).strip())
+            )
+
+    law_lines = law_text.splitlines()
+    for index, line in enumerate(law_lines):
+        chapter_match = _CHAPTER.match(line.strip())
+        paragraph_match = _PARAGRAPH.match(line.strip())
+        if chapter_match:
+            close_passage()
+            number, lines = None, []
+            chapter = chapter_match.group(1)
+            chapter_title = (
+                law_lines[index + 1].strip() if index + 1 < len(law_lines) else ""
+            )
+        elif paragraph_match:
+            close_passage()
+            number, lines = paragraph_match.group(1), [line.strip()]
+        elif number is not None:
+            lines.append(line)
+    close_passage()
+    return passages
+
+
+class LawIndex:
+    """
+    A BM25 index of the § passages of the law.
+
+    The chapter title and the passage text are indexed together, so a manual section
+    matches a § through the words of its chapter as well.
+    """
+
+    def __init__(
+        self,
+        law_text: str,
+        passages: List[LawPassage],
+        term_counts: List[Dict[str, int]],
+    ) -> None:
+        self.law_text = law_text
+        self.passages = passages
+        self.term_counts = term_counts
+        self.lengths = [sum(counts.values()) for counts in term_counts]
+        self.average_length = (
+            sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        )
+        # The passages of each term with its frequency in them, so that a query only
+        # visits the passages that share its terms
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        for index, counts in enumerate(term_counts):
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, []).append((index, frequency))
+        count = len(passages)
+        self.idf = {
+            term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+        self.norms = [
+            BM25_K1 * (1 - BM25_B + BM25_B * length / self.average_length)
+            for length in self.lengths
+        ]
+
+    @classmethod
+    def build(cls, law_text: str) -> "LawIndex":
+        """Parse the law and count the terms of each passage."""
+        passages = parse_law(law_text)
+        term_counts = [
+            dict(Counter(tokenize(f"{passage.chapter_title}\n{passage.text}")))
+            for passage in passages
+        ]
+        return cls(law_text, passages, term_counts)
+
+    def search(self, query: str, top_k: int) -> List[LawPassage]:
+        """
+        Find the passages most relevant to query.
+
+        Args:
+            query (str): The text to find law passages for, e.g. a manual section.
+            top_k (int): The maximum number of passages to return.
+
+        Returns:
+            List[LawPassage]: Up to top_k passages that share terms with query, in
+                the order of the law.
+        """
+        scores = [0.0] * len(self.passages)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for index, frequency in self.postings[term]:
+                scores[index] += (
+                    idf * frequency * (BM25_K1 + 1) / (frequency + self.norms[index])
+                )
+        ranked = sorted(range(len(scores)), key=lambda index: -scores[index])
+        best = sorted(index for index in ranked[:top_k] if scores[index] > 0)
+        return [self.passages[index] for index in best]
+
+    def relevant_text(self, query: str, top_k: int = LAW_TOP_K) -> str:
+        """
+        Render the passages most relevant to query as law text for a prompt.
+
+        Falls back to the whole law if top_k is 0 or less, the law could not be
+        split into passages, or no passage shares a term with query.
+
+        Args:
+            query (str): The text to find law passages for, e.g. a manual section.
+            top_k (int): The maximum number of passages.
+
+        Returns:
+            str: The chapter headings and text of the passages, or the whole law.
+        """
+        passages = self.search(query, top_k) if top_k > 0 and self.passages else []
+        if not passages:
+            return self.law_text
+        parts: List[str] = []
+        chapter: str | None = None
+        for passage in passages:
+            if passage.chapter != chapter:
+                chapter = passage.chapter
+                parts.append(f"{chapter} luku\n{passage.chapter_title}")
+            parts.append(passage.text)
+        return "\n\n".join(parts)
+
+
+def load_law_index(law_text: str, cache_file: str = LAW_INDEX_FILE) -> LawIndex:
+    """
+    Load the index of the law from the cache file, building it if the law or the
+    tokenizer has changed.
+
+    Args:
+        law_text (str): The full text of the law.
+        cache_file (str): The path of the cache file.
+
+    Returns:
+        LawIndex: The index of the law.
+    """
+    law_hash = hashlib.sha256(law_text.encode("utf-8")).hexdigest()
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if (
+            cached.get("law_hash") == law_hash
+            and cached.get("version") == INDEX_VERSION
+        ):
+            return LawIndex(
+                law_text,
+                [LawPassage(**passage) for passage in cached["passages"]],
+                cached["term_counts"],
+            )
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+        pass
+
+    index = LawIndex.build(law_text)
+    with open(cache_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "law_hash": law_hash,
+                "version": INDEX_VERSION,
+                "passages": [asdict(passage) for passage in index.passages],
+                "term_counts": index.term_counts,
+            },
+            f,
+            ensure_ascii=False,
+        )
+    print(f"Indexed {len(index.passages)} § passages of the law in {cache_file}")
+    return index
@@ -1,17 +1,34 @@
+import hashlib
 import json
+import math
 import os
+import re
 import time
-from typing import List, TypedDict, Optional, Dict
+from typing import List, TypedDict, Optional, Dict, Set, Tuple
 import dotenv
 from openai import OpenAI
-from helpers import combine_title_content
-from prompt import create_prompt
+from helpers import CHARS_PER_TOKEN, combine_title_content
+from law_index import LawIndex
+from state_store import get_cached_completions, put_cached_completions
+from prompt import (
+    PACKED_RESPONSE_FORMAT,
+    PROMPT_VERSION,
+    build_messages,
+    build_packed_messages,
+)
 from os.path import basename
 
 dotenv.load_dotenv()
 
 CLIENT = OpenAI()
 
+# Token budget of the manual sections packed into one request, 0 sends every section
+# in a request of its own
+PACK_TOKENS: int = int(os.getenv("PACK_TOKENS", "0"))
+
+# custom_id of a request packing sections first to last of a file
+PACK_ID = re.compile(r"(?P<filename>.+)-Pack-(?P<first>\d+)-(?P<last>\d+)")
+
 
 class Section(TypedDict):
     title: str
@@ -61,40 +78,244 @@ class BatchRequest(TypedDict):
     error: Optional[Dict]
 
 
-def prepare_batch_input(sections: List[Dict], law_text: str) -> str:
+def custom_id_filename(custom_id: str) -> str:
+    """Returns the source filename of a single section or packed request custom_id."""
+    return re.split(r"-(?:Section|Pack)-", custom_id, maxsplit=1)[0]
+
+
+def section_keys_path(batch_input_path: str) -> str:
+    """Returns the path of the file mapping the sections of a batch input to their keys."""
+    return f"{os.path.splitext(batch_input_path)[0]}.keys.json"
+
+
+def load_section_keys(content: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Parses a section keys file written by prepare_batch_input.
+
+    Args:
+        content (str): The JSON content of the file.
+
+    Returns:
+        Tuple[Dict[str, str], Dict[str, str]]: The completion key of every section by
+            custom_id, and the representative of every near-duplicate section. Files
+            written before near-duplicate detection hold only the keys.
+    """
+    data = json.loads(content)
+    if "keys" not in data:
+        return data, {}
+    return data["keys"], data.get("representatives", {})
+
+
+def completion_key(body: Dict, prompt_version: str = PROMPT_VERSION) -> str:
+    """
+    Hashes what determines the completion of a request.
+
+    Args:
+        body (Dict): The body of a single section or packed request.
+        prompt_version (str): The prompt version the messages were built with.
+
+    Returns:
+        str: The hex digest of the model, temperature, prompt version, messages and
+            response format, if the request has one.
+    """
+    payload = json.dumps(
+        {
+            "model": body["model"],
+            "temperature": body["temperature"],
+            "prompt_version": prompt_version,
+            "messages": body["messages"],
+            # Only packed requests have one, leaving the keys of others unchanged
+            **(
+                {"response_format": body["response_format"]}
+                if "response_format" in body
+                else {}
+            ),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def packed_section_key(pack_key: str, index: int) -> str:
+    """Returns the key of the answer to one section of a packed request."""
+    return hashlib.sha256(f"{pack_key}#{index}".encode("utf-8")).hexdigest()
+
+
+def section_index(custom_id: str) -> int:
+    """Returns the 1-based section index of a single section custom_id."""
+    return int(custom_id.rsplit("-Section-", 1)[1])
+
+
+def pack_sections(sections: List[Dict], token_budget: int) -> List[List[Dict]]:
+    """
+    Groups consecutive sections of the same file into packs up to a token budget.
+
+    Only sections with consecutive indexes are packed, so that the index range in
+    the custom_id of a pack covers exactly its sections.
+
+    Args:
+        sections (List[Dict]): List of sections with custom_id and content, in order.
+        token_budget (int): The estimated tokens of the sections a pack may hold.
+            A section over the budget gets a pack of its own, 0 disables packing.
+
+    Returns:
+        List[List[Dict]]: The packs in order.
+    """
+    packs: List[List[Dict]] = []
+    pack_tokens = 0
+    for item in sections:
+        tokens = math.ceil(
+            len(combine_title_content(item["section"])) / CHARS_PER_TOKEN
+        )
+        if (
+            packs
+            and token_budget > 0
+            and custom_id_filename(packs[-1][-1]["custom_id"])
+            == custom_id_filename(item["custom_id"])
+            and section_index(packs[-1][-1]["custom_id"]) + 1
+            == section_index(item["custom_id"])
+            and pack_tokens + tokens <= token_budget
+        ):
+            packs[-1].append(item)
+            pack_tokens += tokens
+        else:
+            packs.append([item])
+            pack_tokens = tokens
+    return packs
+
+
+def prepare_batch_input(
+    sections: List[Dict],
+    law_text: str,
+    law_index: LawIndex | None = None,
+    representatives: Dict[str, str] | None = None,
+    completion_keys: Dict[str, str] | None = None,
+) -> Tuple[str, int]:
     """
     Prepares a JSONL file for Batch API with all section prompts.
 
+    Requests whose answers are all in the completion cache, or that repeat an earlier
+    request of the batch, are left out of the file. So are near-duplicate sections,
+    which take the key of their representative. The completion key of every section
+    is written to the file at section_keys_path, so that merge_cached_completions can
+    fill in their answers.
+
+    With PACK_TOKENS set, consecutive sections of a file share a request whose
+    custom_id is "<filename>-Pack-<first>-<last>", see unpack_results. The answer to
+    each of its sections is keyed by the packed request and the section index, so
+    only the same pack reuses it.
+
     Args:
         sections (List[Dict]): List of sections with custom_id and content.
         law_text (str): The content of the law text.
+        law_index (LawIndex | None): If given, each prompt gets only the LAW_TOP_K
+            passages of the law most relevant to the section instead of law_text.
+        representatives (Dict[str, str] | None): The representative of every
+            near-duplicate section, see dedup.find_near_duplicates. A representative
+            comes before its members, in this or an earlier batch.
+        completion_keys (Dict[str, str] | None): The completion keys of the sections
+            of earlier batches, extended with the sections of this batch. Share it
+            between the batches of a run so members find the keys of representatives
+            in earlier batches.
 
     Returns:
-        str: The full path to the prepared batch input file.
+        Tuple[str, int]: The full path to the prepared batch input file and the
+            number of requests in it.
     """
     batch_inputs_dir = "batch_inputs"
     os.makedirs(batch_inputs_dir, exist_ok=True)
-    batch_input_filename = f"batch_input_{int(time.time())}.jsonl"
+    # Nanoseconds, so batches prepared within the same second get files of their own
+    batch_input_filename = f"batch_input_{time.time_ns()}.jsonl"
     full_path = os.path.join(batch_inputs_dir, batch_input_filename)
 
-    with open(full_path, "w", encoding="utf-8") as f:
-        for item in sections:
-            custom_id = item["custom_id"]
-            section = item["section"]
-            combined_content = combine_title_content(section)
-            prompt = create_prompt(law_text, combined_content)
-            request: BatchRequest = {
+    representatives = representatives or {}
+    completion_keys = completion_keys if completion_keys is not None else {}
+    section_keys: Dict[str, str] = {}
+    batch_representatives: Dict[str, str] = {}
+    to_pack: List[Dict] = []
+    custom_ids = {item["custom_id"] for item in sections}
+    for item in sections:
+        representative = representatives.get(item["custom_id"])
+        if representative in completion_keys or representative in custom_ids:
+            batch_representatives[item["custom_id"]] = representative
+        else:
+            to_pack.append(item)
+
+    # Packs are formed before the cache is consulted, so the same sections are packed
+    # the same way in every run with the same PACK_TOKENS, and each answer is cached
+    # under a key of the request that produced it
+    requests: List[BatchRequest] = []
+    request_keys: List[List[str]] = []
+    for pack in pack_sections(to_pack, PACK_TOKENS):
+        contents = [combine_title_content(item["section"]) for item in pack]
+        law_part = (
+            law_index.relevant_text("\n\n".join(contents))
+            if law_index is not None
+            else law_text
+        )
+        if len(pack) == 1:
+            custom_id = pack[0]["custom_id"]
+            body = {
+                "model": "gpt-4o-2024-08-06",
+                "messages": build_messages(law_part, contents[0], PROMPT_VERSION),
+                "temperature": 0.0,
+            }
+            keys = [completion_key(body)]
+        else:
+            indexes = [section_index(item["custom_id"]) for item in pack]
+            custom_id = (
+                f"{custom_id_filename(pack[0]['custom_id'])}"
+                f"-Pack-{indexes[0]}-{indexes[-1]}"
+            )
+            body = {
+                "model": "gpt-4o-2024-08-06",
+                "messages": build_packed_messages(
+                    law_part, list(zip(indexes, contents)), PROMPT_VERSION
+                ),
+                "temperature": 0.0,
+                "response_format": PACKED_RESPONSE_FORMAT,
+            }
+            pack_key = completion_key(body)
+            keys = [packed_section_key(pack_key, index) for index in indexes]
+        for item, key in zip(pack, keys):
+            section_keys[item["custom_id"]] = key
+            completion_keys[item["custom_id"]] = key
+        requests.append(
+            {
                 "custom_id": custom_id,
                 "method": "POST",
                 "url": "/v1/chat/completions",
-                "body": {
-                    "model": "gpt-4o-2024-08-06",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.0,
-                },
+                "body": body,
             }
+        )
+        request_keys.append(keys)
+    for member, representative in batch_representatives.items():
+        section_keys[member] = completion_keys[representative]
+        completion_keys[member] = section_keys[member]
+
+    # Requests whose answers are all cached, or that repeat an earlier request of the
+    # batch, are left out
+    cached = get_cached_completions(list(set(section_keys.values())))
+    seen: Set[str] = set(cached)
+    sent = 0
+    with open(full_path, "w", encoding="utf-8") as f:
+        for request, keys in zip(requests, request_keys):
+            if all(key in seen for key in keys):
+                continue
+            seen.update(keys)
+            sent += 1
             f.write(json.dumps(request) + "\n")
-    return full_path
+    if sent < len(requests) or batch_representatives:
+        print(
+            f"{len(requests) - sent} of {len(requests)} requests are answered from the "
+            f"completion cache or by a repeated request, and {len(batch_representatives)} "
+            f"of {len(sections)} sections by a near-duplicate"
+        )
+
+    with open(section_keys_path(full_path), "w", encoding="utf-8") as f:
+        json.dump({"keys": section_keys, "representatives": batch_representatives}, f)
+    return full_path, sent
 
 
 def upload_batch_file(batch_input_path: str) -> str:
@@ -175,8 +396,178 @@ def retrieve_batch_results(output_file_id: str) -> List[Dict]:
     return results
 
 
+def summarize_usage(results: List[Dict]) -> Dict[str, Dict[str, int]]:
+    """
+    Sums the token usage of batch results per source file.
+
+    cachedTokens are the prompt tokens served from the provider's prompt cache,
+    which are billed at a discount.
+
+    Args:
+        results (List[Dict]): List of response objects from the batch.
+
+    Returns:
+        Dict[str, Dict[str, int]]: promptTokens, cachedTokens and completionTokens
+            per source filename.
+    """
+    usage_per_file: Dict[str, Dict[str, int]] = {}
+    for result in results:
+        response = result.get("response") or {}
+        usage = (response.get("body") or {}).get("usage") or {}
+        filename = custom_id_filename(result.get("custom_id", ""))
+        totals = usage_per_file.setdefault(
+            filename, {"promptTokens": 0, "cachedTokens": 0, "completionTokens": 0}
+        )
+        totals["promptTokens"] += usage.get("prompt_tokens", 0)
+        totals["cachedTokens"] += (usage.get("prompt_tokens_details") or {}).get(
+            "cached_tokens", 0
+        )
+        totals["completionTokens"] += usage.get("completion_tokens", 0)
+    return usage_per_file
+
+
+def section_result(custom_id: str, content: str) -> Dict:
+    """Returns a result in the batch output format answering a single section."""
+    return {
+        "custom_id": custom_id,
+        "response": {"body": {"choices": [{"message": {"content": content}}]}},
+        "error": None,
+    }
+
+
+def completion_content(result: Dict) -> str | None:
+    """Returns the message content of a successful result, or None."""
+    if result.get("error"):
+        return None
+    response = result.get("response") or {}
+    if response.get("status_code", 200) != 200:
+        return None
+    try:
+        return response["body"]["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def unpack_results(results: List[Dict]) -> List[Dict]:
+    """
+    Fans the results of packed requests out to one result per section.
+
+    The analysis of each section in a packed answer becomes the message content of a
+    result with the custom_id "<filename>-Section-<index>". If the packed request
+    failed or its answer cannot be parsed, each of its sections gets the error, and a
+    section missing from the answer gets an error of its own.
+
+    Args:
+        results (List[Dict]): List of response objects from the batch.
+
+    Returns:
+        List[Dict]: The results with packed results replaced by section results.
+    """
+    unpacked: List[Dict] = []
+    for result in results:
+        match = PACK_ID.fullmatch(result.get("custom_id", ""))
+        if match is None:
+            unpacked.append(result)
+            continue
+
+        error = result.get("error")
+        analyses: Dict[int, str] = {}
+        if not error:
+            try:
+                content = result["response"]["body"]["choices"][0]["message"]["content"]
+                analyses = {
+                    int(answer["section"]): answer["analysis"]
+                    for answer in json.loads(content)["results"]
+                }
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                error = {"message": f"Could not parse the packed answer: {e!r}"}
+
+        for index in range(int(match["first"]), int(match["last"]) + 1):
+            custom_id = f"{match['filename']}-Section-{index}"
+            if error:
+                unpacked.append({"custom_id": custom_id, "error": error})
+            elif index not in analyses:
+                unpacked.append(
+                    {
+                        "custom_id": custom_id,
+                        "error": {
+                            "message": f"No answer for section {index} in {match[0]}"
+                        },
+                    }
+                )
+            else:
+                unpacked.append(section_result(custom_id, analyses[index]))
+    return unpacked
+
+
+def merge_cached_completions(
+    results: List[Dict],
+    section_keys: Dict[str, str],
+    representatives: Dict[str, str] | None = None,
+) -> List[Dict]:
+    """
+    Stores the completions of a batch in the completion cache and adds the sections
+    that were left out of the batch.
+
+    Args:
+        results (List[Dict]): The section results of the batch, see unpack_results.
+        section_keys (Dict[str, str]): The completion key of every section of the
+            batch input by custom_id, see prepare_batch_input.
+        representatives (Dict[str, str] | None): The representative of every
+            near-duplicate section of the batch input.
+
+    Returns:
+        List[Dict]: The results of all sections in section order. A section without
+            a result or a cached completion gets an error, and a near-duplicate
+            section the custom_id of its representative under "representative".
+    """
+    representatives = representatives or {}
+    completions: Dict[str, str] = {}
+    for result in results:
+        key = section_keys.get(result.get("custom_id", ""))
+        content = completion_content(result)
+        if key is not None and content is not None:
+            completions[key] = content
+    put_cached_completions(completions)
+
+    answered = {result.get("custom_id") for result in results}
+    missing = [custom_id for custom_id in section_keys if custom_id not in answered]
+    cached = get_cached_completions([section_keys[custom_id] for custom_id in missing])
+    merged = list(results)
+    answered_from_cache = 0
+    for custom_id in missing:
+        content = cached.get(section_keys[custom_id])
+        if content is not None:
+            answered_from_cache += 1
+            merged.append(section_result(custom_id, content))
+        else:
+            merged.append(
+                {
+                    "custom_id": custom_id,
+                    "error": {"message": "No completion in the batch or the cache"},
+                }
+            )
+        if custom_id in representatives:
+            merged[-1]["representative"] = representatives[custom_id]
+    if missing:
+        print(
+            f"{answered_from_cache} of {len(missing)} left out sections answered from cache"
+        )
+    return sorted(
+        merged,
+        key=lambda result: (
+            custom_id_filename(result["custom_id"]),
+            section_index(result["custom_id"]),
+        ),
+    )
+
+
 def process_batch_results(
-    results: List[Dict], filenames: List[str], sections: Dict[str, Section]
+    results: List[Dict],
+    filenames: List[str],
+    sections: Dict[str, Section],
+    section_keys: Dict[str, str] | None = None,
+    representatives: Dict[str, str] | None = None,
 ) -> List[str]:
     """
     Processes the batch results and compiles the analysis content.
@@ -185,30 +576,43 @@ def process_batch_results(
         results (List[Dict]): List of response objects from the batch.
         filenames (List[str]): List of source filenames for reference.
         sections (Dict[str, Section]): Dictionary mapping custom_ids to sections.
+        section_keys (Dict[str, str] | None): The completion key of every section of
+            the batch input, if it was prepared with the completion cache.
+        representatives (Dict[str, str] | None): The representative of every
+            near-duplicate section of the batch input. Their analyses are flagged.
 
     Returns:
         List[str]: List of compiled analysis contents per file.
     """
     analysis_dict: Dict[str, List[str]] = {basename(fn): [] for fn in filenames}
 
+    results = unpack_results(results)
+    if section_keys is not None:
+        results = merge_cached_completions(results, section_keys, representatives)
+
     for result in results:
         custom_id = result.get("custom_id")
         response = result.get("response")
         error = result.get("error")
 
         if error:
-            filename = custom_id.split("-Section-")[0]
+            filename = custom_id_filename(custom_id)
             analysis_dict[filename].append(f"\nError in {custom_id}: {error}\n")
             continue
 
         content = response["body"]["choices"][0]["message"]["content"]
         combined_content = combine_title_content(sections[custom_id])
+        heading = (
+            f"SUGGESTED CHANGES (near-duplicate of {result['representative']}):"
+            if result.get("representative")
+            else "SUGGESTED CHANGES:"
+        )
         analysis_result = (
             "\n\n====================================\n\n"
-            f"\nTEXT SECTION:\n{combined_content}\n\nSUGGESTED CHANGES:\n"
+            f"\nTEXT SECTION:\n{combined_content}\n\n{heading}\n"
             f"{content}"
         )
-        filename = custom_id.split("-Section-")[0]
+        filename = custom_id_filename(custom_id)
         analysis_dict[filename].append(analysis_result)
 
     # Compile analysis content per file
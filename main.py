@@ -3,17 +3,33 @@ import json
 import os
 import time
 import tempfile
-from typing import Dict, List
+from typing import Dict, List, Set
 
+from corpus import Corpus
 from llm import (
     create_batch_job,
+    custom_id_filename,
+    load_section_keys,
+    section_keys_path,
     poll_batch_status,
     process_batch_results,
     retrieve_batch_results,
+    summarize_usage,
     upload_batch_file,
 )
-from helpers import check_args_and_env_vars, update_state
-from storage import list_files_in_dir, download_file, upload_file_to_bucket
+from helpers import (
+    blob_fingerprint,
+    check_args_and_env_vars,
+    select_pending,
+    update_state,
+    update_states,
+)
+from storage import (
+    iter_blobs,
+    download_file,
+    upload_file_to_bucket,
+    upload_many,
+)
 
 
 def main() -> None:
@@ -24,23 +40,52 @@ def main() -> None:
             "ANALYSIS_DIR",
             "COMPLETIONS_FILE",
         ],
+        optional_args=["--corpus"],
+        flag_args=["--force"],
     )
     bucket_name: str = config["BUCKET_NAME"]
+    # With --corpus NAME the analysed sections are looked up in the corpus
+    corpus = (
+        Corpus.download(bucket_name, config["CORPUS"]) if "CORPUS" in config else None
+    )
     batch_inputs_prefix: str = "batch_inputs/"
 
     # Retrieve prepared batch input files from the bucket
-    batch_input_files = list_files_in_dir(
-        bucket_name=bucket_name,
-        prefix=batch_inputs_prefix,
+    batch_input_blobs = list(
+        iter_blobs(bucket_name, batch_inputs_prefix, suffix=".jsonl")
     )
 
-    if not batch_input_files:
+    if not batch_input_blobs:
         print("No prepared batch input files found in the bucket.")
         return
 
-    prepared_batches: Dict[str, List[str]] = {}
+    # Skip batch input files that were already submitted unless they changed or failed
+    pending_blobs = select_pending(
+        batch_input_blobs,
+        done_key="batchSubmittedAt",
+        fingerprint_key="batchInputFingerprint",
+        failed_key="batchFailedAt",
+        force=config["FORCE"],
+    )
 
-    for batch_input_file in batch_input_files:
+    keys_blob_names = {
+        blob.name
+        for blob in iter_blobs(bucket_name, batch_inputs_prefix, suffix=".keys.json")
+    }
+
+    prepared_batches: Dict[str, List[str]] = {}
+    batch_input_files: Dict[str, str] = {}
+    batch_section_keys: Dict[str, Dict[str, str] | None] = {}
+    batch_representatives: Dict[str, Dict[str, str]] = {}
+    # Batches with near-duplicates of sections in earlier batches, written only once
+    # the earlier batches are, so the completions of the representatives are cached
+    dependent_batches: Set[str] = set()
+    # Fingerprints of the batches answered entirely from the completion cache that
+    # wait for earlier batches, by the name of their batch input file
+    cached_batches: Dict[str, str] = {}
+
+    for batch_input_blob in pending_blobs:
+        batch_input_file = batch_input_blob.name
         try:
             # Derive the batch_input_file_id from the filename
             batch_input_file_id = os.path.splitext(os.path.basename(batch_input_file))[
@@ -48,9 +93,73 @@ def main() -> None:
             ]
 
             # Download the batch input file content
+            file_content = download_file(bucket_name, batch_input_file)
+
+            # Parse the JSONL content
+            batch_requests = [
+                json.loads(line) for line in file_content.splitlines() if line.strip()
+            ]
+
+            # The completion keys of all sections, including those left out of the
+            # batch because the completion cache or a near-duplicate answers them
+            keys_blob_name = section_keys_path(batch_input_file)
+            section_keys: Dict[str, str] | None = None
+            representatives: Dict[str, str] = {}
+            if keys_blob_name in keys_blob_names:
+                section_keys, representatives = load_section_keys(
+                    download_file(bucket_name, keys_blob_name)
+                )
+            depends_on_earlier = any(
+                representative not in section_keys
+                for representative in representatives.values()
+            )
+
+            # Extract unique filenames from custom_ids
+            batch_filenames = list(
+                {custom_id_filename(req["custom_id"]) for req in batch_requests}
+                | {custom_id_filename(custom_id) for custom_id in section_keys or {}}
+            )
+
+            if not batch_filenames:
+                print(f"No batch filenames found in {batch_input_file}. Skipping.")
+                continue
+
+            if not batch_requests and depends_on_earlier and prepared_batches:
+                print(
+                    f"All sections of {batch_input_file} are answered from cache once "
+                    "the earlier batches complete."
+                )
+                prepared_batches[batch_input_file] = batch_filenames
+                batch_section_keys[batch_input_file] = section_keys
+                batch_representatives[batch_input_file] = representatives
+                batch_input_files[batch_input_file] = batch_input_file
+                dependent_batches.add(batch_input_file)
+                cached_batches[batch_input_file] = blob_fingerprint(batch_input_blob)
+                continue
+
+            if not batch_requests:
+                print(f"All sections of {batch_input_file} are answered from cache.")
+                write_analysis(
+                    bucket_name,
+                    batch_filenames,
+                    [],
+                    corpus,
+                    section_keys,
+                    representatives,
+                )
+                update_state(
+                    batch_input_file,
+                    {
+                        "batchSubmittedAt": datetime.datetime.now(
+                            datetime.timezone.utc
+                        ).isoformat(),
+                        "batchInputFingerprint": blob_fingerprint(batch_input_blob),
+                    },
+                )
+                continue
+
             with tempfile.NamedTemporaryFile(delete=False) as temp_file:
                 temp_file_path = temp_file.name
-                file_content = download_file(bucket_name, batch_input_file)
                 temp_file.write(file_content.encode("utf-8"))
 
             # Upload the batch input file to OpenAI
@@ -65,27 +174,32 @@ def main() -> None:
                 f"Batch job {batch_id} created for input file ID {batch_input_file_id}."
             )
 
-            # Parse the JSONL content
-            batch_requests = [
-                json.loads(line) for line in file_content.splitlines() if line.strip()
-            ]
-
-            # Extract unique filenames from custom_ids
-            batch_filenames = list(
-                {req["custom_id"].split("-Section-")[0] for req in batch_requests}
-            )
-
-            if not batch_filenames:
-                print(f"No batch filenames found in {batch_input_file}. Skipping.")
-                continue
-
             prepared_batches[batch_id] = batch_filenames
+            batch_section_keys[batch_id] = section_keys
+            batch_representatives[batch_id] = representatives
+            batch_input_files[batch_id] = batch_input_file
+            if depends_on_earlier:
+                dependent_batches.add(batch_id)
+            update_state(
+                batch_input_file,
+                {
+                    "batchSubmittedAt": datetime.datetime.now(
+                        datetime.timezone.utc
+                    ).isoformat(),
+                    "batchInputFingerprint": blob_fingerprint(batch_input_blob),
+                    "batchJobId": batch_id,
+                },
+            )
 
         except Exception as e:
             print(f"Failed to process batch input file {batch_input_file}: {e}")
             fail_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            for filename in prepared_batches.get(batch_input_file_id, []):
-                update_state(filename, {"batchProcessingFailedAt": fail_time})
+            update_states(
+                {
+                    filename: {"batchProcessingFailedAt": fail_time}
+                    for filename in prepared_batches.get(batch_input_file_id, [])
+                }
+            )
 
     if not prepared_batches:
         print("No valid prepared batches to process.")
@@ -101,17 +215,64 @@ def main() -> None:
     while pending_batches:
         for batch_id in list(pending_batches.keys()):
             try:
+                waiting = (
+                    batch_id in dependent_batches
+                    and next(iter(pending_batches)) != batch_id
+                )
+                if batch_id in cached_batches:
+                    if waiting:
+                        continue
+                    pending_batches.pop(batch_id)
+                    write_analysis(
+                        bucket_name,
+                        prepared_batches[batch_id],
+                        [],
+                        corpus,
+                        batch_section_keys[batch_id],
+                        batch_representatives[batch_id],
+                    )
+                    update_state(
+                        batch_id,
+                        {
+                            "batchSubmittedAt": datetime.datetime.now(
+                                datetime.timezone.utc
+                            ).isoformat(),
+                            "batchInputFingerprint": cached_batches[batch_id],
+                        },
+                    )
+                    continue
                 batch = poll_batch_status(batch_id)
-                if batch.status == "completed":
+                if batch.status == "completed" and waiting:
+                    print(
+                        f"Batch job {batch_id} completed, waiting for the earlier "
+                        "batches with the representatives of its near-duplicates."
+                    )
+                elif batch.status == "completed":
                     print(f"Batch job {batch_id} completed.")
                     completed_batches[batch_id] = pending_batches.pop(batch_id)
-                    process_batch(batch_id, completed_batches[batch_id], bucket_name)
+                    process_batch(
+                        batch_id,
+                        completed_batches[batch_id],
+                        bucket_name,
+                        batch_input_files.get(batch_id),
+                        corpus,
+                        batch_section_keys.get(batch_id),
+                        batch_representatives.get(batch_id),
+                    )
                 elif batch.status == "failed":
                     print(f"Batch job {batch_id} failed.")
                     failed_batches[batch_id] = pending_batches.pop(batch_id)
                     fail_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
-                    for filename in failed_batches[batch_id]:
-                        update_state(filename, {"batchProcessingFailedAt": fail_time})
+                    update_states(
+                        {
+                            filename: {"batchProcessingFailedAt": fail_time}
+                            for filename in failed_batches[batch_id]
+                        }
+                    )
+                    if batch_id in batch_input_files:
+                        update_state(
+                            batch_input_files[batch_id], {"batchFailedAt": fail_time}
+                        )
                 else:
                     print(f"Batch job {batch_id} status: {batch.status}.")
             except Exception as e:
@@ -127,15 +288,99 @@ def main() -> None:
     )
 
 
-def process_batch(batch_id: str, batch_filenames: List[str], bucket_name: str) -> None:
+def write_analysis(
+    bucket_name: str,
+    batch_filenames: List[str],
+    results: List[Dict],
+    corpus: Corpus | None = None,
+    section_keys: Dict[str, str] | None = None,
+    representatives: Dict[str, str] | None = None,
+    usage: Dict[str, Dict[str, int]] | None = None,
+) -> None:
+    """
+    Compile the analysis of each file of a batch, upload it and record its completion.
+
+    Args:
+        bucket_name (str): The bucket the analyses are uploaded to.
+        batch_filenames (List[str]): The section files of the batch.
+        results (List[Dict]): The batch results, empty if the completion cache
+            answers every section.
+        corpus (Corpus | None): The corpus to look the sections up in.
+        section_keys (Dict[str, str] | None): The completion key of every section of
+            the batch input, if it was prepared with the completion cache.
+        representatives (Dict[str, str] | None): The representative of every
+            near-duplicate section of the batch input.
+        usage (Dict[str, Dict[str, int]]): The token usage per file to record.
+    """
+    analysis_content = process_batch_results(
+        results,
+        batch_filenames,
+        corpus if corpus is not None else {},
+        section_keys,
+        representatives,
+    )
+
+    analysis_uploads = []
+    for filename in batch_filenames:
+        destination_blob_name: str = (
+            f"analysis/{os.path.splitext(os.path.basename(filename))[0]}.txt"
+        )
+
+        file_analysis = "\n".join(
+            [
+                section_analysis
+                for section_analysis in analysis_content
+                if section_analysis.startswith(
+                    f"Source File: {os.path.basename(filename)}"
+                )
+            ]
+        )
+
+        analysis_uploads.append(
+            {
+                "destination_blob_name": destination_blob_name,
+                "file_contents": file_analysis,
+            }
+        )
+
+    upload_many(bucket_name, analysis_uploads)
+
+    completion_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    update_states(
+        {
+            filename: {
+                "batchProcessingCompletedAt": completion_time,
+                **(usage or {}).get(os.path.basename(filename), {}),
+            }
+            for filename in batch_filenames
+        }
+    )
+    print(f"Analysis complete for {', '.join(batch_filenames)}.")
+
+
+def process_batch(
+    batch_id: str,
+    batch_filenames: List[str],
+    bucket_name: str,
+    batch_input_file: str | None = None,
+    corpus: Corpus | None = None,
+    section_keys: Dict[str, str] | None = None,
+    representatives: Dict[str, str] | None = None,
+) -> None:
     try:
         batch = poll_batch_status(batch_id)
         output_file_id = batch.output_file_id
         if not output_file_id:
             print(f"No output file for batch job {batch_id}.")
             fail_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            for filename in batch_filenames:
-                update_state(filename, {"batchProcessingFailedAt": fail_time})
+            update_states(
+                {
+                    filename: {"batchProcessingFailedAt": fail_time}
+                    for filename in batch_filenames
+                }
+            )
+            if batch_input_file:
+                update_state(batch_input_file, {"batchFailedAt": fail_time})
             return
 
         results = retrieve_batch_results(output_file_id)
@@ -153,40 +398,36 @@ def process_batch(batch_id: str, batch_filenames: List[str], bucket_name: str) -
         )
         print(f"Batch output file uploaded to {batch_output_blob_name}")
 
-        analysis_content = process_batch_results(results, batch_filenames, {})
-
-        for filename in batch_filenames:
-            destination_blob_name: str = (
-                f"analysis/{os.path.splitext(os.path.basename(filename))[0]}.txt"
-            )
-
-            file_analysis = "\n".join(
-                [
-                    section_analysis
-                    for section_analysis in analysis_content
-                    if section_analysis.startswith(
-                        f"Source File: {os.path.basename(filename)}"
-                    )
-                ]
-            )
-
-            upload_file_to_bucket(
-                bucket_name=bucket_name,
-                destination_blob_name=destination_blob_name,
-                file_contents=file_analysis,
-            )
-            print(
-                f"Analysis complete for {filename}. Uploaded to {destination_blob_name}"
-            )
+        usage = summarize_usage(results)
+        prompt_tokens = sum(totals["promptTokens"] for totals in usage.values())
+        cached_tokens = sum(totals["cachedTokens"] for totals in usage.values())
+        print(
+            f"Batch {batch_id} used {prompt_tokens} prompt tokens, {cached_tokens} of them "
+            f"cached ({cached_tokens / max(prompt_tokens, 1):.0%}), and "
+            f"{sum(totals['completionTokens'] for totals in usage.values())} completion tokens"
+        )
 
-            completion_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            update_state(filename, {"batchProcessingCompletedAt": completion_time})
+        write_analysis(
+            bucket_name,
+            batch_filenames,
+            results,
+            corpus,
+            section_keys,
+            representatives,
+            usage,
+        )
 
     except Exception as e:
         print(f"An error occurred while processing batch {batch_id}: {e}")
         fail_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
-        for filename in batch_filenames:
-            update_state(filename, {"batchProcessingFailedAt": fail_time})
+        update_states(
+            {
+                filename: {"batchProcessingFailedAt": fail_time}
+                for filename in batch_filenames
+            }
+        )
+        if batch_input_file:
+            update_state(batch_input_file, {"batchFailedAt": fail_time})
 
 
 if __name__ == "__main__":
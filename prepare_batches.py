@@ -5,9 +5,20 @@ from posixpath import basename
 from typing import Dict, List, TypedDict
 
 
-from llm import prepare_batch_input, upload_batch_file
-from helpers import check_args_and_env_vars, update_state
-from storage import download_file, list_files_in_dir, upload_file_to_bucket
+from corpus import Corpus
+from dedup import NEAR_DUPLICATE_THRESHOLD, find_near_duplicates
+from law_index import LAW_TOP_K, load_law_index
+from llm import prepare_batch_input, section_keys_path, upload_batch_file
+from helpers import (
+    blob_fingerprint,
+    check_args_and_env_vars,
+    combine_title_content,
+    select_pending,
+    update_state,
+    update_states,
+)
+from prompt import PROMPT_VERSION
+from storage import download_many, iter_blobs, upload_file_to_bucket
 
 
 class Section(TypedDict):
@@ -15,6 +26,15 @@ class Section(TypedDict):
     content: List[str]
 
 
+def load_sections(
+    corpus: Corpus | None, filename: str, sections_contents: str | None
+) -> List[Section]:
+    """Read the sections of a file from the corpus, or parse its downloaded content."""
+    if corpus is not None:
+        return corpus.sections(os.path.splitext(basename(filename))[0])
+    return json.loads(sections_contents)
+
+
 def prepare_batches() -> Dict[str, List[Dict[str, str]]]:
     config = check_args_and_env_vars(
         required_env_vars=[
@@ -24,23 +44,71 @@ def prepare_batches() -> Dict[str, List[Dict[str, str]]]:
             "ANALYSIS_DIR",
             "COMPLETIONS_FILE",
         ],
+        optional_args=["--corpus"],
+        flag_args=["--force"],
     )
 
     bucket_name = config["BUCKET_NAME"]
     json_sections_dir = config["SECTIONS_JSON_DIR"]
+    # With --corpus NAME the sections are read from one corpus file instead of a blob
+    # per card
+    corpus = (
+        Corpus.download(bucket_name, config["CORPUS"]) if "CORPUS" in config else None
+    )
 
     with open("new-construction-law.txt", "r", encoding="utf-8") as file:
         new_construction_law: str = file.read()
 
     if not new_construction_law:
         raise ValueError("new-construction-law.txt is empty")
-
-    section_filenames = list_files_in_dir(
-        bucket_name=bucket_name,
-        prefix=json_sections_dir,
+    law_index = load_law_index(new_construction_law) if LAW_TOP_K > 0 else None
+
+    section_files = select_pending(
+        (
+            corpus.blob_infos()
+            if corpus is not None
+            else iter_blobs(bucket_name, json_sections_dir, suffix=".json")
+        ),
+        done_key="batchPreparedAt",
+        fingerprint_key="sectionsFingerprint",
+        failed_key="batchPrepareFailedAt",
+        force=config["FORCE"],
     )
-
-    json_filenames = [fn for fn in section_filenames if fn.endswith(".json")]
+    fingerprints = {blob.name: blob_fingerprint(blob) for blob in section_files}
+    json_filenames = list(fingerprints)
+
+    # With NEAR_DUPLICATE_THRESHOLD set, all sections are read up front and only the
+    # representative of each group of near-duplicates is sent
+    contents_by_filename: Dict[str, str | None] = {}
+    representatives: Dict[str, str] = {}
+    if NEAR_DUPLICATE_THRESHOLD > 0:
+        contents_by_filename = dict(
+            zip(
+                json_filenames,
+                (
+                    [None] * len(json_filenames)
+                    if corpus is not None
+                    else download_many(bucket_name, json_filenames)
+                ),
+            )
+        )
+        texts: Dict[str, str] = {}
+        for filename, sections_contents in contents_by_filename.items():
+            try:
+                sections = load_sections(corpus, filename, sections_contents)
+            except json.JSONDecodeError:
+                # Reported when the batch of the file is prepared
+                continue
+            for index, section in enumerate(sections, start=1):
+                texts[f"{basename(filename)}-Section-{index}"] = combine_title_content(
+                    section
+                )
+        representatives = find_near_duplicates(texts, NEAR_DUPLICATE_THRESHOLD)
+        print(
+            f"{len(representatives)} of {len(texts)} sections are near-duplicates "
+            "answered by a representative"
+        )
+    completion_keys: Dict[str, str] = {}
 
     batch_size = 10
     total_batches = (len(json_filenames) + batch_size - 1) // batch_size
@@ -56,25 +124,41 @@ def prepare_batches() -> Dict[str, List[Dict[str, str]]]:
         )
 
         start_time_iso = batch_start_time.isoformat()
-        for filename in batch_filenames:
-            update_state(filename, {"batchProcessingStartAt": start_time_iso})
+        update_states(
+            {
+                filename: {"batchProcessingStartAt": start_time_iso}
+                for filename in batch_filenames
+            }
+        )
 
         batch_input_sections = []
         sections_dict: Dict[str, Section] = {}
 
-        for filename in batch_filenames:
-            source_blob_name: str = filename
-
-            sections_contents = download_file(bucket_name, source_blob_name)
+        if contents_by_filename:
+            batch_contents = [contents_by_filename[name] for name in batch_filenames]
+        elif corpus is not None:
+            batch_contents = [None] * len(batch_filenames)
+        else:
+            batch_contents = download_many(bucket_name, batch_filenames)
+        prepared_filenames: List[str] = []
 
+        for filename, sections_contents in zip(batch_filenames, batch_contents):
             try:
-                sections: List[Section] = json.loads(sections_contents)
+                sections = load_sections(corpus, filename, sections_contents)
             except json.JSONDecodeError as e:
                 print(f"Error decoding JSON from {filename}: {e}")
                 fail_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
-                update_state(filename, {"batchProcessingFailedAt": fail_time})
+                update_state(
+                    filename,
+                    {
+                        "batchProcessingFailedAt": fail_time,
+                        "batchPrepareFailedAt": fail_time,
+                    },
+                )
                 continue
 
+            prepared_filenames.append(filename)
+
             for index, section in enumerate(sections, start=1):
                 custom_id = f"{basename(filename)}-Section-{index}"
                 sections_dict[custom_id] = section
@@ -85,14 +169,32 @@ def prepare_batches() -> Dict[str, List[Dict[str, str]]]:
         if not batch_input_sections:
             print("No valid sections to process in this batch.")
             fail_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            for filename in batch_filenames:
-                update_state(filename, {"batchProcessingFailedAt": fail_time})
+            update_states(
+                {
+                    filename: {
+                        "batchProcessingFailedAt": fail_time,
+                        "batchPrepareFailedAt": fail_time,
+                    }
+                    for filename in batch_filenames
+                }
+            )
             continue
 
-        batch_input_path = prepare_batch_input(
-            batch_input_sections, new_construction_law
+        batch_input_path, request_count = prepare_batch_input(
+            batch_input_sections,
+            new_construction_law,
+            law_index,
+            representatives,
+            completion_keys,
         )
 
+        # The section keys go first, so a batch input is never listed without them
+        keys_path = section_keys_path(batch_input_path)
+        upload_file_to_bucket(
+            bucket_name=bucket_name,
+            destination_blob_name=f"batch_inputs/{os.path.basename(keys_path)}",
+            source_file_path=keys_path,
+        )
         batch_input_blob_name = f"batch_inputs/{os.path.basename(batch_input_path)}"
         upload_file_to_bucket(
             bucket_name=bucket_name,
@@ -101,10 +203,29 @@ def prepare_batches() -> Dict[str, List[Dict[str, str]]]:
         )
         print(f"Batch input file uploaded to {batch_input_blob_name}")
 
-        batch_input_file_id = upload_batch_file(batch_input_path)
+        if request_count:
+            batch_input_file_id = upload_batch_file(batch_input_path)
+        else:
+            # Every section is answered from the completion cache, main.py finishes
+            # the batch without sending it
+            batch_input_file_id = os.path.splitext(os.path.basename(batch_input_path))[
+                0
+            ]
 
         prepared_batches[batch_input_file_id] = batch_filenames
 
+        prepared_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        update_states(
+            {
+                filename: {
+                    "batchPreparedAt": prepared_time,
+                    "sectionsFingerprint": fingerprints[filename],
+                    "promptVersion": PROMPT_VERSION,
+                }
+                for filename in prepared_filenames
+            }
+        )
+
     return prepared_batches
 
 
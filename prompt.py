@@ -1,15 +1,17 @@
-def create_prompt(new_law_part: str, old_manual_content: str) -> str:
-    return f"""
-You are given an update Finnish construction law and a section of an existing construction manual. 
-You task is to compare the new construction law text against an existing construction instruction manual to identify sections of the manual that need to be updated. Both documents are in Finnish.
+import os
+from typing import Any, Callable, Dict, List, Tuple
 
-New construction law:
-    {new_law_part}
+import dotenv
 
-Old construction manual section:
-  {old_manual_content}
+dotenv.load_dotenv()
+
+# The prompt version batch requests are built with, see PROMPT_VERSIONS
+PROMPT_VERSION: str = os.getenv("PROMPT_VERSION", "law-inline-v1")
+
+INSTRUCTIONS: str = """You are given an update Finnish construction law and a section of an existing construction manual. 
+You task is to compare the new construction law text against an existing construction instruction manual to identify sections of the manual that need to be updated. Both documents are in Finnish."""
 
-Please follow these steps to complete the task:
+STEPS: str = """Please follow these steps to complete the task:
 1. Carefully read and analyze the new construction law text.
 2. Review the old construction instruction manual section thoroughly. Pay attention to anything that no longer comply with the new construction law text.
 3. Compare the content of the old manual with the new law requirements. Look for discrepancies, outdated information, or parts that no longer comply with the new regulations.
@@ -19,9 +21,9 @@ Please follow these steps to complete the task:
    c. An explanation of why it needs to be updated, referencing the specific part of the new law that necessitates the change
    d. A reference to the relevant section in the new law
 
-Remember that all text in both the new law and the old manual is in Finnish. Provide your analysis and report in Finnish as well. If you don't find any outdated sections, return the following: "Ei päivitettävää".
+Remember that all text in both the new law and the old manual is in Finnish. Provide your analysis and report in Finnish as well. If you don't find any outdated sections, return the following: "Ei päivitettävää"."""
 
-Below you will find examples of the updates delimited by "####"
+EXAMPLES: str = """Below you will find examples of the updates delimited by "####"
 
 Example 1:
 
@@ -91,7 +93,149 @@ Uuden lain 83 §:n mukaan suunnittelijan on osoitettava pätevyytensä tavanomai
 d.Viittaus uuteen lakiin:
 83 § Suunnittelijoiden kelpoisuusvaatimukset
 
-####
+####"""
+
+
+def create_prompt(new_law_part: str, old_manual_content: str) -> str:
+    return f"""
+{INSTRUCTIONS}
+
+New construction law:
+    {new_law_part}
+
+Old construction manual section:
+  {old_manual_content}
+
+{STEPS}
+
+{EXAMPLES}
 
 Begin your analysis now, and present your findings as instructed above.
 """
+
+
+def law_inline_messages(
+    new_law_part: str, old_manual_content: str
+) -> List[Dict[str, str]]:
+    """The original prompt, with the manual section between the law and the examples."""
+    return [
+        {"role": "user", "content": create_prompt(new_law_part, old_manual_content)}
+    ]
+
+
+def static_prefix_messages(
+    new_law_part: str, old_manual_content: str
+) -> List[Dict[str, str]]:
+    """
+    The prompt with everything but the manual section in the system message.
+
+    The instructions and examples come first and the law after them, so requests
+    share a prefix that the provider can cache even when the law passages differ.
+    """
+    system = f"""{INSTRUCTIONS}
+
+{STEPS}
+
+{EXAMPLES}
+
+The old construction manual section is given in the user message. Analyse it and present your findings as instructed above.
+
+New construction law:
+{new_law_part}
+"""
+    return [
+        {"role": "system", "content": system},
+        {
+            "role": "user",
+            "content": f"Old construction manual section:\n{old_manual_content}",
+        },
+    ]
+
+
+# Prompt versions by name. Add a new version instead of editing one in use, so results
+# stay traceable to the prompt that produced them.
+PROMPT_VERSIONS: Dict[str, Callable[[str, str], List[Dict[str, str]]]] = {
+    "law-inline-v1": law_inline_messages,
+    "static-prefix-v2": static_prefix_messages,
+}
+
+
+def build_messages(
+    new_law_part: str, old_manual_content: str, version: str = PROMPT_VERSION
+) -> List[Dict[str, str]]:
+    """
+    Build the chat messages of a request with a named prompt version.
+
+    Args:
+        new_law_part (str): The law text, or the passages of it relevant to the section.
+        old_manual_content (str): The title and content of the manual section.
+        version (str): A key of PROMPT_VERSIONS.
+
+    Returns:
+        List[Dict[str, str]]: The messages with their roles and contents.
+    """
+    if version not in PROMPT_VERSIONS:
+        raise ValueError(
+            f"Unknown prompt version {version!r}, expected one of {', '.join(PROMPT_VERSIONS)}"
+        )
+    return PROMPT_VERSIONS[version](new_law_part, old_manual_content)
+
+
+# Appended to the manual sections of a packed request
+PACKED_ANSWER_INSTRUCTIONS: str = (
+    """The old construction manual content above consists of several sections, each starting with a line "### Section N". Analyse each section separately as instructed above. Answer with one result per section, holding the number N of the section in "section" and your findings for that section alone, formatted as instructed above, in "analysis"."""
+)
+
+# Structured output format of a packed request
+PACKED_RESPONSE_FORMAT: Dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "section_results",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "section": {"type": "integer"},
+                            "analysis": {"type": "string"},
+                        },
+                        "required": ["section", "analysis"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def build_packed_messages(
+    new_law_part: str,
+    old_manual_sections: List[Tuple[int, str]],
+    version: str = PROMPT_VERSION,
+) -> List[Dict[str, str]]:
+    """
+    Build the chat messages of a request that analyses several sections at once.
+
+    Args:
+        new_law_part (str): The law text, or the passages of it relevant to the sections.
+        old_manual_sections (List[Tuple[int, str]]): The index and the title and
+            content of each manual section.
+        version (str): A key of PROMPT_VERSIONS.
+
+    Returns:
+        List[Dict[str, str]]: The messages with their roles and contents, to be sent
+            with PACKED_RESPONSE_FORMAT.
+    """
+    manual_content = "\n\n".join(
+        f"### Section {index}\n{content}" for index, content in old_manual_sections
+    )
+    messages = build_messages(new_law_part, manual_content, version)
+    messages[-1]["content"] += f"\n\n{PACKED_ANSWER_INSTRUCTIONS}"
+    return messages
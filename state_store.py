@@ -0,0 +1,226 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+import dotenv
+
+dotenv.load_dotenv()
+
+STATE_DB: str = os.getenv("STATE_DB", "state.db")
+# Legacy state file, imported once into the database
+STATE_JSON: str = "state.json"
+
+_local = threading.local()
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS state (
+    file TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (file, key)
+);
+CREATE INDEX IF NOT EXISTS state_key_value ON state (key, value);
+CREATE TABLE IF NOT EXISTS layout_cache (
+    content_hash TEXT NOT NULL,
+    processor_version TEXT NOT NULL,
+    layout_blob TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (content_hash, processor_version)
+);
+CREATE TABLE IF NOT EXISTS completion_cache (
+    prompt_hash TEXT PRIMARY KEY,
+    completion TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def get_connection() -> sqlite3.Connection:
+    """Return this thread's connection to the state database, creating it on first use."""
+    connection: sqlite3.Connection | None = getattr(_local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(STATE_DB, timeout=30)
+        # WAL lets readers run alongside a writer and serializes concurrent writers
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        _import_state_json(connection)
+        _local.connection = connection
+    return connection
+
+
+def _import_state_json(connection: sqlite3.Connection) -> None:
+    """Import the legacy state.json into the database once."""
+    with connection:
+        # Take the write lock up front so that only one process imports
+        connection.execute("BEGIN IMMEDIATE")
+        imported = connection.execute(
+            "SELECT value FROM meta WHERE name = 'state_json_imported_at'"
+        ).fetchone()
+        if imported or not os.path.exists(STATE_JSON):
+            return
+        try:
+            with open(STATE_JSON, "r") as f:
+                legacy_state: Dict[str, Dict[str, Any]] = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Warning: {STATE_JSON} is not a valid JSON. Skipping import.")
+            legacy_state = {}
+
+        now = datetime.now(timezone.utc).isoformat()
+        connection.executemany(
+            "INSERT OR IGNORE INTO state (file, key, value, updated_at) VALUES (?, ?, ?, ?)",
+            [
+                (file, key, json.dumps(value), now)
+                for file, data in legacy_state.items()
+                for key, value in data.items()
+            ],
+        )
+        connection.execute(
+            "INSERT INTO meta (name, value) VALUES ('state_json_imported_at', ?)",
+            (now,),
+        )
+        print(f"Imported {len(legacy_state)} entries from {STATE_JSON} to {STATE_DB}")
+
+
+def update_states(updates: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Update the state of several files in a single transaction.
+
+    Args:
+        updates (Dict[str, Dict[str, Any]]): The values to set, keyed by file key.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    rows = [
+        (file, key, json.dumps(value), now)
+        for file, data in updates.items()
+        for key, value in data.items()
+    ]
+    if not rows:
+        return
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            """
+            INSERT INTO state (file, key, value, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (file, key) DO UPDATE
+            SET value = excluded.value, updated_at = excluded.updated_at
+            """,
+            rows,
+        )
+
+
+def load_all() -> Dict[str, Dict[str, Any]]:
+    """Return the state of all files keyed by file key."""
+    state: Dict[str, Dict[str, Any]] = {}
+    rows = get_connection().execute("SELECT file, key, value FROM state ORDER BY file")
+    for file, key, value in rows:
+        state.setdefault(file, {})[key] = json.loads(value)
+    return state
+
+
+def get_cached_layouts(
+    content_hashes: List[str], processor_version: str
+) -> Dict[str, str]:
+    """
+    Look up stored Document AI layout output for PDFs by content hash.
+
+    Args:
+        content_hashes (List[str]): The content hashes of the PDFs.
+        processor_version (str): The processor version the layout must come from.
+
+    Returns:
+        Dict[str, str]: The layout blob name of each content hash that has one.
+    """
+    connection = get_connection()
+    cached: Dict[str, str] = {}
+    for content_hash in content_hashes:
+        row = connection.execute(
+            "SELECT layout_blob FROM layout_cache WHERE content_hash = ? AND processor_version = ?",
+            (content_hash, processor_version),
+        ).fetchone()
+        if row:
+            cached[content_hash] = row[0]
+    return cached
+
+
+def put_cached_layouts(layouts: Dict[str, str], processor_version: str) -> None:
+    """
+    Record where the Document AI layout output of PDFs is stored.
+
+    Args:
+        layouts (Dict[str, str]): The layout blob name keyed by PDF content hash.
+        processor_version (str): The processor version that produced the layouts.
+    """
+    if not layouts:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            """
+            INSERT INTO layout_cache (content_hash, processor_version, layout_blob, created_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (content_hash, processor_version) DO UPDATE
+            SET layout_blob = excluded.layout_blob, created_at = excluded.created_at
+            """,
+            [
+                (content_hash, processor_version, layout_blob, now)
+                for content_hash, layout_blob in layouts.items()
+            ],
+        )
+
+
+def get_cached_completions(prompt_hashes: List[str]) -> Dict[str, str]:
+    """
+    Look up stored completions by the hash of the request that produced them.
+
+    Args:
+        prompt_hashes (List[str]): The hashes of the requests.
+
+    Returns:
+        Dict[str, str]: The completion of each hash that has one.
+    """
+    connection = get_connection()
+    cached: Dict[str, str] = {}
+    for prompt_hash in prompt_hashes:
+        row = connection.execute(
+            "SELECT completion FROM completion_cache WHERE prompt_hash = ?",
+            (prompt_hash,),
+        ).fetchone()
+        if row:
+            cached[prompt_hash] = row[0]
+    return cached
+
+
+def put_cached_completions(completions: Dict[str, str]) -> None:
+    """
+    Store completions by the hash of the request that produced them.
+
+    Args:
+        completions (Dict[str, str]): The completion keyed by request hash.
+    """
+    if not completions:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            """
+            INSERT INTO completion_cache (prompt_hash, completion, created_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT (prompt_hash) DO UPDATE
+            SET completion = excluded.completion, created_at = excluded.created_at
+            """,
+            [
+                (prompt_hash, completion, now)
+                for prompt_hash, completion in completions.items()
+            ],
+        )
@@ -1,7 +1,21 @@
+import io
 import os
-from google.cloud import storage
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from typing import List, Tuple
+from typing import Any, BinaryIO, Dict, Iterator, List, Tuple
+
+import blob_cache
+from storage_backends import (
+    BlobInfo,
+    crc32c_base64,
+    get_backend,
+    has_suffix,
+    md5_base64,
+)
+
+# Keep below the default HTTP connection pool size of the GCS client (10)
+MAX_WORKERS: int = 8
 
 
 def upload_file_to_bucket(
@@ -19,15 +33,15 @@ def upload_file_to_bucket(
         source_file_path (str | None): The local path of the file to upload. Optional if file_contents is provided.
         file_contents (str | None): The contents of the file to upload. Optional if source_file_path is provided.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
+    backend = get_backend()
 
     if source_file_path:
-        blob.upload_from_filename(source_file_path)
+        backend.upload_from_filename(
+            bucket_name, destination_blob_name, source_file_path
+        )
         print(f"Uploaded {source_file_path} to {bucket_name}/{destination_blob_name}")
     elif file_contents is not None:
-        blob.upload_from_string(file_contents)
+        backend.upload_from_string(bucket_name, destination_blob_name, file_contents)
         print(f"Uploaded file contents to {bucket_name}/{destination_blob_name}")
     else:
         raise ValueError("Either source_file_path or file_contents must be provided")
@@ -36,21 +50,194 @@ def upload_file_to_bucket(
 def download_file(
     bucket_name: str, source_blob_name: str, destination_file_path: str | None = None
 ) -> str | None:
-    """Download a single file from GCS bucket to local path or return its contents."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
+    """Download a single file from GCS bucket to local path or return its contents.
+
+    When the local blob cache is enabled, the blob's generation is looked up first and
+    an unchanged blob is served from the cache instead of being downloaded again.
+    """
+    backend = get_backend()
+
+    if backend.cacheable and blob_cache.is_enabled():
+        info = backend.get_info(bucket_name, source_blob_name)
+        if info is None:
+            raise FileNotFoundError(
+                f"The blob {source_blob_name} does not exist in bucket {bucket_name}."
+            )
+        key = blob_cache.cache_key(bucket_name, source_blob_name, info.generation)
+        cached_path = blob_cache.get(key)
+        if cached_path is None:
+            data = backend.download_as_bytes(
+                bucket_name, source_blob_name, generation=info.generation
+            )
+            cached_path = blob_cache.put(key, data)
+            print(f"Downloaded {source_blob_name} to cache")
+        else:
+            print(f"Cache hit for {source_blob_name}")
+
+        if destination_file_path:
+            shutil.copyfile(cached_path, destination_file_path)
+            print(f"Copied cached {source_blob_name} to {destination_file_path}")
+            return None
+        with open(cached_path, "r", encoding="utf-8") as file:
+            return file.read()
 
     if destination_file_path:
-        blob.download_to_filename(destination_file_path)
+        backend.download_to_filename(
+            bucket_name, source_blob_name, destination_file_path
+        )
         print(f"Downloaded {source_blob_name} to {destination_file_path}")
         return None
     else:
-        contents = blob.download_as_text()
+        contents = backend.download_as_bytes(bucket_name, source_blob_name).decode(
+            "utf-8"
+        )
         print(f"Retrieved contents of {source_blob_name}")
         return contents
 
 
+class _CachingReader(io.RawIOBase):
+    """
+    Binary stream that copies the blob it reads into a blob cache entry.
+
+    The entry is committed once as many bytes as the blob's size have been read, and
+    discarded if the stream is closed before that.
+    """
+
+    def __init__(self, stream: BinaryIO, key: str, size: int) -> None:
+        self._stream = stream
+        self._key = key
+        self._size = size
+        self._written = 0
+        self._cache_file: BinaryIO | None
+        self._cache_file, self._temp_path = blob_cache.open_temp(key)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        data = self._stream.read(len(buffer))
+        buffer[: len(data)] = data
+        if self._cache_file is not None:
+            self._cache_file.write(data)
+            self._written += len(data)
+            if self._written >= self._size:
+                self._finish()
+        return len(data)
+
+    def _finish(self) -> None:
+        """Commit the entry if the whole blob was copied, else discard it."""
+        if self._cache_file is None:
+            return
+        self._cache_file.close()
+        self._cache_file = None
+        if self._written == self._size:
+            blob_cache.commit(self._key, self._temp_path)
+        else:
+            blob_cache.discard(self._temp_path)
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._finish()
+            finally:
+                self._stream.close()
+        super().close()
+
+
+def open_blob(bucket_name: str, source_blob_name: str) -> BinaryIO:
+    """Open a file in GCS bucket as a binary stream without downloading it as a whole.
+
+    With the local blob cache enabled, a cached copy is read from disk. Otherwise the
+    blob is streamed and copied into the cache as it is read, so that reading it to
+    the end leaves it cached for the next run.
+    """
+    backend = get_backend()
+
+    if backend.cacheable and blob_cache.is_enabled():
+        info = backend.get_info(bucket_name, source_blob_name)
+        if info is None:
+            raise FileNotFoundError(
+                f"The blob {source_blob_name} does not exist in bucket {bucket_name}."
+            )
+        key = blob_cache.cache_key(bucket_name, source_blob_name, info.generation)
+        cached_path = blob_cache.get(key)
+        if cached_path is not None:
+            print(f"Cache hit for {source_blob_name}")
+            return open(cached_path, "rb")
+        print(f"Streaming {source_blob_name} to cache")
+        stream = backend.open_for_read(
+            bucket_name, source_blob_name, generation=info.generation
+        )
+        return io.BufferedReader(_CachingReader(stream, key, info.size))
+
+    print(f"Streaming {source_blob_name}")
+    return backend.open_for_read(bucket_name, source_blob_name)
+
+
+def upload_many(
+    bucket_name: str,
+    uploads: List[Dict[str, Any]],
+    max_workers: int = MAX_WORKERS,
+) -> None:
+    """
+    Upload several files or file contents to GCP Storage bucket concurrently.
+
+    Args:
+        bucket_name (str): The name of the GCP Storage bucket.
+        uploads (List[Dict[str, Any]]): Keyword arguments for upload_file_to_bucket, one dict
+            per upload (destination_blob_name and source_file_path or file_contents).
+        max_workers (int): The maximum number of concurrent transfers.
+    """
+    if not uploads:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(uploads))) as executor:
+        # Consume the iterator so that the first failure is raised here
+        list(
+            executor.map(
+                lambda upload: upload_file_to_bucket(bucket_name, **upload), uploads
+            )
+        )
+
+
+def download_many(
+    bucket_name: str,
+    source_blob_names: List[str],
+    destination_file_paths: List[str] | None = None,
+    max_workers: int = MAX_WORKERS,
+) -> List[str | None]:
+    """
+    Download several files from GCS bucket concurrently.
+
+    Args:
+        bucket_name (str): The name of the GCS bucket.
+        source_blob_names (List[str]): The names of the blobs to download.
+        destination_file_paths (List[str] | None): Local paths to download the blobs to, in the
+            same order as source_blob_names. If omitted, the blob contents are returned.
+        max_workers (int): The maximum number of concurrent transfers.
+
+    Returns:
+        List[str | None]: The results of download_file in the order of source_blob_names.
+    """
+    if not source_blob_names:
+        return []
+    if destination_file_paths is None:
+        destination_file_paths = [None] * len(source_blob_names)
+    elif len(destination_file_paths) != len(source_blob_names):
+        raise ValueError(
+            "destination_file_paths must match source_blob_names in length"
+        )
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(source_blob_names))
+    ) as executor:
+        return list(
+            executor.map(
+                lambda args: download_file(bucket_name, *args),
+                zip(source_blob_names, destination_file_paths),
+            )
+        )
+
+
 def parse_gcs_uri(uri: str) -> Tuple[str, str]:
     """Parse a GCS URI into bucket and prefix.
 
@@ -66,58 +253,183 @@ def parse_gcs_uri(uri: str) -> Tuple[str, str]:
     return bucket_name, prefix
 
 
-def copy_batch_to_dir(batch_output_uri: str, chunks_dir: str) -> None:
+def local_file_info(file_path: str, blob_name: str | None = None) -> BlobInfo:
+    """Compute the size and GCS style checksums of a local file.
+
+    Args:
+        file_path (str): The local path of the file.
+        blob_name (str | None): The blob name to report, defaults to file_path.
+
+    Returns:
+        BlobInfo: The file's metadata, comparable with blobs_match.
+    """
+    with open(file_path, "rb") as file:
+        data = file.read()
+    return BlobInfo(
+        name=blob_name or file_path,
+        size=len(data),
+        crc32c=crc32c_base64(data),
+        md5_hash=md5_base64(data),
+    )
+
+
+def blobs_match(source: BlobInfo, destination: BlobInfo | None) -> bool:
+    """Check whether two blobs have identical content based on their checksums.
+
+    Args:
+        source (BlobInfo): The metadata of the source blob.
+        destination (BlobInfo | None): The metadata of the destination blob, or None if it does not exist.
+
+    Returns:
+        bool: True if the destination exists and its crc32c or md5 matches the source.
+    """
+    if destination is None:
+        return False
+    if source.crc32c and destination.crc32c:
+        return source.crc32c == destination.crc32c
+    if source.md5_hash and destination.md5_hash:
+        return source.md5_hash == destination.md5_hash
+    return False
+
+
+def _copy_blob_if_changed(
+    bucket_name: str, source: BlobInfo, destination_blob_name: str
+) -> bool:
+    """Copy a blob within the bucket unless the destination already has the same content."""
+    backend = get_backend()
+    if blobs_match(source, backend.get_info(bucket_name, destination_blob_name)):
+        print(f"Skipped {source.name}, {destination_blob_name} is up to date")
+        return False
+
+    backend.copy(bucket_name, source.name, destination_blob_name)
+    print(f"Copied {source.name} to {destination_blob_name}")
+    return True
+
+
+def copy_file(
+    bucket_name: str, source_blob_name: str, destination_blob_name: str
+) -> bool:
+    """Copy a file within a bucket unless the destination already has the same content.
+
+    Args:
+        bucket_name (str): The name of the GCS bucket.
+        source_blob_name (str): The name of the blob to copy.
+        destination_blob_name (str): The name of the copy.
+
+    Returns:
+        bool: True if the file was copied, False if the destination was up to date.
+
+    Raises:
+        FileNotFoundError: If the source blob does not exist.
+    """
+    source = get_backend().get_info(bucket_name, source_blob_name)
+    if source is None:
+        raise FileNotFoundError(
+            f"The blob {source_blob_name} does not exist in bucket {bucket_name}."
+        )
+    return _copy_blob_if_changed(bucket_name, source, destination_blob_name)
+
+
+def copy_batch_to_dir(
+    batch_output_uri: str, chunks_dir: str, max_workers: int = MAX_WORKERS
+) -> None:
     """Recursively move all JSON files from the batch output directory to the dchunks directory.
 
+    Copies are issued concurrently and destinations whose checksum already matches the
+    source are skipped.
+
     Args:
         batch_output_uri (str): The GCS URI of the batch output directory.
         dchunks_dir (str): The GCS URI of the destination dchunks directory.
+        max_workers (int): The maximum number of concurrent copies.
     """
-    storage_client = storage.Client()
-
     source_bucket_name, source_prefix = parse_gcs_uri(batch_output_uri)
     dest_bucket_name, dest_prefix = parse_gcs_uri(chunks_dir)
 
     if source_bucket_name != dest_bucket_name:
         raise ValueError("Source and destination buckets must be the same.")
 
-    bucket = storage_client.bucket(source_bucket_name)
-
-    blobs = bucket.list_blobs(prefix=source_prefix)
+    # The trailing slash keeps batch_1 from matching batch_10 and batch_1_retry1
+    blobs = iter_blobs(
+        source_bucket_name, f"{source_prefix.rstrip('/')}/", suffix=".json"
+    )
 
+    copies: List[Tuple[BlobInfo, str]] = []
     for blob in blobs:
-        if blob.name.endswith(".json"):
-            filename = os.path.basename(blob.name)  # Extract the filename
-            # Remove the '-0' before the .json extension
-            if filename.endswith("-0.json"):
-                filename = filename.replace("-0.json", ".json")
-            destination_blob_name = f"{dest_prefix}/{filename}"  # Set destination path
+        filename = os.path.basename(blob.name)  # Extract the filename
+        # Remove the '-0' before the .json extension
+        if filename.endswith("-0.json"):
+            filename = filename.replace("-0.json", ".json")
+        destination_blob_name = f"{dest_prefix}/{filename}"  # Set destination path
+        copies.append((blob, destination_blob_name))
+
+    if not copies:
+        print(f"No JSON files found in {batch_output_uri}")
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(copies))) as executor:
+        copied = list(
+            executor.map(
+                lambda copy: _copy_blob_if_changed(source_bucket_name, *copy),
+                copies,
+            )
+        )
+
+    print(
+        f"Copied {sum(copied)} of {len(copies)} files from {batch_output_uri} to {chunks_dir}"
+    )
+
+
+def blob_exists(bucket_name: str, blob_name: str) -> bool:
+    """Return True if the blob exists in the bucket."""
+    return get_backend().get_info(bucket_name, blob_name) is not None
+
+
+def iter_blobs(
+    bucket_name: str,
+    prefix: str,
+    suffix: str | None = None,
+    ignore_case: bool = False,
+) -> Iterator[BlobInfo]:
+    """Lazily list the files in a given GCS bucket directory.
 
-            # Copy the blob to the destination
-            bucket.copy_blob(blob, bucket, destination_blob_name)
+    Args:
+        bucket_name (str): The name of the GCS bucket.
+        prefix (str): The prefix (directory) to list files from.
+        suffix (str | None): Only list files whose name ends with this, e.g. ".json".
+        ignore_case (bool): Whether the suffix is matched case-insensitively.
 
-            print(f"Copied {blob.name} to {destination_blob_name}")
+    Returns:
+        Iterator[BlobInfo]: Name, size, generation and checksums of each file.
+    """
+    for blob in get_backend().list_blobs(bucket_name, prefix, suffix, ignore_case):
+        # Skip directory placeholder objects and anything the server-side glob let through
+        if not blob.name.endswith("/") and has_suffix(blob.name, suffix, ignore_case):
+            yield blob
 
 
-def list_files_in_dir(bucket_name: str, prefix: str) -> list[str]:
+def list_files_in_dir(
+    bucket_name: str,
+    prefix: str,
+    suffix: str | None = None,
+    ignore_case: bool = False,
+) -> list[str]:
     """List all files in a given GCS bucket directory.
 
     Args:
         bucket_name (str): The name of the GCS bucket.
         prefix (str): The prefix (directory) to list files from.
+        suffix (str | None): Only list files whose name ends with this, e.g. ".json".
+        ignore_case (bool): Whether the suffix is matched case-insensitively.
 
     Returns:
         list[str]: A list of file names in the specified directory.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=prefix)
-
-    file_list = [blob.name for blob in blobs if not blob.name.endswith("/")]
+    file_list = [
+        blob.name for blob in iter_blobs(bucket_name, prefix, suffix, ignore_case)
+    ]
 
-    print(f"Files in {bucket_name}/{prefix}:")
-    for file in file_list:
-        print(file)
+    print(f"Found {len(file_list)} files in {bucket_name}/{prefix}")
 
     return file_list
 
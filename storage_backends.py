@@ -0,0 +1,498 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterator, Tuple
+
+import dotenv
+import google_crc32c
+from google.cloud import storage
+
+dotenv.load_dotenv()
+
+STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "gcs")
+LOCAL_STORAGE_DIR: str = os.getenv("LOCAL_STORAGE_DIR", "local_storage")
+
+
+# Object fields requested when listing, everything else is left out of the response
+LIST_FIELDS: str = "items(name,size,generation,crc32c,md5Hash),nextPageToken"
+LIST_PAGE_SIZE: int = 1000
+# Files above this size are uploaded as chunked resumable uploads
+RESUMABLE_UPLOAD_THRESHOLD: int = 16 * 1024 * 1024
+# Must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE: int = 8 * 1024 * 1024
+# Bytes fetched per request when streaming a blob
+DOWNLOAD_CHUNK_SIZE: int = 4 * 1024 * 1024
+
+
+@dataclass(frozen=True, slots=True)
+class BlobInfo:
+    name: str
+    size: int
+    generation: int | None = None
+    crc32c: str | None = None
+    md5_hash: str | None = None
+
+
+def suffix_glob(suffix: str, ignore_case: bool = False) -> str:
+    """
+    Build a GCS match_glob pattern matching object names that end with suffix.
+
+    Args:
+        suffix (str): The required end of the object name, e.g. ".json".
+        ignore_case (bool): Whether letters in the suffix match in either case.
+
+    Returns:
+        str: The glob pattern.
+    """
+    if ignore_case:
+        suffix = "".join(
+            f"[{char.lower()}{char.upper()}]" if char.isalpha() else char
+            for char in suffix
+        )
+    return f"**{suffix}"
+
+
+def has_suffix(name: str, suffix: str | None, ignore_case: bool = False) -> bool:
+    """Return True if name ends with suffix, or if no suffix is given."""
+    if not suffix:
+        return True
+    if ignore_case:
+        return name.lower().endswith(suffix.lower())
+    return name.endswith(suffix)
+
+
+def md5_base64(data: bytes) -> str:
+    """Return the base64 encoded MD5 digest of data, the format GCS uses for md5Hash."""
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+
+def crc32c_base64(data: bytes) -> str:
+    """Return the base64 encoded CRC32C checksum of data, the format GCS uses for crc32c."""
+    return base64.b64encode(google_crc32c.Checksum(data).digest()).decode("ascii")
+
+
+class StorageBackend(ABC):
+    """Interface for the object stores the pipeline reads from and writes to."""
+
+    # Whether downloads are slow enough to be worth caching locally
+    cacheable: bool = False
+
+    @abstractmethod
+    def upload_from_filename(
+        self, bucket_name: str, blob_name: str, source_file_path: str
+    ) -> None:
+        """Upload a local file to a blob."""
+
+    @abstractmethod
+    def upload_from_string(
+        self, bucket_name: str, blob_name: str, contents: str | bytes
+    ) -> None:
+        """Upload text or bytes to a blob."""
+
+    @abstractmethod
+    def download_as_bytes(
+        self, bucket_name: str, blob_name: str, generation: int | None = None
+    ) -> bytes:
+        """Download the contents of a blob, optionally requiring a specific generation."""
+
+    def download_to_filename(
+        self, bucket_name: str, blob_name: str, destination_file_path: str
+    ) -> None:
+        """Download a blob to a local file."""
+        with open(destination_file_path, "wb") as file:
+            file.write(self.download_as_bytes(bucket_name, blob_name))
+
+    def open_for_read(
+        self, bucket_name: str, blob_name: str, generation: int | None = None
+    ) -> BinaryIO:
+        """Open a blob as a binary stream, optionally requiring a specific generation."""
+        return io.BytesIO(self.download_as_bytes(bucket_name, blob_name, generation))
+
+    @abstractmethod
+    def get_info(self, bucket_name: str, blob_name: str) -> BlobInfo | None:
+        """Return the metadata of a blob, or None if it does not exist."""
+
+    @abstractmethod
+    def list_blobs(
+        self,
+        bucket_name: str,
+        prefix: str,
+        suffix: str | None = None,
+        ignore_case: bool = False,
+    ) -> Iterator[BlobInfo]:
+        """Lazily yield the metadata of blobs whose name starts with prefix and ends with suffix."""
+
+    @abstractmethod
+    def copy(
+        self, bucket_name: str, source_blob_name: str, destination_blob_name: str
+    ) -> None:
+        """Copy a blob to a new name within the same bucket."""
+
+
+class GCSBackend(StorageBackend):
+    """Google Cloud Storage backend sharing one lazily created client."""
+
+    cacheable = True
+
+    def __init__(self) -> None:
+        self._client: storage.Client | None = None
+        self._buckets: Dict[str, storage.Bucket] = {}
+        self._lock = threading.Lock()
+
+    def get_client(self) -> storage.Client:
+        """Return the shared GCS client, creating it on first use."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = storage.Client()
+        return self._client
+
+    def get_bucket(self, bucket_name: str) -> storage.Bucket:
+        """Return a cached bucket handle for the given bucket name."""
+        bucket = self._buckets.get(bucket_name)
+        if bucket is None:
+            client = self.get_client()
+            with self._lock:
+                bucket = self._buckets.get(bucket_name)
+                if bucket is None:
+                    bucket = client.bucket(bucket_name)
+                    self._buckets[bucket_name] = bucket
+        return bucket
+
+    @staticmethod
+    def _to_info(blob: storage.Blob) -> BlobInfo:
+        return BlobInfo(
+            name=blob.name,
+            size=blob.size or 0,
+            generation=blob.generation,
+            crc32c=blob.crc32c,
+            md5_hash=blob.md5_hash,
+        )
+
+    def upload_from_filename(
+        self, bucket_name: str, blob_name: str, source_file_path: str
+    ) -> None:
+        blob = self.get_bucket(bucket_name).blob(blob_name)
+        if os.path.getsize(source_file_path) > RESUMABLE_UPLOAD_THRESHOLD:
+            # Chunked resumable upload, a failed chunk is retried instead of the whole file
+            blob.chunk_size = UPLOAD_CHUNK_SIZE
+        blob.upload_from_filename(source_file_path)
+
+    def upload_from_string(
+        self, bucket_name: str, blob_name: str, contents: str | bytes
+    ) -> None:
+        self.get_bucket(bucket_name).blob(blob_name).upload_from_string(contents)
+
+    def download_as_bytes(
+        self, bucket_name: str, blob_name: str, generation: int | None = None
+    ) -> bytes:
+        blob = self.get_bucket(bucket_name).blob(blob_name)
+        return blob.download_as_bytes(if_generation_match=generation)
+
+    def download_to_filename(
+        self, bucket_name: str, blob_name: str, destination_file_path: str
+    ) -> None:
+        self.get_bucket(bucket_name).blob(blob_name).download_to_filename(
+            destination_file_path
+        )
+
+    def open_for_read(
+        self, bucket_name: str, blob_name: str, generation: int | None = None
+    ) -> BinaryIO:
+        blob = self.get_bucket(bucket_name).blob(blob_name)
+        return blob.open(
+            "rb", chunk_size=DOWNLOAD_CHUNK_SIZE, if_generation_match=generation
+        )
+
+    def get_info(self, bucket_name: str, blob_name: str) -> BlobInfo | None:
+        blob = self.get_bucket(bucket_name).get_blob(blob_name)
+        return self._to_info(blob) if blob is not None else None
+
+    def list_blobs(
+        self,
+        bucket_name: str,
+        prefix: str,
+        suffix: str | None = None,
+        ignore_case: bool = False,
+    ) -> Iterator[BlobInfo]:
+        # Pages are fetched lazily as the iterator is consumed
+        blobs = self.get_bucket(bucket_name).list_blobs(
+            prefix=prefix,
+            match_glob=suffix_glob(suffix, ignore_case) if suffix else None,
+            fields=LIST_FIELDS,
+            page_size=LIST_PAGE_SIZE,
+        )
+        for blob in blobs:
+            yield self._to_info(blob)
+
+    def copy(
+        self, bucket_name: str, source_blob_name: str, destination_blob_name: str
+    ) -> None:
+        bucket = self.get_bucket(bucket_name)
+        bucket.copy_blob(bucket.blob(source_blob_name), bucket, destination_blob_name)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Backend storing each bucket as a directory under a local root directory.
+
+    Checksums are computed when a file is first listed and kept in a file in the root
+    directory at the end of each listing, with the size and mtime_ns they were
+    computed at, so later listings only read the files that changed since.
+    """
+
+    CHECKSUMS_FILE: str = ".checksums.json"
+
+    def __init__(self, root_dir: str) -> None:
+        self.root_dir = root_dir
+        self._checksums: Dict[str, Tuple[int, int, str, str]] | None = None
+        self._checksums_changed = False
+        self._checksums_lock = threading.Lock()
+
+    def _load_checksums(self) -> Dict[str, Tuple[int, int, str, str]]:
+        if self._checksums is None:
+            try:
+                with open(
+                    os.path.join(self.root_dir, self.CHECKSUMS_FILE), encoding="utf-8"
+                ) as file:
+                    self._checksums = {
+                        path: tuple(entry) for path, entry in json.load(file).items()
+                    }
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._checksums = {}
+        return self._checksums
+
+    def _save_checksums(self) -> None:
+        with self._checksums_lock:
+            if not self._checksums_changed:
+                return
+            os.makedirs(self.root_dir, exist_ok=True)
+            path = os.path.join(self.root_dir, self.CHECKSUMS_FILE)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(self._checksums, file)
+            os.replace(temp_path, path)
+            self._checksums_changed = False
+
+    def _path(self, bucket_name: str, blob_name: str) -> str:
+        return os.path.join(self.root_dir, bucket_name, *blob_name.split("/"))
+
+    def _info(self, bucket_name: str, blob_name: str, path: str) -> BlobInfo:
+        stat = os.stat(path)
+        key = os.path.relpath(path, self.root_dir)
+        with self._checksums_lock:
+            cached = self._load_checksums().get(key)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            crc32c, md5_hash = cached[2:]
+        else:
+            with open(path, "rb") as file:
+                data = file.read()
+            crc32c, md5_hash = crc32c_base64(data), md5_base64(data)
+            with self._checksums_lock:
+                self._load_checksums()[key] = (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    crc32c,
+                    md5_hash,
+                )
+                self._checksums_changed = True
+        return BlobInfo(
+            name=blob_name,
+            size=stat.st_size,
+            generation=stat.st_mtime_ns,
+            crc32c=crc32c,
+            md5_hash=md5_hash,
+        )
+
+    def upload_from_filename(
+        self, bucket_name: str, blob_name: str, source_file_path: str
+    ) -> None:
+        path = self._path(bucket_name, blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(source_file_path, path)
+
+    def upload_from_string(
+        self, bucket_name: str, blob_name: str, contents: str | bytes
+    ) -> None:
+        path = self._path(bucket_name, blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = contents.encode("utf-8") if isinstance(contents, str) else contents
+        with open(path, "wb") as file:
+            file.write(data)
+
+    def download_as_bytes(
+        self, bucket_name: str, blob_name: str, generation: int | None = None
+    ) -> bytes:
+        with open(self._path(bucket_name, blob_name), "rb") as file:
+            return file.read()
+
+    def download_to_filename(
+        self, bucket_name: str, blob_name: str, destination_file_path: str
+    ) -> None:
+        shutil.copyfile(self._path(bucket_name, blob_name), destination_file_path)
+
+    def open_for_read(
+        self, bucket_name: str, blob_name: str, generation: int | None = None
+    ) -> BinaryIO:
+        return open(self._path(bucket_name, blob_name), "rb")
+
+    def get_info(self, bucket_name: str, blob_name: str) -> BlobInfo | None:
+        path = self._path(bucket_name, blob_name)
+        if not os.path.isfile(path):
+            return None
+        return self._info(bucket_name, blob_name, path)
+
+    def list_blobs(
+        self,
+        bucket_name: str,
+        prefix: str,
+        suffix: str | None = None,
+        ignore_case: bool = False,
+    ) -> Iterator[BlobInfo]:
+        bucket_dir = os.path.join(self.root_dir, bucket_name)
+        for dir_path, dir_names, file_names in os.walk(bucket_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                path = os.path.join(dir_path, file_name)
+                blob_name = os.path.relpath(path, bucket_dir).replace(os.sep, "/")
+                if blob_name.startswith(prefix) and has_suffix(
+                    blob_name, suffix, ignore_case
+                ):
+                    yield self._info(bucket_name, blob_name, path)
+        self._save_checksums()
+
+    def copy(
+        self, bucket_name: str, source_blob_name: str, destination_blob_name: str
+    ) -> None:
+        self.upload_from_filename(
+            bucket_name,
+            destination_blob_name,
+            self._path(bucket_name, source_blob_name),
+        )
+
+
+class MemoryBackend(StorageBackend):
+    """Backend keeping all blobs in process memory, for single-process runs."""
+
+    def __init__(self) -> None:
+        self._blobs: Dict[Tuple[str, str], Tuple[bytes, int]] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def upload_from_filename(
+        self, bucket_name: str, blob_name: str, source_file_path: str
+    ) -> None:
+        with open(source_file_path, "rb") as file:
+            self.upload_from_string(bucket_name, blob_name, file.read())
+
+    def upload_from_string(
+        self, bucket_name: str, blob_name: str, contents: str | bytes
+    ) -> None:
+        data = contents.encode("utf-8") if isinstance(contents, str) else contents
+        with self._lock:
+            self._generation += 1
+            self._blobs[(bucket_name, blob_name)] = (data, self._generation)
+
+    def download_as_bytes(
+        self, bucket_name: str, blob_name: str, generation: int | None = None
+    ) -> bytes:
+        try:
+            data, current_generation = self._blobs[(bucket_name, blob_name)]
+        except KeyError:
+            raise FileNotFoundError(
+                f"The blob {bucket_name}/{blob_name} does not exist."
+            )
+        if generation is not None and generation != current_generation:
+            raise ValueError(f"The blob {bucket_name}/{blob_name} has changed.")
+        return data
+
+    def get_info(self, bucket_name: str, blob_name: str) -> BlobInfo | None:
+        entry = self._blobs.get((bucket_name, blob_name))
+        if entry is None:
+            return None
+        data, generation = entry
+        return BlobInfo(
+            name=blob_name,
+            size=len(data),
+            generation=generation,
+            crc32c=crc32c_base64(data),
+            md5_hash=md5_base64(data),
+        )
+
+    def list_blobs(
+        self,
+        bucket_name: str,
+        prefix: str,
+        suffix: str | None = None,
+        ignore_case: bool = False,
+    ) -> Iterator[BlobInfo]:
+        with self._lock:
+            names = sorted(
+                name
+                for bucket, name in self._blobs
+                if bucket == bucket_name
+                and name.startswith(prefix)
+                and has_suffix(name, suffix, ignore_case)
+            )
+        for name in names:
+            info = self.get_info(bucket_name, name)
+            if info is not None:
+                yield info
+
+    def copy(
+        self, bucket_name: str, source_blob_name: str, destination_blob_name: str
+    ) -> None:
+        self.upload_from_string(
+            bucket_name,
+            destination_blob_name,
+            self.download_as_bytes(bucket_name, source_blob_name),
+        )
+
+
+_backend: StorageBackend | None = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(name: str) -> StorageBackend:
+    """
+    Create a storage backend by name.
+
+    Args:
+        name (str): One of "gcs", "local" or "memory".
+
+    Returns:
+        StorageBackend: The new backend instance.
+
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    if name == "gcs":
+        return GCSBackend()
+    if name == "local":
+        return LocalBackend(LOCAL_STORAGE_DIR)
+    if name == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+def get_backend() -> StorageBackend:
+    """Return the process-wide storage backend selected with STORAGE_BACKEND."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend(STORAGE_BACKEND)
+    return _backend
+
+
+def set_backend(backend: StorageBackend) -> None:
+    """Replace the process-wide storage backend, e.g. with a MemoryBackend."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The scripts import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# llm creates its OpenAI client at import, which needs a key but no requests
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,155 @@
+import io
+import json
+import random
+from typing import Any
+
+import pytest
+
+import chunks_to_sections
+from chunks_to_sections import FlatLayout, flatten_layout, flatten_layout_stream
+from json_stream import JsonStreamReader
+
+READ_SIZES = [7, 13, 64, 1000, 256 * 1024]
+
+# Characters that stress string handling: quotes, backslashes, control characters
+# written as escapes, and characters outside the Basic Multilingual Plane
+_CHARS = 'aäö §"\\/\n\t \U0001f600{}[],:'
+
+
+def random_string(rng: random.Random, max_length: int = 40) -> str:
+    return "".join(rng.choice(_CHARS) for _ in range(rng.randint(0, max_length)))
+
+
+def random_value(rng: random.Random, depth: int = 0) -> Any:
+    kind = rng.randrange(8 if depth < 4 else 5)
+    if kind == 0:
+        return rng.choice([None, True, False])
+    if kind == 1:
+        return rng.randint(-(10**12), 10**12)
+    if kind == 2:
+        return rng.uniform(-1e6, 1e6) * 10 ** rng.randint(-30, 30)
+    if kind in (3, 4):
+        return random_string(rng)
+    if kind in (5, 6):
+        return {
+            random_string(rng, 8): random_value(rng, depth + 1)
+            for _ in range(rng.randint(0, 5))
+        }
+    return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 5))]
+
+
+def walk(reader: JsonStreamReader, rng: random.Random) -> Any:
+    """Rebuild the next value with the structural calls, skipping some of it."""
+    char = reader.peek()
+    if char == "{":
+        reader.expect("{")
+        result = {}
+        while reader.next_item("}"):
+            key = reader.read_key()
+            if rng.random() < 0.2:
+                reader.skip_value()
+                result[key] = "<skipped>"
+            else:
+                result[key] = walk(reader, rng)
+        return result
+    if char == "[":
+        reader.expect("[")
+        result = []
+        while reader.next_item("]"):
+            if rng.random() < 0.2:
+                reader.skip_value()
+                result.append("<skipped>")
+            else:
+                result.append(walk(reader, rng))
+        return result
+    if rng.random() < 0.5:
+        decoded, value = reader.try_read_value()
+        if decoded:
+            return value
+    return reader.read_value()
+
+
+def expected(value: Any, rng: random.Random) -> Any:
+    """Replay the skips of walk on the decoded value."""
+    if isinstance(value, dict):
+        return {
+            key: "<skipped>" if rng.random() < 0.2 else expected(item, rng)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [
+            "<skipped>" if rng.random() < 0.2 else expected(item, rng) for item in value
+        ]
+    # Mirrors the coin flip between try_read_value and read_value
+    rng.random()
+    return value
+
+
+@pytest.mark.parametrize("read_size", READ_SIZES)
+def test_reader_matches_json_loads(read_size: int) -> None:
+    for seed in range(300):
+        value = random_value(random.Random(seed))
+        data = json.dumps(value, ensure_ascii=seed % 2 == 0, indent=seed % 3 or None)
+        reader = JsonStreamReader(io.BytesIO(data.encode("utf-8")), read_size)
+        walked = walk(reader, random.Random(seed))
+        assert walked == expected(json.loads(data), random.Random(seed)), data
+        assert reader.peek() == ""
+
+
+def random_block(rng: random.Random, depth: int = 0) -> dict:
+    text_type = rng.choice(
+        ["paragraph", "heading-1", "heading-2", "heading-3", "header", "footer"]
+    )
+    text_block: dict = {
+        "text": random_string(rng, rng.choice([10, 200, 2000])),
+        "type": text_type,
+    }
+    if depth < 3 and rng.random() < 0.4:
+        text_block["blocks"] = [
+            random_block(rng, depth + 1) for _ in range(rng.randint(1, 4))
+        ]
+    items = list(text_block.items())
+    # Nested blocks may come before the type and text of their block
+    rng.shuffle(items)
+    block = {
+        "blockId": str(rng.randint(0, 10**6)),
+        "textBlock": dict(items),
+        "pageSpan": {"pageStart": 1, "pageEnd": rng.randint(1, 40)},
+    }
+    if rng.random() < 0.2:
+        block["tableBlock"] = random_value(rng, 1)
+    return block
+
+
+def flat_fields(flat: FlatLayout) -> tuple:
+    return (
+        list(flat.kinds),
+        list(flat.levels),
+        list(flat.ignored),
+        flat.texts,
+        flat.page_count,
+    )
+
+
+@pytest.mark.parametrize("read_size", READ_SIZES)
+def test_streamed_layout_matches_json_loads(
+    read_size: int, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(
+        chunks_to_sections,
+        "JsonStreamReader",
+        lambda stream: JsonStreamReader(stream, read_size),
+    )
+    for seed in range(100):
+        rng = random.Random(seed)
+        layout = {
+            "uri": "",
+            "documentLayout": {
+                "blocks": [random_block(rng) for _ in range(rng.randint(0, 12))]
+            },
+            "chunkedDocument": random_value(rng, 2),
+        }
+        data = json.dumps(layout, ensure_ascii=seed % 2 == 0).encode("utf-8")
+        streamed = flatten_layout_stream(io.BytesIO(data))
+        loaded = flatten_layout(json.loads(data)["documentLayout"]["blocks"])
+        assert flat_fields(streamed) == flat_fields(loaded)
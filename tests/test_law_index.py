@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from law_index import LawIndex
+
+LAW_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "new-construction-law.txt",
+)
+
+
+@pytest.fixture(scope="module")
+def law_index() -> LawIndex:
+    with open(LAW_FILE, "r", encoding="utf-8") as f:
+        return LawIndex.build(f.read())
+
+
+@pytest.mark.parametrize(
+    "query, number",
+    [
+        # Compounds of "rakennus" must not all match each other
+        ("rakennusjäte", "16"),
+        ("Rakennusjätteen lajittelu ja kierrätys työmaalla.", "16"),
+        # Inflected forms and compounds of "kosteus"
+        ("kosteus", "33"),
+        ("kosteuden", "33"),
+        ("kosteudenhallinta", "33"),
+        ("Makuuhuoneiden ikkunat ja riittävä päivänvalo asunnossa.", "40"),
+        ("suunnittelijoiden kelpoisuus", "83"),
+        ("suunnittelijan kelpoisuuden toteaminen", "85"),
+    ],
+)
+def test_search_finds_the_relevant_passage(
+    law_index: LawIndex, query: str, number: str
+) -> None:
+    assert number in [passage.number for passage in law_index.search(query, 3)]
@@ -0,0 +1,183 @@
+import json
+from typing import Dict, List, Set
+
+import pytest
+
+import llm
+import state_store
+from llm import (
+    load_section_keys,
+    merge_cached_completions,
+    prepare_batch_input,
+    section_keys_path,
+    unpack_results,
+)
+
+LAW_TEXT = "1 §\nSoveltamisala\nTätä lakia sovelletaan rakentamiseen."
+
+
+@pytest.fixture(autouse=True)
+def state_db(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Run each test in an empty directory with a state database of its own."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(state_store, "STATE_DB", str(tmp_path / "state.db"))
+    monkeypatch.setattr(state_store._local, "connection", None, raising=False)
+
+
+def make_sections(filename: str, count: int) -> List[Dict]:
+    return [
+        {
+            "custom_id": f"{filename}-Section-{index}",
+            "section": {"title": f"Osio {index}", "content": [f"Teksti {index}."]},
+        }
+        for index in range(1, count + 1)
+    ]
+
+
+class FakeClient:
+    """Answers batch input files the way the Batch API would, recording the requests."""
+
+    def __init__(self, missing: Set[str] | None = None) -> None:
+        # Sections a packed answer leaves out
+        self.missing = missing or set()
+        self.custom_ids: List[str] = []
+
+    def answer(self, batch_input_path: str) -> List[Dict]:
+        results = []
+        with open(batch_input_path, "r", encoding="utf-8") as f:
+            for line in f:
+                request = json.loads(line)
+                custom_id = request["custom_id"]
+                self.custom_ids.append(custom_id)
+                match = llm.PACK_ID.fullmatch(custom_id)
+                if match is None:
+                    content = f"answer to {custom_id}"
+                else:
+                    content = json.dumps(
+                        {
+                            "results": [
+                                {
+                                    "section": index,
+                                    "analysis": f"answer to {match['filename']}"
+                                    f"-Section-{index}",
+                                }
+                                for index in range(
+                                    int(match["first"]), int(match["last"]) + 1
+                                )
+                                if f"{match['filename']}-Section-{index}"
+                                not in self.missing
+                            ]
+                        }
+                    )
+                results.append(
+                    {
+                        "custom_id": custom_id,
+                        "response": {
+                            "status_code": 200,
+                            "body": {"choices": [{"message": {"content": content}}]},
+                        },
+                        "error": None,
+                    }
+                )
+        return results
+
+
+def run_batch(
+    client: FakeClient,
+    sections: List[Dict],
+    representatives: Dict[str, str] | None = None,
+    completion_keys: Dict[str, str] | None = None,
+) -> Dict[str, Dict]:
+    """Prepare, answer, unpack and merge one batch, returning the results by custom_id."""
+    path, _ = prepare_batch_input(
+        sections,
+        LAW_TEXT,
+        representatives=representatives,
+        completion_keys=completion_keys,
+    )
+    with open(section_keys_path(path), "r", encoding="utf-8") as f:
+        section_keys, batch_representatives = load_section_keys(f.read())
+    results = merge_cached_completions(
+        unpack_results(client.answer(path)), section_keys, batch_representatives
+    )
+    assert [result["custom_id"] for result in results] == [
+        item["custom_id"] for item in sections
+    ]
+    return {result["custom_id"]: result for result in results}
+
+
+def content(result: Dict) -> str | None:
+    return llm.completion_content(result)
+
+
+def test_packed_answers_round_trip(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(llm, "PACK_TOKENS", 10_000)
+    sections = make_sections("a.pdf", 4)
+    # Section 3 repeats section 1, so 2 and 4 are not consecutive and not packed
+    representatives = {"a.pdf-Section-3": "a.pdf-Section-1"}
+
+    client = FakeClient()
+    results = run_batch(client, sections, representatives)
+    assert client.custom_ids == ["a.pdf-Pack-1-2", "a.pdf-Section-4"]
+    assert content(results["a.pdf-Section-1"]) == "answer to a.pdf-Section-1"
+    assert content(results["a.pdf-Section-2"]) == "answer to a.pdf-Section-2"
+    assert content(results["a.pdf-Section-4"]) == "answer to a.pdf-Section-4"
+    # The member gets the answer of its representative and is flagged
+    assert content(results["a.pdf-Section-3"]) == "answer to a.pdf-Section-1"
+    assert results["a.pdf-Section-3"]["representative"] == "a.pdf-Section-1"
+
+    # Preparing the same sections again sends nothing and answers all from the cache
+    client = FakeClient()
+    rerun = run_batch(client, sections, representatives)
+    assert client.custom_ids == []
+    assert {custom_id: content(result) for custom_id, result in rerun.items()} == {
+        custom_id: content(result) for custom_id, result in results.items()
+    }
+
+
+def test_packed_answers_are_not_shared_with_other_packs(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(llm, "PACK_TOKENS", 10_000)
+    run_batch(FakeClient(), make_sections("a.pdf", 2))
+
+    # The same sections sent one by one are requests of their own
+    monkeypatch.setattr(llm, "PACK_TOKENS", 0)
+    client = FakeClient()
+    run_batch(client, make_sections("a.pdf", 2))
+    assert client.custom_ids == ["a.pdf-Section-1", "a.pdf-Section-2"]
+
+
+def test_section_missing_from_packed_answer_is_sent_again(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(llm, "PACK_TOKENS", 10_000)
+    sections = make_sections("a.pdf", 3)
+
+    results = run_batch(FakeClient(missing={"a.pdf-Section-2"}), sections)
+    assert content(results["a.pdf-Section-1"]) == "answer to a.pdf-Section-1"
+    assert content(results["a.pdf-Section-2"]) is None
+    assert results["a.pdf-Section-2"]["error"]
+
+    # The pack is sent again, as not all of its answers are cached
+    client = FakeClient()
+    results = run_batch(client, sections)
+    assert client.custom_ids == ["a.pdf-Pack-1-3"]
+    assert content(results["a.pdf-Section-2"]) == "answer to a.pdf-Section-2"
+
+
+def test_near_duplicate_of_an_earlier_batch(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(llm, "PACK_TOKENS", 10_000)
+    completion_keys: Dict[str, str] = {}
+    run_batch(FakeClient(), make_sections("a.pdf", 2), completion_keys=completion_keys)
+
+    client = FakeClient()
+    results = run_batch(
+        client,
+        make_sections("b.pdf", 2),
+        representatives={"b.pdf-Section-2": "a.pdf-Section-2"},
+        completion_keys=completion_keys,
+    )
+    assert client.custom_ids == ["b.pdf-Section-1"]
+    assert content(results["b.pdf-Section-2"]) == "answer to a.pdf-Section-2"
+    assert results["b.pdf-Section-2"]["representative"] == "a.pdf-Section-2"
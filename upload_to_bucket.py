@@ -1,13 +1,24 @@
 import os
 import glob
-from typing import Generator, Dict, Any
-from helpers import check_args_and_env_vars, update_state
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Generator, Dict, Any, List
+from helpers import check_args_and_env_vars, update_states
 from datetime import datetime, timezone
-from storage import upload_file_to_bucket
+from storage_backends import BlobInfo
+from storage import (
+    MAX_WORKERS,
+    blobs_match,
+    iter_blobs,
+    local_file_info,
+    upload_file_to_bucket,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
 
+MANIFEST_FILE: str = "upload_manifest.json"
+
 
 def get_pdf_files(directory: str) -> Generator[str, None, None]:
     """Retrieve all PDF files from the specified directory using a generator."""
@@ -15,31 +26,175 @@ def get_pdf_files(directory: str) -> Generator[str, None, None]:
     yield from glob.iglob(pattern)
 
 
+def load_manifest() -> Dict[str, Any]:
+    """Load the upload manifest from a JSON file."""
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    try:
+        with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        print(
+            f"Warning: {MANIFEST_FILE} is not a valid JSON. Starting with an empty manifest."
+        )
+        return {}
+
+
+def save_manifest(manifest: Dict[str, Any]) -> None:
+    """Save the upload manifest to a JSON file."""
+    with open(MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def cached_file_info(
+    file_path: str, upload_path: str, manifest: Dict[str, Any]
+) -> BlobInfo:
+    """
+    Return the checksums of a local file, from the manifest if the file is unchanged.
+
+    Args:
+        file_path (str): The local path of the PDF.
+        upload_path (str): The blob name the PDF is uploaded to.
+        manifest (Dict[str, Any]): The upload manifest, whose entries hold the size,
+            mtime_ns and checksums of each file when it was last hashed.
+
+    Returns:
+        BlobInfo: The file's metadata, read and hashed only if its size or mtime_ns
+            changed since the manifest entry was written.
+    """
+    stat = os.stat(file_path)
+    entry = manifest.get(os.path.basename(file_path), {})
+    if (
+        entry.get("blob") == upload_path
+        and entry.get("size") == stat.st_size
+        and entry.get("mtimeNs") == stat.st_mtime_ns
+    ):
+        return BlobInfo(
+            name=upload_path,
+            size=stat.st_size,
+            crc32c=entry.get("crc32c"),
+            md5_hash=entry.get("md5Hash"),
+        )
+    return local_file_info(file_path, upload_path)
+
+
+def upload_files(bucket_name: str, uploads: List[Dict[str, Any]]) -> Dict[str, str]:
+    """
+    Upload files concurrently, carrying on past failed uploads.
+
+    Args:
+        bucket_name (str): The name of the GCP Storage bucket.
+        uploads (List[Dict[str, Any]]): Keyword arguments for upload_file_to_bucket, one
+            dict per upload.
+
+    Returns:
+        Dict[str, str]: The error of each failed upload by destination blob name.
+    """
+    errors: Dict[str, str] = {}
+    if not uploads:
+        return errors
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(uploads))) as executor:
+        futures = {
+            executor.submit(upload_file_to_bucket, bucket_name, **upload): upload[
+                "destination_blob_name"
+            ]
+            for upload in uploads
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to upload {futures[future]}: {e}")
+                errors[futures[future]] = str(e)
+    return errors
+
+
 def main() -> None:
-    """Main function to upload all PDF files in the specified PDF_DIR to GCP Storage bucket."""
-    config = check_args_and_env_vars(required_env_vars=["BUCKET_NAME", "PDF_DIR"])
+    """Main function to sync the PDF files in the specified PDF_DIR to GCP Storage bucket.
+
+    Only files that are missing from the bucket or whose checksum differs are uploaded,
+    unless --force is given.
+    """
+    config = check_args_and_env_vars(
+        required_env_vars=["BUCKET_NAME", "PDF_DIR"], flag_args=["--force"]
+    )
 
     bucket_name = config["BUCKET_NAME"]
     pdf_dir = config["PDF_DIR"]
+    force = config["FORCE"]
+
+    pdf_files = list(get_pdf_files(pdf_dir))
+
+    if not pdf_files:
+        print("No PDF files found to upload.")
+        return
 
-    pdf_files = get_pdf_files(pdf_dir)
+    remote_blobs = (
+        {}
+        if force
+        else {
+            blob.name: blob
+            for blob in iter_blobs(
+                bucket_name, pdf_dir, suffix=".pdf", ignore_case=True
+            )
+        }
+    )
 
-    has_files = False
+    # The manifest doubles as a checksum cache, so only new or changed PDFs are read
+    manifest = load_manifest()
+    uploads: List[Dict[str, Any]] = []
+    manifest_entries: Dict[str, Dict[str, Any]] = {}
     for file_path in pdf_files:
-        print(f"Found file: {file_path}")
-        has_files = True
         file_name = os.path.basename(file_path)
         upload_path = os.path.join(pdf_dir, file_name)
-        print(
-            f"Uploading {file_path} to {upload_path} in bucket {bucket_name}"
-        )  # Debugging line
-        upload_file_to_bucket(
-            bucket_name, file_path, upload_path
-        )  # Ensure file_path is correct
-        update_state(file_name, {"uploadedAt": datetime.now(timezone.utc).isoformat()})
-
-    if not has_files:
-        print("No PDF files found to upload.")
+        mtime_ns = os.stat(file_path).st_mtime_ns
+        local_info = cached_file_info(file_path, upload_path, manifest)
+        entry = {
+            "blob": upload_path,
+            "size": local_info.size,
+            "mtimeNs": mtime_ns,
+            "md5Hash": local_info.md5_hash,
+            "crc32c": local_info.crc32c,
+        }
+
+        if blobs_match(local_info, remote_blobs.get(upload_path)):
+            print(f"Skipping {file_path}, already up to date in bucket {bucket_name}")
+            manifest[file_name] = {**manifest.get(file_name, {}), **entry}
+            continue
+
+        uploads.append(
+            {"destination_blob_name": upload_path, "source_file_path": file_path}
+        )
+        manifest_entries[file_name] = entry
+
+    print(
+        f"Uploading {len(uploads)} of {len(pdf_files)} PDF files to bucket {bucket_name}"
+    )
+    errors = upload_files(bucket_name, uploads)
+
+    # The successful uploads are recorded even if others failed
+    upload_time = datetime.now(timezone.utc).isoformat()
+    uploaded = {
+        file_name: entry
+        for file_name, entry in manifest_entries.items()
+        if entry["blob"] not in errors
+    }
+    for file_name, entry in uploaded.items():
+        entry["uploadedAt"] = upload_time
+        manifest[file_name] = entry
+    save_manifest(manifest)
+    update_states(
+        {
+            file_name: (
+                {"uploadedAt": upload_time}
+                if file_name in uploaded
+                else {"uploadFailedAt": upload_time}
+            )
+            for file_name in manifest_entries
+        }
+    )
+    if errors:
+        print(f"{len(errors)} of {len(uploads)} uploads failed")
 
 
 if __name__ == "__main__":